@@ -0,0 +1,350 @@
+'''
+基于asyncio的隧道引擎。
+
+与 client_connection / server_connection 实现相同的流程（HTTP CONNECT → Shadow头 → 双向转发），
+但使用asyncio的Protocol/Transport。读写缓冲由事件循环管理，安装了uvloop时会自动使用uvloop。
+'''
+
+import asyncio
+import logging
+
+from common import (BadHttpHeader, NoAcceptableMethods, create_listener,
+                    make_shadow_head, parse_http, parse_shadow_head,
+                    shadow_head_length, to_bytes, to_str)
+from encypt import CyptorFactory, DecipherError
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+
+class RemoteProtocol(asyncio.Protocol):
+    '''
+    远程套接字一侧的协议，把所有事件转交给对应的连接对象。
+    '''
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def data_received(self, data):
+        self.conn.on_remote_data(data)
+
+    def eof_received(self):
+        return self.conn.on_remote_eof()
+
+    def connection_lost(self, exc):
+        self.conn.destory()
+
+    def pause_writing(self):
+        # 远程写缓冲已满，暂停读本地
+        self.conn.local_transport.pause_reading()
+
+    def resume_writing(self):
+        self.conn.local_transport.resume_reading()
+
+
+class Connection(asyncio.Protocol):
+    '''
+    表示一个双向连接。本地套接字一侧由这个对象处理。
+
+    子类负责隧道建立阶段，以及每个方向上的加密或解密。
+    '''
+    # 初始状态
+    # 等待本地套接字发来请求头
+    S_INIT = 0
+
+    # 等待远程连接状态
+    # 暂停读本地，等待远程连接建立（服务器端包括DNS解析）
+    S_REMOTE_CONNECT = 1
+
+    # 连接已经建立状态
+    S_ESTABLISHED = 2
+
+    statemap = {
+        S_INIT: "S_INIT",
+        S_REMOTE_CONNECT: "S_REMOTE_CONNECT",
+        S_ESTABLISHED: "S_ESTABLISHED"
+    }
+
+    # 连接空闲超时和远程连接超时的秒数
+    TIMEOUT = 300
+    CONNECT_TIMEOUT = 10
+
+    count = 0
+
+    def __init__(self, cyptor_factory):
+        self.state = self.S_INIT
+        self.local_transport = None
+        self.local_addr = None
+        self.remote_transport = None
+
+        self.cryptor = cyptor_factory.new()
+
+        self.upstream_buffer = b''  # 从本地读，等待远程连接建立后写入
+
+        self.local_closed = False
+        self.remote_closed = False
+        self.destoryed = False
+        self.id = Connection.count
+        Connection.count = Connection.count + 1
+
+        self.last_active = 0
+        self.idle_handle = None
+
+    def connection_made(self, transport):
+        loop = asyncio.get_event_loop()
+        self.last_active = loop.time()
+        self.idle_handle = loop.call_later(self.TIMEOUT, self._on_idle_timeout)
+
+        self.local_transport = transport
+        self.local_addr = transport.get_extra_info('peername')
+        logging.debug("建立新的连接请求，本地{0}:{1}".format(
+            self.local_addr[0], self.local_addr[1]))
+
+    def data_received(self, data):
+        self.last_active = asyncio.get_event_loop().time()
+        try:
+            if self.state == self.S_ESTABLISHED:
+                self.remote_transport.write(self.encode_upstream(data))
+            elif self.state == self.S_INIT:
+                self.on_init_data(data)
+            else:
+                self.buffer_upstream(data)
+        except DecipherError:
+            logging.error("[{0}]解密失败，数据可能被篡改或者密码不一致".format(self.id))
+            self.destory()
+
+    def eof_received(self):
+        logging.info("[{0}]本地关闭连接".format(self.id))
+        self.local_closed = True
+        if self.state != self.S_ESTABLISHED or self.remote_closed:
+            self.destory()
+            return False
+        self.remote_transport.write_eof()
+        return True
+
+    def connection_lost(self, exc):
+        self.destory()
+
+    def pause_writing(self):
+        # 本地写缓冲已满，暂停读远程
+        if self.remote_transport:
+            self.remote_transport.pause_reading()
+
+    def resume_writing(self):
+        if self.remote_transport:
+            self.remote_transport.resume_reading()
+
+    def on_remote_data(self, data):
+        self.last_active = asyncio.get_event_loop().time()
+        try:
+            self.local_transport.write(self.encode_downstream(data))
+        except DecipherError:
+            logging.error("[{0}]解密失败，数据可能被篡改或者密码不一致".format(self.id))
+            self.destory()
+
+    def on_remote_eof(self):
+        logging.info("[{0}]远程服务器关闭连接".format(self.id))
+        self.remote_closed = True
+        if self.local_closed:
+            self.destory()
+            return False
+        self.local_transport.write_eof()
+        return True
+
+    def open_remote(self, host, port):
+        '''
+        非阻塞地连接远程地址。连接期间暂停读本地套接字。
+        '''
+        self.state = self.S_REMOTE_CONNECT
+        self.local_transport.pause_reading()
+        self.remote_addr = host, port
+
+        loop = asyncio.get_event_loop()
+        fut = asyncio.ensure_future(asyncio.wait_for(
+            loop.create_connection(lambda: RemoteProtocol(self), host, port),
+            self.CONNECT_TIMEOUT))
+        fut.add_done_callback(self._on_remote_connect)
+
+    def _on_remote_connect(self, fut):
+        try:
+            transport, _ = fut.result()
+        except (OSError, asyncio.TimeoutError) as e:
+            logging.info("[{0}]远程连接{1}:{2}失败: {3}".format(
+                self.id, self.remote_addr[0], self.remote_addr[1], e))
+            self.destory()
+            return
+
+        # 等待连接期间本地已经断开
+        if self.destoryed:
+            transport.close()
+            return
+
+        logging.info("[{0}]远程地址{1}:{2}连接成功...".format(
+            self.id, self.remote_addr[0], self.remote_addr[1]))
+        self.remote_transport = transport
+        self.on_remote_connected()
+        self.upstream_buffer = b''
+        self.state = self.S_ESTABLISHED
+        self.local_transport.resume_reading()
+
+    def _on_idle_timeout(self):
+        '''
+        空闲定时器到期。如果期间有过读写，就按剩余的时间重新设置定时器。
+        '''
+        loop = asyncio.get_event_loop()
+        idle = loop.time() - self.last_active
+        if idle >= self.TIMEOUT:
+            logging.info("[{0}]连接空闲超时".format(self.id))
+            self.destory()
+        else:
+            self.idle_handle = loop.call_later(self.TIMEOUT - idle,
+                                               self._on_idle_timeout)
+
+    def destory(self):
+        '''
+        销毁连接，关闭两侧的传输。已经写入缓冲的数据会在关闭前发送完。
+        '''
+        if self.destoryed:
+            return
+        self.destoryed = True
+        logging.info("[{0}]连接已被销毁".format(self.id))
+
+        if self.idle_handle:
+            self.idle_handle.cancel()
+        self.local_transport.close()
+        if self.remote_transport:
+            self.remote_transport.close()
+
+
+class ClientConnection(Connection):
+    '''
+    隧道客户端的连接：解析HTTP CONNECT请求，连接隧道服务器。
+    '''
+
+    def __init__(self, cyptor_factory, remote_addr):
+        super().__init__(cyptor_factory)
+        self.remote_addr = remote_addr  # 隧道服务器
+        self.dst_addr = None  # 远程服务器
+
+    def on_init_data(self, data):
+        self.upstream_buffer += data
+        if b'\r\n\r\n' not in self.upstream_buffer:
+            return
+
+        try:
+            self.dst_addr = parse_http(self.upstream_buffer)
+        except BadHttpHeader:
+            logging.error("[{0}]解析本地连接隧道请求失败：非HTTP头部".format(self.id))
+            self.destory()
+            return
+        except NoAcceptableMethods:
+            logging.error("[{0}]解析本地连接隧道头请求失败：不支持的HTTP请求方法".format(
+                self.id))
+            self.destory()
+            return
+
+        logging.info("[{0}]本地请求连接到 {1}:{2}".format(
+            self.id, to_str(self.dst_addr[0]), self.dst_addr[1]))
+        self.upstream_buffer = self.upstream_buffer.split(b'\r\n\r\n', 1)[1]
+        self.open_remote(*self.remote_addr)
+
+    def buffer_upstream(self, data):
+        self.upstream_buffer += data
+
+    def on_remote_connected(self):
+        # Shadow头和连接期间缓存的数据一起加密发送
+        shadow_head = make_shadow_head(self.dst_addr)
+        self.remote_transport.write(
+            self.cryptor.cipher(shadow_head + self.upstream_buffer))
+        self.local_transport.write(
+            b'HTTP/1.1 200 Connection Established\r\n\r\n')
+
+    def encode_upstream(self, data):
+        return self.cryptor.cipher(data)
+
+    def encode_downstream(self, data):
+        return self.cryptor.decipher(data)
+
+
+class ServerConnection(Connection):
+    '''
+    隧道服务器的连接：解析Shadow头，连接远程服务器。
+    '''
+
+    def on_init_data(self, data):
+        # 初始向量或者AEAD的数据块可能被拆分到几次读中，已经解密的数据先缓存，直到Shadow头完整
+        deciphered = self.cryptor.decipher(data)
+        if not deciphered:
+            return
+        self.upstream_buffer += deciphered
+        try:
+            length = shadow_head_length(self.upstream_buffer)
+            if length is None or len(self.upstream_buffer) < length:
+                return
+            host, port, head_length = parse_shadow_head(self.upstream_buffer)
+            host = to_str(host)
+        except Exception:
+            logging.error("[{0}]解析Shadow头失败".format(self.id))
+            self.destory()
+            return
+
+        self.upstream_buffer = self.upstream_buffer[head_length:]
+        self.open_remote(host, port)
+
+    def buffer_upstream(self, data):
+        # 缓冲区中保存的是已经解密的数据
+        self.upstream_buffer += self.cryptor.decipher(data)
+
+    def on_remote_connected(self):
+        if self.upstream_buffer:
+            self.remote_transport.write(self.upstream_buffer)
+
+    def encode_upstream(self, data):
+        return self.cryptor.decipher(data)
+
+    def encode_downstream(self, data):
+        return self.cryptor.cipher(data)
+
+
+def new_event_loop():
+    '''
+    创建事件循环。安装了uvloop时优先使用uvloop。
+    '''
+    if uvloop is not None:
+        return uvloop.new_event_loop()
+    return asyncio.new_event_loop()
+
+
+def serve(args, protocol_factory):
+    Connection.TIMEOUT = args.timeout
+    Connection.CONNECT_TIMEOUT = args.connect_timeout
+
+    loop = new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    sock = create_listener(args.local, reuse_port=args.workers > 1)
+    sock.setblocking(False)
+    server = loop.run_until_complete(
+        loop.create_server(protocol_factory, sock=sock))
+    logging.debug("asyncio引擎开始运行，事件循环: {0}".format(type(loop).__name__))
+
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        loop.close()
+
+
+def client_main(args):
+    server_addr = args.host, args.port
+    cyptor_factory = CyptorFactory(args.method, to_bytes(args.password))
+    serve(args, lambda: ClientConnection(cyptor_factory, server_addr))
+
+
+def server_main(args):
+    cyptor_factory = CyptorFactory(args.method, to_bytes(args.password))
+    serve(args, lambda: ServerConnection(cyptor_factory))
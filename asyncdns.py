@@ -14,13 +14,51 @@ import socket
 import struct
 import re
 import logging
+import time
 import lru_cache
 
-from selectors import EVENT_READ
+from selectors import EVENT_READ, EVENT_WRITE
 
-from common import is_ip, to_bytes, compat_ord, compat_chr
+from common import is_ip, to_bytes
 
-CACHE_SWEEP_INTERVAL = 30
+# 缓存每次清理的条目数有上限，所以可以频繁地清理
+CACHE_SWEEP_INTERVAL = 1
+
+# 一次DNS查询最长的等待时间（包括重传），超时后通知所有等待的回调解析失败
+QUERY_TIMEOUT = 5
+
+# 第一次重传前等待的秒数，之后每次加倍。每次重传发给还没有试过的、最快的服务器
+RETRY_TIMEOUT = 0.5
+RETRIES = 3
+
+# 先得到A地址时，最多再等待AAAA地址的秒数（RFC 8305建议50毫秒）。先得到AAAA地址时不等待
+RESOLUTION_DELAY = 0.05
+
+# 解析结果的缓存时间（秒）。回答中的TTL会被限制在MIN_TTL和MAX_TTL之间
+MIN_TTL = 10
+MAX_TTL = 3600
+
+# 否定回答（域名不存在或者没有地址）缓存时间的上限。回答中没有SOA记录时也使用这个值
+NEGATIVE_TTL = 60
+
+# 服务器失败（SERVFAIL）的缓存时间，rfc2308要求不超过5分钟
+SERVFAIL_TTL = 5
+
+# 提前刷新：缓存条目在这次TTL内被访问了PREFETCH_HITS次以上，并且剩余的时间
+# 不到TTL的PREFETCH_FRACTION时，在后台重新查询。查询期间继续使用原来的结果
+PREFETCH_FRACTION = 0.1
+PREFETCH_HITS = 3
+
+DNS_PORT = 53
+
+# EDNS0（rfc6891）中声明的UDP回应的最大长度。1232字节在常见的链路上不会分片
+EDNS_PAYLOAD_SIZE = 1232
+
+# 接收UDP和TCP回应的缓冲区大小，DNS消息最长65535字节
+RECV_BUFFER_SIZE = 65535
+
+# UDP套接字的接收缓冲区大小，内核会限制在net.core.rmem_max以内
+UDP_RECV_BUFFER = 1024 * 1024
 
 VALID_HOSTNAME = re.compile(br"(?!-)[A-Z\d\-_]{1,63}(?<!-)$", re.IGNORECASE)
 
@@ -61,8 +99,14 @@ QTYPE_A = 1
 QTYPE_AAAA = 28
 QTYPE_CNAME = 5
 QTYPE_NS = 2
+QTYPE_SOA = 6
+QTYPE_OPT = 41
 QCLASS_IN = 1
 
+RCODE_FORMERR = 1
+RCODE_SERVFAIL = 2
+RCODE_NXDOMAIN = 3
+
 
 def build_address(address):
     address = address.strip(b'.')
@@ -78,44 +122,65 @@ def build_address(address):
     return b''.join(results)
 
 
-def build_request(address, qtype):
+def build_request(address, qtype, payload_size=EDNS_PAYLOAD_SIZE):
     request_id = os.urandom(2)
-    header = struct.pack('!BBHHHH', 1, 0, 1, 0, 0, 0)
+    header = struct.pack('!BBHHHH', 1, 0, 1, 0, 0, 1 if payload_size else 0)
     addr = build_address(address)
     qtype_qclass = struct.pack('!HH', qtype, QCLASS_IN)
-    return request_id + header + addr + qtype_qclass
+    opt = b''
+    if payload_size:
+        # EDNS0的OPT记录：名字为根，CLASS字段是能接收的UDP回应的最大长度
+        opt = b'\0' + struct.pack('!HHIH', QTYPE_OPT, payload_size, 0, 0)
+    return request_id + header + addr + qtype_qclass + opt
 
 
-def parse_ip(addrtype, data, length, offset):
-    if addrtype == QTYPE_A:
-        return socket.inet_ntop(socket.AF_INET, data[offset:offset + length])
-    elif addrtype == QTYPE_AAAA:
-        return socket.inet_ntop(socket.AF_INET6, data[offset:offset + length])
-    elif addrtype in [QTYPE_CNAME, QTYPE_NS]:
-        return parse_name(data, offset)[1]
-    else:
-        return data[offset:offset + length]
+# 解析一个域名时最多跟随的压缩指针数。域名最长255字节，正常的回应不会超过这个数，
+# 超过时认为指针形成了环
+MAX_POINTER_JUMPS = 128
 
 
 def parse_name(data, offset):
+    '''
+    解析offset处的域名，返回(域名在offset处占用的字节数, 域名)。
+
+    data可以是bytes或者memoryview。压缩指针用循环处理，不会递归。
+    '''
     p = offset
     labels = []
-    l = compat_ord(data[p])
-    while l > 0:
-        if (l & (128 + 64)) == (128 + 64):
+    length = None  # 遇到第一个指针时，域名在原位置占用的长度就确定了
+    jumps = 0
+    while True:
+        l = data[p]
+        if l & 0xC0 == 0xC0:
             # pointer
-            pointer = struct.unpack('!H', data[p:p + 2])[0]
-            pointer &= 0x3FFF
-            r = parse_name(data, pointer)
-            labels.append(r[1])
-            p += 2
-            # pointer is the end
-            return p - offset, b'.'.join(labels)
+            if length is None:
+                length = p + 2 - offset
+            jumps += 1
+            if jumps > MAX_POINTER_JUMPS:
+                raise ValueError('compression pointer loop at %d' % offset)
+            p = ((l & 0x3F) << 8) | data[p + 1]
+        elif l == 0:
+            break
         else:
             labels.append(data[p + 1:p + 1 + l])
             p += 1 + l
-        l = compat_ord(data[p])
-    return p - offset + 1, b'.'.join(labels)
+    if length is None:
+        length = p + 1 - offset
+    return length, b'.'.join(labels)
+
+
+def skip_name(data, offset):
+    '''
+    返回offset处的域名占用的字节数，不解析域名的内容。
+    '''
+    p = offset
+    while True:
+        l = data[p]
+        if l & 0xC0 == 0xC0:
+            return p + 2 - offset
+        if l == 0:
+            return p + 1 - offset
+        p += 1 + l
 
 
 # DNS 回应格式
@@ -141,30 +206,17 @@ def parse_name(data, offset):
 #    /                     RDATA                     /
 #    /                                               /
 #    +--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+
-def parse_record(data, offset, question=False):
-    nlen, name = parse_name(data, offset)
-    if not question:
-        record_type, record_class, record_ttl, record_rdlength = struct.unpack(
-            '!HHiH', data[offset + nlen:offset + nlen + 10])
-        ip = parse_ip(record_type, data, record_rdlength, offset + nlen + 10)
-        return nlen + 10 + record_rdlength, \
-            (name, ip, record_type, record_class, record_ttl)
-    else:
-        record_type, record_class = struct.unpack(
-            '!HH', data[offset + nlen:offset + nlen + 4])
-        return nlen + 4, (name, None, record_type, record_class, None, None)
+RECORD = struct.Struct('!HHiH')
 
 
 def parse_header(data):
     if len(data) >= 12:
-        header = struct.unpack('!HBBHHHH', data[:12])
+        header = struct.unpack_from('!HBBHHHH', data)
         res_id = header[0]
         res_qr = header[1] & 128
         res_tc = header[1] & 2
         res_ra = header[2] & 128
         res_rcode = header[2] & 15
-        # assert res_tc == 0
-        # assert res_rcode in [0, 3]
         res_qdcount = header[3]
         res_ancount = header[4]
         res_nscount = header[5]
@@ -175,43 +227,72 @@ def parse_header(data):
 
 
 def parse_response(data):
+    '''
+    解析DNS回应。
+
+    只解析解析器需要的部分：第一个问题的域名，回答部分中的A、AAAA和CNAME记录，
+    没有地址时权威部分中的SOA记录。其他记录和附加部分直接跳过。
+    通过memoryview读取，除了域名和地址之外不复制数据。
+    '''
     try:
-        if len(data) >= 12:
-            header = parse_header(data)
-            if not header:
-                return None
-            res_id, res_qr, res_tc, res_ra, res_rcode, res_qdcount, \
-                res_ancount, res_nscount, res_arcount = header
-
-            qds = []
-            ans = []
-            offset = 12
-            for _ in range(0, res_qdcount):
-                l, r = parse_record(data, offset, True)
-                offset += l
-                if r:
-                    qds.append(r)
-            for i in range(0, res_ancount):
-                l, r = parse_record(data, offset)
-                offset += l
-                if r:
-                    ans.append(r)
-            for i in range(0, res_nscount):
-                l, r = parse_record(data, offset)
-                offset += l
-            for i in range(0, res_arcount):
-                l, r = parse_record(data, offset)
-                offset += l
-            response = DNSResponse()
-            if qds:
-                response.hostname = qds[0][0]
-            for an in qds:
-                response.questions.append((an[1], an[2], an[3]))
-            for an in ans:
-                response.answers.append((an[1], an[2], an[3]))
-            return response
+        header = parse_header(data)
+        if not header:
+            return None
+        res_id, res_qr, res_tc, res_ra, res_rcode, res_qdcount, \
+            res_ancount, res_nscount, res_arcount = header
+
+        view = memoryview(data)
+        response = DNSResponse()
+        response.id = res_id
+        response.tc = bool(res_tc)
+        response.rcode = res_rcode
+        offset = 12
+        for i in range(res_qdcount):
+            if i == 0:
+                nlen, response.hostname = parse_name(view, offset)
+            else:
+                nlen = skip_name(view, offset)
+            qtype, qclass = struct.unpack_from('!HH', view, offset + nlen)
+            response.questions.append((None, qtype, qclass))
+            offset += nlen + 4
+
+        has_address = False
+        for _ in range(res_ancount):
+            offset += skip_name(view, offset)
+            rtype, rclass, ttl, rdlength = RECORD.unpack_from(view, offset)
+            offset += RECORD.size
+            if rtype == QTYPE_A and rdlength == 4:
+                addr = socket.inet_ntop(socket.AF_INET,
+                                        view[offset:offset + 4])
+                has_address = True
+            elif rtype == QTYPE_AAAA and rdlength == 16:
+                addr = socket.inet_ntop(socket.AF_INET6,
+                                        view[offset:offset + 16])
+                has_address = True
+            elif rtype == QTYPE_CNAME:
+                addr = parse_name(view, offset)[1]
+            else:
+                addr = None
+            if addr is not None:
+                response.answers.append((addr, rtype, rclass, ttl))
+            offset += rdlength
+
+        if not has_address:
+            for _ in range(res_nscount):
+                offset += skip_name(view, offset)
+                rtype, rclass, ttl, rdlength = RECORD.unpack_from(view, offset)
+                offset += RECORD.size
+                if rtype == QTYPE_SOA and rdlength >= 4:
+                    # rfc2308: 否定回答的缓存时间取SOA记录的TTL和MINIMUM中较小的一个
+                    minimum = struct.unpack_from(
+                        '!I', view, offset + rdlength - 4)[0]
+                    response.negative_ttl = min(ttl, minimum)
+                    break
+                offset += rdlength
+        return response
+    # 任何人都可以向解析器的端口发送伪造的回应，不写堆栈，避免刷屏
     except Exception as e:
-        logging.exception(e)
+        logging.debug('[DNS]解析DNS回应出错: %s', e)
         return None
 
 
@@ -225,26 +306,90 @@ def is_valid_hostname(hostname):
 
 class DNSResponse(object):
     def __init__(self):
+        self.id = None
         self.hostname = None
+        self.tc = False
+        self.rcode = 0
+        self.negative_ttl = None  # 来自权威部分的SOA记录
         self.questions = []  # each: (addr, type, class)
-        self.answers = []  # each: (addr, type, class)
+        self.answers = []  # each: (addr, type, class, ttl)
 
     def __str__(self):
         return '%s: %s' % (self.hostname, str(self.answers))
 
 
-STATUS_FIRST = 0
-STATUS_SECOND = 1
+def interleave_addresses(ipv6, ipv4):
+    '''
+    按RFC 8305交替排列两种地址，IPv6地址在前。连接失败时下一次尝试会换一种地址。
+    '''
+    addrs = []
+    for i in range(max(len(ipv6), len(ipv4))):
+        addrs.extend(ipv6[i:i + 1])
+        addrs.extend(ipv4[i:i + 1])
+    return addrs
+
+
+class DNSQuery(object):
+    '''
+    正在进行的一次查询。同一个请求按退避的间隔重传，每次只发给一个服务器。
+    '''
+
+    def __init__(self, hostname, qtype, deadline):
+        self.hostname = hostname
+        self.qtype = qtype
+        self.deadline = deadline
+        self.attempts = 0
+        self.server = None  # 最近一次发送的服务器
+        self.sent = {}  # server -> 发送时间，重传给同一个服务器时为None
+        self.timer = None
+        self.build(EDNS_PAYLOAD_SIZE)
+
+        # UDP回应被截断时改用TCP查询。TCP失败时使用截断的回应
+        self.tcp_sock = None
+        self.tcp_out = b''
+        self.tcp_in = bytearray()
+        self.truncated = None
+
+    def build(self, payload_size):
+        self.edns = bool(payload_size)
+        self.request = build_request(self.hostname, self.qtype, payload_size)
+        self.request_id = struct.unpack('!H', self.request[:2])[0]
 
 
 class DNSResolver(object):
-    def __init__(self, server_list=None):
-        # self._loop = None
+    '''
+    异步DNS解析器。同时查询A和AAAA记录，解析结果是按RFC 8305排列的地址列表。
+    '''
+
+    def __init__(self, server_list=None, timeout=QUERY_TIMEOUT,
+                 port=DNS_PORT,
+                 min_ttl=MIN_TTL, max_ttl=MAX_TTL, negative_ttl=NEGATIVE_TTL,
+                 retries=RETRIES, retry_timeout=RETRY_TIMEOUT,
+                 prefetch_fraction=PREFETCH_FRACTION,
+                 prefetch_hits=PREFETCH_HITS):
+        self._selector = None
+        self._timers = None
+        self._timeout = timeout
+        self._port = port
+        self._retries = retries
+        self._retry_timeout = retry_timeout
         self._hosts = {}
-        self._hostname_status = {}
         self._hostname_to_cb = {}
         self._cb_to_hostname = {}
-        self._cache = lru_cache.LRUCache(timeout=300)
+        # hostname -> {qtype: (地址列表, ttl, error)}，保存已经结束的查询的结果
+        self._hostname_to_results = {}
+        # hostname -> 等待另一种地址的定时器
+        self._hostname_to_timer = {}
+        self._queries = {}  # (hostname, qtype) -> DNSQuery
+        # hostname -> [地址列表, 过期时间, ttl, 访问次数]，地址列表为None表示否定回答
+        self._cache = lru_cache.LRUCache()
+        self.set_ttl_limits(min_ttl, max_ttl, negative_ttl)
+        # prefetch_fraction为0时不提前刷新
+        self.prefetch_fraction = prefetch_fraction
+        self.prefetch_hits = prefetch_hits
+        # 域名在hosts或者缓存中找到和需要查询的次数，IP地址不计算在内
+        self.cache_hits = 0
+        self.cache_misses = 0
         self._sock = None
         if server_list is None:
             self._servers = None
@@ -252,6 +397,10 @@ class DNSResolver(object):
         else:
             self._servers = server_list
 
+        # 每个服务器平滑后的响应时间。没有回应的服务器会被加倍惩罚，
+        # 所以挑选服务器时会优先使用又快又可靠的服务器
+        self._srtt = dict((server, 0) for server in self._servers)
+
         self._QTYPES = [QTYPE_A, QTYPE_AAAA]
         self._parse_hosts()
 
@@ -302,59 +451,376 @@ class DNSResolver(object):
         except IOError:
             self._hosts['localhost'] = '127.0.0.1'
 
-    def add_to_loop(self, selector):
+    def set_ttl_limits(self, min_ttl, max_ttl, negative_ttl):
+        '''
+        设置缓存时间的范围。negative_ttl为0时不缓存否定回答。
+        '''
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        # 超过最长缓存时间没有访问的条目一定已经过期，由sweep清理
+        self._cache.timeout = max(max_ttl, negative_ttl, SERVFAIL_TTL)
+
+    def add_to_loop(self, selector, timers):
         self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
                                    socket.SOL_UDP)
         self._sock.setblocking(False)
+        # 大量连接同时解析时回应会成批到达，默认的接收缓冲区放不下时内核会丢弃回应，只能等重传
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                              UDP_RECV_BUFFER)
 
         def _dns_on_read(key, mask):
-            data, addr = self._sock.recvfrom(1024)
-            if addr[0] not in self._servers:
-                logging.warn('[DNS]收到非本地请求包')
-                return
-            self._handle_data(data)
+            # 一次读完所有已经到达的回应
+            while self._sock:
+                try:
+                    data, addr = self._sock.recvfrom(RECV_BUFFER_SIZE)
+                except (BlockingIOError, InterruptedError):
+                    return
+                if addr[0] not in self._servers:
+                    logging.warn('[DNS]收到非本地请求包')
+                    continue
+                self._handle_data(data, addr[0])
 
         selector.register(self._sock, EVENT_READ, _dns_on_read)
+        self._selector = selector
+        self._timers = timers
+        timers.call_periodic(CACHE_SWEEP_INTERVAL, self.handle_periodic)
 
-    def _call_callback(self, hostname, ip, error=None):
+    def _call_callback(self, hostname, addrs, error=None):
         callbacks = self._hostname_to_cb.get(hostname, [])
         for callback in callbacks:
             if callback in self._cb_to_hostname:
                 del self._cb_to_hostname[callback]
-            if ip or error:
-                callback((hostname, ip), error)
+            if addrs or error:
+                callback((hostname, addrs), error)
             else:
                 callback((hostname, None),
                          Exception('unknown hostname %s' % hostname))
+        self._cleanup(hostname)
+
+    def _call_waiting(self, hostname, addrs):
+        '''
+        把addrs交给正在等待的回调，但是不结束解析。之后的resolve仍然等待解析完成。
+        '''
+        callbacks = self._hostname_to_cb.get(hostname)
+        if not callbacks:
+            return
+        self._hostname_to_cb[hostname] = []
+        for callback in callbacks:
+            self._cb_to_hostname.pop(callback, None)
+            callback((hostname, addrs), None)
+
+    def _cleanup(self, hostname):
+        '''
+        结束一个域名的解析：取消还在进行的查询和定时器。
+        '''
         if hostname in self._hostname_to_cb:
             del self._hostname_to_cb[hostname]
-        if hostname in self._hostname_status:
-            del self._hostname_status[hostname]
+        self._hostname_to_results.pop(hostname, None)
+        timer = self._hostname_to_timer.pop(hostname, None)
+        if timer:
+            timer.cancel()
+        for qtype in self._QTYPES:
+            self._finish_query(hostname, qtype)
+
+    def _finish_query(self, hostname, qtype):
+        query = self._queries.pop((hostname, qtype), None)
+        if query:
+            if query.timer:
+                query.timer.cancel()
+            self._close_tcp(query)
+
+    def _start_query(self, hostname, qtype):
+        query = DNSQuery(hostname, qtype, time.monotonic() + self._timeout)
+        self._queries[(hostname, qtype)] = query
+        self._send_query(query)
+
+    def _pick_server(self, query):
+        '''
+        选择响应最快的、这次查询还没有试过的服务器。都试过时从所有服务器中选。
+        '''
+        servers = [server for server in self._servers
+                   if server not in query.sent] or self._servers
+        return min(servers, key=lambda server: self._srtt.get(server, 0))
+
+    def _send_query(self, query):
+        server = self._pick_server(query)
+        now = time.monotonic()
+        # 重传给同一个服务器时无法判断回应对应哪一次发送，不用来估计响应时间
+        query.sent[server] = None if server in query.sent else now
+        query.server = server
+        query.attempts += 1
+        logging.debug('[DNS] 解析域名 %s, 类型 %d, 服务器: %s, 第%d次',
+                      query.hostname, query.qtype, server, query.attempts)
+        try:
+            self._sock.sendto(query.request, (server, self._port))
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError as e:
+            logging.warning('[DNS]向服务器 %s 发送请求失败: %s', server, e)
+
+        if self._timers is not None:
+            delay = self._retry_timeout * 2 ** (query.attempts - 1)
+            delay = max(0, min(delay, query.deadline - now))
+            query.timer = self._timers.call_later(delay, self._on_retry,
+                                                  query.hostname, query.qtype)
+
+    def _on_retry(self, hostname, qtype):
+        '''
+        等待回应超时。惩罚没有回应的服务器，然后重传或者放弃。
+        '''
+        query = self._queries[(hostname, qtype)]
+        query.timer = None
+        if query.tcp_sock:
+            logging.warning('[DNS]TCP查询 %s 超时', hostname)
+            self._on_tcp_failed(query)
+            return
+        srtt = self._srtt.get(query.server, 0)
+        self._srtt[query.server] = min(max(srtt * 2, self._retry_timeout),
+                                       self._timeout)
+        if query.attempts > self._retries or \
+                time.monotonic() >= query.deadline:
+            logging.warning('[DNS]解析域名 %s 超时, 类型 %d', hostname, qtype)
+            self._finish_query(hostname, qtype)
+            self._on_query_done(hostname, qtype, [], None,
+                                Exception('timeout resolving %s' % hostname))
+        else:
+            self._send_query(query)
+
+    def _start_tcp(self, query, server, truncated):
+        '''
+        UDP回应被截断，用TCP向同一个服务器重新查询。TCP套接字注册在同一个selector上。
+        '''
+        if query.timer:
+            query.timer.cancel()
+        query.truncated = truncated
+        query.server = server
+        query.tcp_out = struct.pack('!H', len(query.request)) + query.request
+        query.tcp_in = bytearray()
+        sock = socket.socket(is_ip(server), socket.SOCK_STREAM)
+        sock.setblocking(False)
+        query.tcp_sock = sock
+        logging.debug('[DNS]回应被截断，使用TCP解析域名 %s, 服务器: %s',
+                      query.hostname, server)
 
-    def _handle_data(self, data):
+        def _dns_on_tcp_event(key, mask):
+            try:
+                if query.tcp_out:
+                    n = sock.send(query.tcp_out)
+                    query.tcp_out = query.tcp_out[n:]
+                    if not query.tcp_out:
+                        self._selector.modify(sock, EVENT_READ,
+                                              _dns_on_tcp_event)
+                    return
+                data = sock.recv(RECV_BUFFER_SIZE)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logging.warning('[DNS]TCP查询 %s 失败: %s', query.hostname, e)
+                self._on_tcp_failed(query)
+                return
+            if not data:
+                logging.warning('[DNS]TCP查询 %s 失败: 连接被关闭', query.hostname)
+                self._on_tcp_failed(query)
+                return
+
+            query.tcp_in += data
+            if len(query.tcp_in) < 2:
+                return
+            length = struct.unpack('!H', query.tcp_in[:2])[0]
+            if len(query.tcp_in) < 2 + length:
+                return
+            response = bytes(query.tcp_in[2:2 + length])
+            self._close_tcp(query)
+            self._handle_data(response, server, tcp=True)
+
+        try:
+            sock.connect((server, self._port))
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError as e:
+            logging.warning('[DNS]TCP查询 %s 失败: %s', query.hostname, e)
+            self._on_tcp_failed(query)
+            return
+        self._selector.register(sock, EVENT_WRITE, _dns_on_tcp_event)
+        query.timer = self._timers.call_later(
+            max(0, query.deadline - time.monotonic()), self._on_retry,
+            query.hostname, query.qtype)
+
+    def _close_tcp(self, query):
+        if query.tcp_sock:
+            try:
+                self._selector.unregister(query.tcp_sock)
+            except KeyError:
+                pass
+            query.tcp_sock.close()
+            query.tcp_sock = None
+
+    def _on_tcp_failed(self, query):
+        '''
+        TCP查询失败或者超时，使用截断的UDP回应。
+        '''
+        if query.timer:
+            query.timer.cancel()
+            query.timer = None
+        self._close_tcp(query)
+        self._handle_data(query.truncated, query.server, tcp=True)
+
+    def _update_srtt(self, query, server):
+        sent = query.sent.get(server)
+        if sent is None:
+            return
+        rtt = time.monotonic() - sent
+        srtt = self._srtt.get(server, 0)
+        self._srtt[server] = rtt if not srtt else srtt * 7 / 8 + rtt / 8
+
+    def _cache_answer(self, hostname, addrs, ttl):
+        '''
+        缓存解析结果，addrs为None时缓存否定回答。
+        '''
+        if addrs:
+            ttl = max(self.min_ttl, min(ttl, self.max_ttl))
+        elif ttl is None:
+            ttl = self.negative_ttl
+        else:
+            ttl = min(ttl, self.negative_ttl)
+        if ttl <= 0:
+            return
+        now = time.monotonic()
+        if not addrs:
+            # 刷新失败时继续使用还没有过期的结果
+            entry = self._cache.get(hostname)
+            if entry and entry[0] and entry[1] > now:
+                return
+        self._cache[hostname] = [addrs, now + ttl, ttl, 0]
+
+    def _lookup_cache(self, hostname):
+        '''
+        返回缓存的条目，没有缓存或者已经过期时返回None。
+
+        经常访问的条目快要过期时，在后台重新查询。
+        '''
+        entry = self._cache.get(hostname)
+        if entry is None:
+            return None
+        now = time.monotonic()
+        if entry[1] <= now:
+            del self._cache[hostname]
+            return None
+
+        entry[3] += 1
+        if entry[0] and entry[3] >= self.prefetch_hits and \
+                entry[1] - now < entry[2] * self.prefetch_fraction and \
+                hostname not in self._hostname_to_results:
+            logging.debug('[DNS]提前刷新: %s', hostname)
+            self._start_resolution(hostname)
+        return entry
+
+    def _handle_data(self, data, server=None, tcp=False):
+        '''
+        处理DNS回应。tcp为True表示回应来自TCP查询，或者是TCP失败后使用的截断回应。
+        '''
         response = parse_response(data)
-        if response and response.hostname:
-            hostname = response.hostname
-            ip = None
-            for answer in response.answers:
-                if answer[1] in (QTYPE_A, QTYPE_AAAA) and \
-                        answer[2] == QCLASS_IN:
-                    ip = answer[0]
-                    break
-            if not ip and self._hostname_status.get(hostname, STATUS_SECOND) \
-                    == STATUS_FIRST:
-                self._hostname_status[hostname] = STATUS_SECOND
-                self._send_req(hostname, self._QTYPES[1])
+        if not (response and response.hostname and response.questions):
+            return
+        hostname = response.hostname
+        qtype = response.questions[0][1]
+        query = self._queries.get((hostname, qtype))
+        if query is None or response.id != query.request_id:
+            # 查询已经结束，或者不是对当前请求的回应
+            return
+        if not tcp:
+            if query.tcp_sock:
+                # 已经在用TCP查询，只接受没有截断的UDP回应
+                if response.tc:
+                    return
             else:
-                if ip:
-                    self._cache[hostname] = ip
-                    self._call_callback(hostname, ip)
-                elif self._hostname_status.get(hostname, None) \
-                        == STATUS_SECOND:
-                    for question in response.questions:
-                        if question[1] == self._QTYPES[1]:
-                            self._call_callback(hostname, None)
-                            break
+                self._update_srtt(query, server)
+                if response.tc and self._selector is not None:
+                    self._start_tcp(query, server, data)
+                    return
+
+        if response.rcode == RCODE_FORMERR and query.edns:
+            # 不支持EDNS0的服务器，去掉OPT记录重新查询
+            logging.debug('[DNS]服务器 %s 不支持EDNS0', server)
+            if query.timer:
+                query.timer.cancel()
+            query.build(0)
+            self._send_query(query)
+            return
+
+        if response.rcode == RCODE_SERVFAIL and \
+                len(query.sent) < len(self._servers):
+            # 换一个服务器重试
+            if query.timer:
+                query.timer.cancel()
+            self._send_query(query)
+            return
+        self._finish_query(hostname, qtype)
+
+        addrs = [answer[0] for answer in response.answers
+                 if answer[1] == qtype and answer[2] == QCLASS_IN]
+        if response.tc and not addrs:
+            # TCP查询失败，截断的回应中也没有地址，不能当作否定回答缓存
+            self._on_query_done(hostname, qtype, [], None, Exception(
+                'truncated response for %s' % hostname))
+            return
+        if addrs:
+            # CNAME链中任何一条记录过期，整个回答就过期了
+            ttl = min(answer[3] for answer in response.answers)
+        elif response.rcode == RCODE_SERVFAIL:
+            ttl = SERVFAIL_TTL
+        else:
+            ttl = response.negative_ttl
+
+        if response.rcode == RCODE_NXDOMAIN:
+            # 域名不存在，不需要等另一种地址
+            self._cache_answer(hostname, None, ttl)
+            self._call_callback(hostname, None)
+        else:
+            self._on_query_done(hostname, qtype, addrs, ttl)
+
+    def _on_query_done(self, hostname, qtype, addrs, ttl, error=None):
+        results = self._hostname_to_results.get(hostname)
+        if results is None:
+            return
+        results[qtype] = (addrs, ttl, error)
+        if len(results) == len(self._QTYPES):
+            self._finish_resolution(hostname)
+        elif addrs and qtype == QTYPE_AAAA:
+            # RFC 8305: 先得到IPv6地址时立刻开始连接。A查询继续进行，
+            # 完成后两种地址一起缓存，供之后的连接使用
+            self._call_waiting(hostname, addrs)
+        elif addrs and self._timers is not None and \
+                hostname not in self._hostname_to_timer:
+            # RFC 8305: 先得到IPv4地址时，最多再等RESOLUTION_DELAY秒，
+            # 不让AAAA查询缓慢拖慢整个连接
+            self._hostname_to_timer[hostname] = self._timers.call_later(
+                RESOLUTION_DELAY, self._finish_resolution, hostname)
+
+    def _finish_resolution(self, hostname):
+        timer = self._hostname_to_timer.pop(hostname, None)
+        if timer:
+            timer.cancel()
+        results = self._hostname_to_results[hostname]
+        empty = ([], None, None)
+        addrs = interleave_addresses(results.get(QTYPE_AAAA, empty)[0],
+                                     results.get(QTYPE_A, empty)[0])
+        if addrs:
+            ttl = min(r[1] for r in results.values() if r[0])
+            self._cache_answer(hostname, addrs, ttl)
+            self._call_callback(hostname, addrs)
+            return
+
+        errors = [r[2] for r in results.values() if r[2]]
+        if len(errors) == len(results):
+            # 全部超时，不缓存
+            self._call_callback(hostname, None, errors[0])
+            return
+        if not errors:
+            ttls = [r[1] for r in results.values() if r[1] is not None]
+            self._cache_answer(hostname, None, min(ttls) if ttls else None)
+        self._call_callback(hostname, None)
 
     def handle_periodic(self):
         self._cache.sweep()
@@ -367,59 +833,362 @@ class DNSResolver(object):
             if arr:
                 arr.remove(callback)
                 if not arr:
-                    del self._hostname_to_cb[hostname]
-                    if hostname in self._hostname_status:
-                        del self._hostname_status[hostname]
-
-    def _send_req(self, hostname, qtype):
-        req = build_request(hostname, qtype)
-        for server in self._servers:
-            logging.debug('[DNS] 解析域名 %s, 类型 %d, 服务器: %s', hostname, qtype,
-                          server)
-            self._sock.sendto(req, (server, 53))
+                    self._cleanup(hostname)
 
     def resolve(self, hostname, callback):
+        '''
+        解析域名，完成时调用callback((hostname, 地址列表), error)。
+
+        地址列表中IPv6和IPv4地址交替排列，应该按顺序尝试连接。
+        '''
         if type(hostname) != bytes:
             hostname = hostname.encode('utf8')
         if not hostname:
             callback(None, Exception('empty hostname'))
         elif is_ip(hostname):
-            callback((hostname, hostname), None)
+            callback((hostname, [hostname]), None)
         elif hostname in self._hosts:
             logging.debug('[DNS]命中缓存: %s', hostname)
+            self.cache_hits += 1
             ip = self._hosts[hostname]
-            callback((hostname, ip), None)
-        elif hostname in self._cache:
+            callback((hostname, [ip]), None)
+        elif self._lookup_cache(hostname):
             logging.debug('[DNS]命中缓存: %s', hostname)
-            ip = self._cache[hostname]
-            callback((hostname, ip), None)
+            self.cache_hits += 1
+            addrs = self._cache[hostname][0]
+            if addrs:
+                callback((hostname, addrs), None)
+            else:
+                callback((hostname, None),
+                         Exception('unknown hostname %s' % hostname))
         else:
             if not is_valid_hostname(hostname):
                 callback(None, Exception('invalid hostname: %s' % hostname))
                 return
-            arr = self._hostname_to_cb.get(hostname, None)
-            if not arr:
-                self._hostname_status[hostname] = STATUS_FIRST
-                self._send_req(hostname, self._QTYPES[0])
-                self._hostname_to_cb[hostname] = [callback]
+            self.cache_misses += 1
+            if hostname in self._hostname_to_results:
+                # 已经有同一个域名的查询（也可能是后台刷新）在进行，由它负责重传
+                self._hostname_to_cb.setdefault(hostname, []).append(callback)
                 self._cb_to_hostname[callback] = hostname
             else:
-                arr.append(callback)
-                # TODO send again only if waited too long
-                self._send_req(hostname, self._QTYPES[0])
+                self._hostname_to_cb[hostname] = [callback]
+                self._cb_to_hostname[callback] = hostname
+                self._start_resolution(hostname)
+
+    def _start_resolution(self, hostname):
+        self._hostname_to_results[hostname] = {}
+        # 同时查询A和AAAA记录
+        for qtype in self._QTYPES:
+            self._start_query(hostname, qtype)
+
+    def close(self):
+        if self._sock:
+            self._sock.close()
+            self._sock = None
+
+
+def _build_response(request, rcode=0, answers=(), soa=None, tc=False):
+    '''
+    根据请求构造回应，用于测试。answers的每一项是(类型, rdata, ttl)，soa是(ttl, minimum)。
+    '''
+    header = struct.pack('!2sBBHHHH', request[:2], 0x83 if tc else 0x81,
+                         0x80 | rcode, 1, len(answers), 1 if soa else 0, 0)
+    question = request[12:12 + parse_name(request, 12)[0] + 4]
+    records = [struct.pack('!HHHiH', 0xC00C, qtype, QCLASS_IN, ttl,
+                           len(rdata)) + rdata
+               for qtype, rdata, ttl in answers]
+    if soa:
+        rdata = b'\0\0' + struct.pack('!IIIII', 1, 0, 0, 0, soa[1])
+        records.append(struct.pack('!HHHiH', 0xC00C, QTYPE_SOA, QCLASS_IN,
+                                   soa[0], len(rdata)) + rdata)
+    return header + question + b''.join(records)
+
 
-    # def close(self):
-    #     if self._sock:
-    #         if self._loop:
-    #             self._loop.remove_periodic(self.handle_periodic)
-    #             self._loop.remove(self._sock)
-    #         self._sock.close()
-    #         self._sock = None
+class _FakeSocket(object):
+    '''
+    记录发出的请求，用于测试。
+    '''
+
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, addr):
+        self.sent.append((data, addr))
 
 
 def test():
-    pass
+    # 压缩指针：CNAME的目标名字引用了问题中的后缀，A记录的名字引用了CNAME的目标
+    data = struct.pack('!HBBHHHH', 1, 0x81, 0x80, 1, 2, 0, 3) + \
+        b'\3www\7example\3com\0' + struct.pack('!HH', QTYPE_A, QCLASS_IN) + \
+        struct.pack('!HHHiH', 0xC00C, QTYPE_CNAME, QCLASS_IN, 300, 6) + \
+        b'\3cdn\xC0\x10' + \
+        struct.pack('!HHHiH', 0xC02D, QTYPE_A, QCLASS_IN, 20, 4) + \
+        socket.inet_aton('1.2.3.4')
+    assert parse_name(data, 45) == (6, b'cdn.example.com')
+    # 附加部分不会被解析，即使是不完整的数据
+    response = parse_response(data)
+    assert response.hostname == b'www.example.com'
+    assert response.questions == [(None, QTYPE_A, QCLASS_IN)]
+    assert response.answers == [
+        (b'cdn.example.com', QTYPE_CNAME, QCLASS_IN, 300),
+        ('1.2.3.4', QTYPE_A, QCLASS_IN, 20)]
+
+    # 指向自己的压缩指针
+    loop = data[:12] + b'\xC0\x0C'
+    try:
+        parse_name(loop, 12)
+        assert False
+    except ValueError:
+        pass
+
+    assert interleave_addresses(['::1', '::2'], ['1', '2', '3']) == \
+        ['::1', '1', '::2', '2', '3']
+
+    resolver = DNSResolver(server_list=['127.0.0.1'], min_ttl=1, max_ttl=100,
+                           negative_ttl=50)
+    sock = resolver._sock = _FakeSocket()
+    results = []
+
+    def callback(result, error):
+        results.append((result, error))
+
+    def requests():
+        # 取出发出的请求，按查询类型返回
+        reqs = dict((parse_response(data).questions[0][1], data)
+                    for data, _ in sock.sent)
+        del sock.sent[:]
+        return reqs
+
+    def ttl_of(hostname):
+        return resolver._cache[hostname][1] - time.monotonic()
+
+    ipv4 = [(QTYPE_A, socket.inet_aton('1.2.3.4'), 1000)]
+    ipv6 = [(QTYPE_AAAA, socket.inet_pton(socket.AF_INET6, '2001:db8::1'), 50)]
+
+    # 同时查询A和AAAA，TTL被限制在max_ttl以内，缓存期间不再查询
+    resolver.resolve('a.example.com', callback)
+    reqs = requests()
+    assert sorted(reqs) == [QTYPE_A, QTYPE_AAAA]
+    resolver._handle_data(_build_response(reqs[QTYPE_A], answers=ipv4))
+    assert not results
+    resolver._handle_data(_build_response(reqs[QTYPE_AAAA]))
+    assert results.pop() == ((b'a.example.com', ['1.2.3.4']), None)
+    assert 99 < ttl_of(b'a.example.com') <= 100
+    resolver.resolve('a.example.com', callback)
+    assert results.pop() == ((b'a.example.com', ['1.2.3.4']), None)
+    assert not sock.sent
+
+    # 过期后重新查询，IPv6地址排在前面，TTL取最小值
+    resolver._cache[b'a.example.com'][1] = time.monotonic() - 1
+    resolver.resolve('a.example.com', callback)
+    reqs = requests()
+    assert len(reqs) == 2 and not results
+    resolver._handle_data(_build_response(
+        reqs[QTYPE_A], answers=[(QTYPE_A, socket.inet_aton('1.2.3.5'), 0)]))
+    assert not results
+    resolver._handle_data(_build_response(reqs[QTYPE_AAAA], answers=ipv6))
+    assert results.pop() == \
+        ((b'a.example.com', ['2001:db8::1', '1.2.3.5']), None)
+    assert (resolver.cache_hits, resolver.cache_misses) == (1, 2)
+    assert 0 < ttl_of(b'a.example.com') <= 1
+
+    # NXDOMAIN按SOA缓存，不再等AAAA的回应
+    resolver.resolve('b.example.com', callback)
+    reqs = requests()
+    resolver._handle_data(_build_response(reqs[QTYPE_A], rcode=RCODE_NXDOMAIN,
+                                          soa=(300, 20)))
+    assert results.pop()[1] is not None
+    assert not resolver._queries
+    assert 19 < ttl_of(b'b.example.com') <= 20
+    resolver._handle_data(_build_response(reqs[QTYPE_AAAA], answers=ipv6))
+    resolver.resolve('b.example.com', callback)
+    assert results.pop()[1] is not None
+    assert not sock.sent
+
+    # 两种地址都没有，缓存否定回答
+    resolver.resolve('c.example.com', callback)
+    for request in requests().values():
+        resolver._handle_data(_build_response(request))
+    assert results.pop()[1] is not None
+    assert 49 < ttl_of(b'c.example.com') <= 50
+
+    # SERVFAIL只缓存很短的时间，查询结束后的回应不会覆盖缓存
+    resolver.resolve('d.example.com', callback)
+    reqs = requests()
+    for request in reqs.values():
+        resolver._handle_data(_build_response(request, rcode=RCODE_SERVFAIL))
+    assert results.pop()[1] is not None
+    assert ttl_of(b'd.example.com') <= SERVFAIL_TTL
+    resolver._handle_data(_build_response(reqs[QTYPE_A],
+                                          rcode=RCODE_NXDOMAIN))
+    assert ttl_of(b'd.example.com') <= SERVFAIL_TTL
+    assert not results
+
+    # 经常访问的条目快要过期时在后台刷新，刷新期间继续使用原来的结果
+    resolver.prefetch_hits = 2
+    resolver.prefetch_fraction = 0.5
+    resolver.resolve('p.example.com', callback)
+    for qtype, request in requests().items():
+        answers = ipv4 if qtype == QTYPE_A else ()
+        resolver._handle_data(_build_response(request, answers=answers))
+    results.clear()
+    resolver._cache[b'p.example.com'][1] = time.monotonic() + 40
+    resolver.resolve('p.example.com', callback)
+    assert not sock.sent
+    resolver.resolve('p.example.com', callback)
+    reqs = requests()
+    assert len(reqs) == 2
+    resolver.resolve('p.example.com', callback)
+    assert not sock.sent
+    assert results == [((b'p.example.com', ['1.2.3.4']), None)] * 3
+    results.clear()
+    resolver._handle_data(_build_response(reqs[QTYPE_A], answers=[
+        (QTYPE_A, socket.inet_aton('1.2.3.7'), 90)]))
+    resolver._handle_data(_build_response(reqs[QTYPE_AAAA]))
+    assert not results
+    assert resolver._cache[b'p.example.com'][0] == ['1.2.3.7']
+    assert 89 < ttl_of(b'p.example.com') <= 90
+
+    # 刷新失败时保留原来的结果
+    resolver._cache[b'p.example.com'][1] = time.monotonic() + 40
+    resolver.resolve('p.example.com', callback)
+    resolver.resolve('p.example.com', callback)
+    for request in requests().values():
+        resolver._handle_data(_build_response(request, rcode=RCODE_SERVFAIL))
+    assert resolver._cache[b'p.example.com'][0] == ['1.2.3.7']
+    assert not resolver._queries and not resolver._hostname_to_results
+    results.clear()
+
+    # 没有回应时按退避的间隔重传，先换到还没有试过的服务器，重传次数用完后失败
+    from eventloop import TimerWheel
+    s1, s2 = '10.0.0.1', '10.0.0.2'
+    resolver = DNSResolver(server_list=[s1, s2], timeout=1, retries=2,
+                           retry_timeout=0.02)
+    resolver._QTYPES = [QTYPE_A]
+    sock = resolver._sock = _FakeSocket()
+    timers = resolver._timers = TimerWheel(tick=0.01)
+    resolver.resolve('e.example.com', callback)
+    resolver.resolve('e.example.com', callback)
+    assert len(sock.sent) == 1
+    for _ in range(100):
+        time.sleep(0.01)
+        timers.run_due()
+        if results:
+            break
+    assert [addr[0] for _, addr in sock.sent] == [s1, s2, s1]
+    assert len(set(data for data, _ in sock.sent)) == 1
+    assert len(results) == 2 and 'timeout' in str(results.pop()[1])
+    results.clear()
+    assert not resolver._queries and len(timers) == 0
+
+    # 请求中带有EDNS0的OPT记录，服务器不支持时去掉OPT记录重新查询
+    assert parse_header(sock.sent[0][0])[8] == 1
+    sock.sent.clear()
+    resolver.resolve('formerr.example.com', callback)
+    request, addr = sock.sent.pop()
+    resolver._handle_data(_build_response(request, rcode=RCODE_FORMERR), s1)
+    request, addr = sock.sent.pop()
+    assert parse_header(request)[8] == 0
+    resolver._handle_data(_build_response(request, answers=ipv4), s1)
+    assert results.pop() == ((b'formerr.example.com', ['1.2.3.4']), None)
+
+    # 优先使用响应快的服务器，忽略ID不对的回应
+    resolver._srtt = {s1: 0.5, s2: 0.01}
+    sock.sent.clear()
+    resolver.resolve('f.example.com', callback)
+    request, addr = sock.sent.pop()
+    assert addr[0] == s2
+    forged = bytes([request[0] ^ 1]) + request[1:]
+    resolver._handle_data(_build_response(forged, answers=ipv4), s2)
+    assert not results
+    resolver._handle_data(_build_response(request, answers=ipv4), s2)
+    assert results.pop() == ((b'f.example.com', ['1.2.3.4']), None)
+    assert resolver._srtt[s2] < 0.5
+
+    # SERVFAIL时立刻换一个服务器重试
+    resolver.resolve('g.example.com', callback)
+    request, addr = sock.sent.pop()
+    resolver._handle_data(_build_response(request, rcode=RCODE_SERVFAIL),
+                          addr[0])
+    assert not results
+    request, addr = sock.sent.pop()
+    assert addr[0] == s1
+    resolver._handle_data(_build_response(request, answers=ipv4), s1)
+    assert results.pop() == ((b'g.example.com', ['1.2.3.4']), None)
+    assert len(timers) == 0
+
+    # 得到IPv4地址后，AAAA没有回应时只再等RESOLUTION_DELAY
+    resolver._QTYPES = [QTYPE_A, QTYPE_AAAA]
+    resolver.resolve('h.example.com', callback)
+    reqs = requests()
+    resolver._handle_data(_build_response(reqs[QTYPE_A], answers=ipv4))
+    start = time.monotonic()
+    while not results and time.monotonic() - start < 1:
+        time.sleep(0.01)
+        timers.run_due()
+    assert results.pop() == ((b'h.example.com', ['1.2.3.4']), None)
+    assert time.monotonic() - start < RETRY_TIMEOUT
+    assert not resolver._queries and len(timers) == 0
+
+    # 先得到IPv6地址时立刻回调，A的回应到达后两种地址一起缓存
+    resolver.resolve('i.example.com', callback)
+    reqs = requests()
+    resolver._handle_data(_build_response(reqs[QTYPE_AAAA], answers=ipv6))
+    assert results.pop() == ((b'i.example.com', ['2001:db8::1']), None)
+    assert b'i.example.com' not in resolver._hostname_to_timer
+    resolver._handle_data(_build_response(reqs[QTYPE_A], answers=ipv4))
+    assert not results and not resolver._queries
+    resolver.resolve('i.example.com', callback)
+    assert results.pop() == \
+        ((b'i.example.com', ['2001:db8::1', '1.2.3.4']), None)
+
+    # UDP回应被截断时，在同一个selector上改用TCP查询
+    import selectors
+    import threading
+    udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp.bind(('127.0.0.1', 0))
+    port = udp.getsockname()[1]
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', port))
+    listener.listen(1)
+    many = [(QTYPE_A, socket.inet_aton('10.0.%d.%d' % (i // 256, i % 256)), 60)
+            for i in range(200)]
+
+    def serve_udp():
+        try:
+            while True:
+                data, addr = udp.recvfrom(RECV_BUFFER_SIZE)
+                qtype = parse_response(data).questions[0][1]
+                udp.sendto(_build_response(data, tc=qtype == QTYPE_A), addr)
+        except OSError:
+            pass
+
+    def serve_tcp():
+        conn, _ = listener.accept()
+        data = conn.recv(RECV_BUFFER_SIZE)
+        response = _build_response(data[2:], answers=many)
+        conn.sendall(struct.pack('!H', len(response)) + response)
+        conn.close()
 
+    threading.Thread(target=serve_udp, daemon=True).start()
+    threading.Thread(target=serve_tcp, daemon=True).start()
+    selector = selectors.DefaultSelector()
+    timers = TimerWheel()
+    resolver = DNSResolver(server_list=['127.0.0.1'], port=port)
+    resolver.add_to_loop(selector, timers)
+    resolver.resolve('big.example.com', callback)
+    start = time.monotonic()
+    while not results and time.monotonic() - start < 5:
+        for key, mask in selector.select(0.1):
+            key.data(key, mask)
+        timers.run_due()
+    (hostname, addrs), error = results.pop()
+    assert error is None and len(addrs) == 200
+    assert not resolver._queries
+    resolver.close()
+    udp.close()
+    listener.close()
+    selector.close()
 
 if __name__ == '__main__':
     test()
@@ -0,0 +1,76 @@
+'''
+加密方法的吞吐量基准测试。
+
+对encypt.METHODS中的每种加密方法，按连接转发时的方式（cipher_batch、decipher_into）
+测量64B到256KB不同大小数据块的加密、解密速度和每次调用的耗时，并给出本机最快的方法。
+单个进程只能使用一个CPU核心，表中的速度就是每个工作进程的上限，可以据此选择-m和-w参数。
+
+最后一张表是每个连接建立加密的耗时，比较每次从密码创建加密器和使用加密器工厂两种方式，
+它决定了大量连接同时建立时每秒能处理多少个CONNECT请求。
+
+    python bench_crypto.py [--duration SECONDS] [--sizes 64,1024,...] [--methods M1,M2]
+                           [--setup-count N]
+'''
+
+import argparse
+import logging
+import os
+
+import encypt
+
+SIZES = [64, 256, 1024, 4096, 16 * 1024, 64 * 1024, 256 * 1024]
+
+
+def format_size(size):
+    if size >= 1024:
+        return '%dK' % (size // 1024)
+    return str(size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='加密方法吞吐量基准测试')
+    parser.add_argument('--duration', type=float, default=0.2,
+                        help='每种方法每个大小的测量秒数')
+    parser.add_argument('--sizes', default=','.join(map(str, SIZES)),
+                        help='逗号分隔的数据块大小')
+    parser.add_argument('--methods', default=','.join(sorted(encypt.METHODS)),
+                        help='逗号分隔的加密方法')
+    parser.add_argument('--setup-count', type=int, default=2000,
+                        help='测量建立加密耗时的连接数')
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    methods = args.methods.split(',')
+
+    print('{0:<24}{1:>8}{2:>12}{3:>12}{4:>12}'.format(
+        'method', 'size', 'enc MB/s', 'dec MB/s', 'us/call'))
+    best = {}
+    for method in methods:
+        for size in sizes:
+            encrypt, decrypt, per_call = encypt.measure_method(
+                method, size, args.duration)
+            print('{0:<24}{1:>8}{2:>12.1f}{3:>12.1f}{4:>12.2f}'.format(
+                method, format_size(size), encrypt, decrypt, per_call))
+            speed = 1 / (1 / encrypt + 1 / decrypt)
+            if size not in best or speed > best[size][0]:
+                best[size] = speed, method
+
+    print()
+    for size in sizes:
+        print('{0:>8}: 最快的方法是 {1}'.format(format_size(size), best[size][1]))
+    print('本机有{0}个CPU核心，多进程模式(-w)下总吞吐量最多约为上表的{0}倍'.format(
+        os.cpu_count()))
+
+    print()
+    print('{0:<24}{1:>16}{2:>16}'.format(
+        'method', 'new_cyptor us', 'factory us'))
+    for method in methods:
+        print('{0:<24}{1:>16.2f}{2:>16.2f}'.format(
+            method,
+            encypt.measure_setup(method, False, args.setup_count),
+            encypt.measure_setup(method, True, args.setup_count)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,333 @@
+'''
+DNS回应解析的微基准测试。
+
+比较asyncdns.parse_response和原来逐条切片、递归处理压缩指针并解析所有部分的实现。
+默认使用生成的回应：简单的A记录、CDN域名的长CNAME链（带权威和附加部分）、
+AAAA记录、NXDOMAIN和只有CNAME没有地址的回应。也可以用--corpus指定一个目录，
+其中每个文件是一个抓包得到的原始DNS回应（UDP负载）。
+
+    python bench_dns_parse.py [--rounds N] [--corpus DIR]
+'''
+
+import argparse
+import logging
+import os
+import socket
+import struct
+import time
+
+import asyncdns
+from common import compat_ord
+
+QCLASS_IN = asyncdns.QCLASS_IN
+
+
+# 原来的实现，仅用于对比
+
+def legacy_parse_ip(addrtype, data, length, offset):
+    if addrtype == asyncdns.QTYPE_A:
+        return socket.inet_ntop(socket.AF_INET, data[offset:offset + length])
+    elif addrtype == asyncdns.QTYPE_AAAA:
+        return socket.inet_ntop(socket.AF_INET6, data[offset:offset + length])
+    elif addrtype in [asyncdns.QTYPE_CNAME, asyncdns.QTYPE_NS]:
+        return legacy_parse_name(data, offset)[1]
+    else:
+        return data[offset:offset + length]
+
+
+def legacy_parse_name(data, offset):
+    p = offset
+    labels = []
+    l = compat_ord(data[p])
+    while l > 0:
+        if (l & (128 + 64)) == (128 + 64):
+            # pointer
+            pointer = struct.unpack('!H', data[p:p + 2])[0]
+            pointer &= 0x3FFF
+            r = legacy_parse_name(data, pointer)
+            labels.append(r[1])
+            p += 2
+            # pointer is the end
+            return p - offset, b'.'.join(labels)
+        else:
+            labels.append(data[p + 1:p + 1 + l])
+            p += 1 + l
+        l = compat_ord(data[p])
+    return p - offset + 1, b'.'.join(labels)
+
+
+def legacy_parse_record(data, offset, question=False):
+    nlen, name = legacy_parse_name(data, offset)
+    if not question:
+        record_type, record_class, record_ttl, record_rdlength = struct.unpack(
+            '!HHiH', data[offset + nlen:offset + nlen + 10])
+        ip = legacy_parse_ip(record_type, data, record_rdlength,
+                             offset + nlen + 10)
+        return nlen + 10 + record_rdlength, \
+            (name, ip, record_type, record_class, record_ttl)
+    else:
+        record_type, record_class = struct.unpack(
+            '!HH', data[offset + nlen:offset + nlen + 4])
+        return nlen + 4, (name, None, record_type, record_class, None, None)
+
+
+def legacy_parse_header(data):
+    if len(data) >= 12:
+        header = struct.unpack('!HBBHHHH', data[:12])
+        res_id = header[0]
+        res_qr = header[1] & 128
+        res_tc = header[1] & 2
+        res_ra = header[2] & 128
+        res_rcode = header[2] & 15
+        # assert res_tc == 0
+        # assert res_rcode in [0, 3]
+        res_qdcount = header[3]
+        res_ancount = header[4]
+        res_nscount = header[5]
+        res_arcount = header[6]
+        return (res_id, res_qr, res_tc, res_ra, res_rcode, res_qdcount,
+                res_ancount, res_nscount, res_arcount)
+    return None
+
+
+def legacy_parse_response(data):
+    try:
+        if len(data) >= 12:
+            header = legacy_parse_header(data)
+            if not header:
+                return None
+            res_id, res_qr, res_tc, res_ra, res_rcode, res_qdcount, \
+                res_ancount, res_nscount, res_arcount = header
+
+            response = asyncdns.DNSResponse()
+            response.id = res_id
+            response.tc = bool(res_tc)
+            response.rcode = res_rcode
+            qds = []
+            ans = []
+            offset = 12
+            for _ in range(0, res_qdcount):
+                l, r = legacy_parse_record(data, offset, True)
+                offset += l
+                if r:
+                    qds.append(r)
+            for i in range(0, res_ancount):
+                l, r = legacy_parse_record(data, offset)
+                offset += l
+                if r:
+                    ans.append(r)
+            for i in range(0, res_nscount):
+                l, r = legacy_parse_record(data, offset)
+                offset += l
+                if r[2] == asyncdns.QTYPE_SOA and len(r[1]) >= 4:
+                    # rfc2308: 否定回答的缓存时间取SOA记录的TTL和MINIMUM中较小的一个
+                    minimum = struct.unpack('!I', r[1][-4:])[0]
+                    response.negative_ttl = min(r[4], minimum)
+            for i in range(0, res_arcount):
+                l, r = legacy_parse_record(data, offset)
+                offset += l
+            if qds:
+                response.hostname = qds[0][0]
+            for an in qds:
+                response.questions.append((an[1], an[2], an[3]))
+            for an in ans:
+                response.answers.append((an[1], an[2], an[3], an[4]))
+            return response
+    except Exception as e:
+        logging.exception(e)
+        return None
+
+
+class ResponseWriter:
+    '''
+    构造带有压缩指针的DNS回应。
+    '''
+
+    def __init__(self, qname, qtype, rcode=0):
+        self.buf = bytearray(struct.pack('!HBBHHHH', 0x1234, 0x81,
+                                         0x80 | rcode, 1, 0, 0, 0))
+        self.names = {}
+        self.name(qname)
+        self.buf += struct.pack('!HH', qtype, QCLASS_IN)
+
+    def name(self, name):
+        labels = name.split(b'.')
+        for i in range(len(labels)):
+            suffix = b'.'.join(labels[i:])
+            if suffix in self.names:
+                self.buf += struct.pack('!H', 0xC000 | self.names[suffix])
+                return
+            self.names[suffix] = len(self.buf)
+            self.buf += bytes([len(labels[i])]) + labels[i]
+        self.buf += b'\0'
+
+    def record(self, section, name, rtype, ttl, rdata):
+        '''
+        section是回答、权威或者附加部分(1, 2, 3)。rdata是bytes，或者是作为域名写入的列表。
+        '''
+        self.name(name)
+        self.buf += struct.pack('!HHi', rtype, QCLASS_IN, ttl)
+        pos = len(self.buf)
+        self.buf += b'\0\0'
+        if isinstance(rdata, list):
+            for item in rdata:
+                if isinstance(item, bytes) and b'.' in item:
+                    self.name(item)
+                else:
+                    self.buf += item
+        else:
+            self.buf += rdata
+        struct.pack_into('!H', self.buf, pos, len(self.buf) - pos - 2)
+        count = struct.unpack_from('!H', self.buf, 4 + section * 2)[0]
+        struct.pack_into('!H', self.buf, 4 + section * 2, count + 1)
+
+    def opt(self):
+        self.buf += b'\0' + struct.pack('!HHIH', asyncdns.QTYPE_OPT, 1232,
+                                         0, 0)
+        count = struct.unpack_from('!H', self.buf, 10)[0]
+        struct.pack_into('!H', self.buf, 10, count + 1)
+
+    def data(self):
+        return bytes(self.buf)
+
+
+def ipv4(i):
+    return struct.pack('!I', 10 << 24 | i & 0xFFFFFF)
+
+
+def ipv6(i):
+    return socket.inet_pton(socket.AF_INET6, '2001:db8::%x' % i)
+
+
+def soa(zone):
+    return [b'ns1.' + zone, b'hostmaster.' + zone,
+            struct.pack('!IIIII', 2024010101, 7200, 3600, 1209600, 300)]
+
+
+def make_corpus(count):
+    '''
+    生成count组回应，每组包括五种典型的回应。
+    '''
+    A, AAAA, CNAME, NS, SOA = (asyncdns.QTYPE_A, asyncdns.QTYPE_AAAA,
+                               asyncdns.QTYPE_CNAME, asyncdns.QTYPE_NS,
+                               asyncdns.QTYPE_SOA)
+    corpus = []
+    for i in range(count):
+        # 简单的A记录
+        w = ResponseWriter(b'api%d.example.com' % i, A)
+        w.record(1, b'api%d.example.com' % i, A, 300, ipv4(i))
+        w.opt()
+        corpus.append(('simple', w.data()))
+
+        # CDN：长CNAME链，多个地址，权威部分的NS和附加部分的glue记录
+        chain = [b'www.shop%d.example.com' % i,
+                 b'shop%d.example.com.cdn.cloudprovider.net' % i,
+                 b'e%d.a.edgekey.net' % i,
+                 b'e%d.dscx.edgesuite.net' % i,
+                 b'a%d.w10.edge.cdnnet.com' % i]
+        w = ResponseWriter(chain[0], A)
+        for src, dst in zip(chain, chain[1:]):
+            w.record(1, src, CNAME, 3600, [dst])
+        for j in range(8):
+            w.record(1, chain[-1], A, 20, ipv4(i * 8 + j))
+        for j in range(4):
+            w.record(2, b'edge.cdnnet.com', NS, 86400,
+                     [b'ns%d.cdnnet.com' % j])
+        for j in range(4):
+            w.record(3, b'ns%d.cdnnet.com' % j, A, 86400, ipv4(j))
+            w.record(3, b'ns%d.cdnnet.com' % j, AAAA, 86400, ipv6(j))
+        w.opt()
+        corpus.append(('cdn', w.data()))
+
+        # AAAA记录
+        w = ResponseWriter(b'v6.site%d.example.org' % i, AAAA)
+        for j in range(4):
+            w.record(1, b'v6.site%d.example.org' % i, AAAA, 600,
+                     ipv6(i * 4 + j))
+        w.record(2, b'example.org', NS, 86400, [b'a.iana-servers.net'])
+        w.opt()
+        corpus.append(('aaaa', w.data()))
+
+        # 域名不存在
+        w = ResponseWriter(b'missing%d.example.com' % i, A, rcode=3)
+        w.record(2, b'example.com', SOA, 900, soa(b'example.com'))
+        w.opt()
+        corpus.append(('nxdomain', w.data()))
+
+        # 只有CNAME，没有AAAA地址
+        w = ResponseWriter(b'img%d.example.com' % i, AAAA)
+        w.record(1, b'img%d.example.com' % i, CNAME, 300,
+                 [b'img.static.example.net'])
+        w.record(2, b'example.net', SOA, 900, soa(b'example.net'))
+        w.opt()
+        corpus.append(('nodata', w.data()))
+    return corpus
+
+
+def load_corpus(path):
+    corpus = []
+    for name in sorted(os.listdir(path)):
+        with open(os.path.join(path, name), 'rb') as f:
+            corpus.append((name, f.read()))
+    return corpus
+
+
+def summary(response):
+    '''
+    解析器使用的字段，两种实现的结果应该相同。
+    '''
+    addrs = [a for a in response.answers
+             if a[1] in (asyncdns.QTYPE_A, asyncdns.QTYPE_AAAA,
+                         asyncdns.QTYPE_CNAME)]
+    negative_ttl = None if addrs and addrs[-1][1] != asyncdns.QTYPE_CNAME \
+        else response.negative_ttl
+    return (response.id, response.hostname, response.tc, response.rcode,
+            response.questions[0][1], addrs, negative_ttl)
+
+
+def measure(parse, messages, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for data in messages:
+            parse(data)
+    return (time.perf_counter() - start) / (rounds * len(messages))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='DNS回应解析微基准测试')
+    parser.add_argument('--rounds', type=int, default=20, help='重复次数')
+    parser.add_argument('--count', type=int, default=200,
+                        help='生成的每种回应的数量')
+    parser.add_argument('--corpus', help='抓包得到的回应所在的目录')
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    if args.corpus:
+        corpus = load_corpus(args.corpus)
+        kinds = {'corpus': [data for _, data in corpus]}
+    else:
+        corpus = make_corpus(args.count)
+        kinds = {}
+        for kind, data in corpus:
+            kinds.setdefault(kind, []).append(data)
+        kinds['all'] = [data for _, data in corpus]
+
+    for _, data in corpus:
+        legacy = legacy_parse_response(data)
+        current = asyncdns.parse_response(data)
+        assert (legacy is None) == (current is None)
+        if legacy is not None:
+            assert summary(legacy) == summary(current), data
+
+    print('{0:<10}{1:>8}{2:>14}{3:>14}{4:>10}'.format(
+        'kind', 'bytes', 'legacy us', 'current us', 'speedup'))
+    for kind, messages in kinds.items():
+        size = sum(len(data) for data in messages) // len(messages)
+        old = measure(legacy_parse_response, messages, args.rounds)
+        new = measure(asyncdns.parse_response, messages, args.rounds)
+        print('{0:<10}{1:>8}{2:>14.2f}{3:>14.2f}{4:>9.1f}x'.format(
+            kind, size, old * 1e6, new * 1e6, old / new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+'''
+DNS解析器的基准测试。
+
+在子进程中启动stub_dns.StubDNSServer，用asyncdns.DNSResolver在同一个事件循环中解析大量域名，
+最多同时有--concurrency个解析在进行。域名按Zipf分布选取：少数热门域名被反复解析（命中缓存），
+大量域名只出现一两次，--nxdomain比例的域名不存在。对每种场景报告每秒完成的解析数、缓存命中率、
+解析时间的p50/p99/p99.9/最大值、失败数，以及DNS服务器收到的查询、丢弃和截断的次数。
+
+场景覆盖正常和出错的情况：
+* fast：没有延迟；cname：回答中有3层CNAME；truncated：UDP回应全部被截断，改用TCP查询。
+* slow：每个回应延迟100到200毫秒；lossy：丢弃10%的UDP查询，靠重传恢复。
+* slow-primary：第一个服务器延迟300毫秒；dead-primary：第一个服务器不回应。
+  解析器应该按响应时间改用第二个服务器。
+
+    python bench_dns_resolver.py [--queries N] [--hosts N] [--concurrency N] [--nxdomain RATIO]
+                                 [--scenarios fast,slow,...] [--output FILE]
+'''
+
+import argparse
+import json
+import logging
+import random
+import time
+from selectors import DefaultSelector
+
+import stub_dns
+from asyncdns import DNSResolver
+from eventloop import TimerWheel
+
+# 场景名 -> 每个DNS服务器的StubDNSServer参数
+SCENARIOS = {
+    'fast': [{}],
+    'cname': [{'cname': 3}],
+    'truncated': [{'truncate': 1}],
+    'slow': [{'latency': 0.1, 'jitter': 0.1}],
+    'lossy': [{'loss': 0.1}],
+    'slow-primary': [{'latency': 0.3}, {}],
+    'dead-primary': [{'loss': 1}, {}],
+}
+
+
+def make_workload(count, hosts, nxdomain, seed):
+    '''
+    按Zipf分布选取count个域名。
+    '''
+    rng = random.Random(seed)
+    names = []
+    for i in range(hosts):
+        prefix = stub_dns.NXDOMAIN_PREFIX if rng.random() < nxdomain else b''
+        names.append(prefix + b'h%d.bench.test' % i)
+    weights = [1 / (i + 1) for i in range(hosts)]
+    return rng.choices(names, weights, k=count)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+class Driver:
+    '''
+    向解析器发起解析并记录结果。
+    '''
+
+    def __init__(self, resolver):
+        self.resolver = resolver
+        self.outstanding = 0
+        self.latencies = []
+        self.failures = 0
+        self.nxdomain = 0
+
+    def resolve(self, hostname):
+        start = time.perf_counter()
+        self.outstanding += 1
+
+        # 解析器用回调函数作为键，每次解析需要不同的函数对象
+        def callback(result, error):
+            self.outstanding -= 1
+            self.latencies.append(time.perf_counter() - start)
+            if result and result[1]:
+                return
+            if hostname.startswith(stub_dns.NXDOMAIN_PREFIX):
+                self.nxdomain += 1
+            else:
+                self.failures += 1
+
+        # 命中缓存时在这里直接调用回调
+        self.resolver.resolve(hostname, callback)
+
+
+def run_scenario(servers, workload, args):
+    stubs = []
+    for i, options in enumerate(servers):
+        # 多个服务器使用不同的本地地址和同一个端口，解析器只有一个端口参数
+        port = stubs[0].address[1] if stubs else 0
+        stubs.append(stub_dns.StubProcess(
+            host='127.0.0.{0}'.format(i + 1), port=port, ttl=args.ttl,
+            seed=args.seed + i, **options))
+
+    selector = DefaultSelector()
+    timers = TimerWheel()
+    resolver = DNSResolver(server_list=[stub.address[0] for stub in stubs],
+                           port=stubs[0].address[1])
+    resolver.add_to_loop(selector, timers)
+    driver = Driver(resolver)
+
+    start = time.perf_counter()
+    i = 0
+    while i < len(workload) or driver.outstanding:
+        while driver.outstanding < args.concurrency and i < len(workload):
+            driver.resolve(workload[i])
+            i += 1
+        if not driver.outstanding:
+            continue
+        events = selector.select(timers.next_timeout())
+        timers.update_time()
+        for key, mask in events:
+            key.data(key, mask)
+        timers.run_due()
+    elapsed = time.perf_counter() - start
+
+    resolver.close()
+    selector.close()
+    stats = {}
+    for stub in stubs:
+        for k, v in stub.stop().items():
+            stats[k] = stats.get(k, 0) + v
+
+    lookups = resolver.cache_hits + resolver.cache_misses
+    result = {
+        'resolutions_per_sec': len(workload) / elapsed,
+        'cache_hit_ratio': resolver.cache_hits / lookups if lookups else 0,
+        'p50_ms': percentile(driver.latencies, 0.5) * 1000,
+        'p99_ms': percentile(driver.latencies, 0.99) * 1000,
+        'p999_ms': percentile(driver.latencies, 0.999) * 1000,
+        'max_ms': max(driver.latencies) * 1000,
+        'failures': driver.failures,
+        'nxdomain': driver.nxdomain,
+    }
+    result.update(stats)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='DNS解析器基准测试')
+    parser.add_argument('--queries', type=int, default=50000,
+                        help='每种场景解析的次数')
+    parser.add_argument('--hosts', type=int, default=5000,
+                        help='不同域名的个数')
+    parser.add_argument('--concurrency', type=int, default=100,
+                        help='最多同时进行的解析数')
+    parser.add_argument('--nxdomain', type=float, default=0.05,
+                        help='不存在的域名的比例')
+    parser.add_argument('--ttl', type=int, default=300,
+                        help='DNS服务器回答的TTL')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help='逗号分隔的场景: ' + ','.join(SCENARIOS))
+    parser.add_argument('--seed', type=int, default=1, help='随机数种子')
+    parser.add_argument('--output', help='把结果以JSON写入这个文件')
+    args = parser.parse_args()
+    # 丢包和不回应的场景中解析器会大量警告超时
+    logging.disable(logging.CRITICAL)
+
+    workload = make_workload(args.queries, args.hosts, args.nxdomain,
+                             args.seed)
+    columns = ['resolutions_per_sec', 'cache_hit_ratio', 'p50_ms', 'p99_ms',
+               'p999_ms', 'max_ms', 'failures', 'queries', 'dropped',
+               'tcp_queries']
+    print('{0:<14}{1:>10}{2:>8}{3:>9}{4:>9}{5:>9}{6:>9}{7:>7}{8:>9}{9:>9}'
+          '{10:>7}'.format('scenario', 'res/s', 'hit', 'p50 ms', 'p99 ms',
+                           'p999 ms', 'max ms', 'fail', 'queries', 'dropped',
+                           'tcp'))
+    results = {}
+    for name in args.scenarios.split(','):
+        result = results[name] = run_scenario(SCENARIOS[name], workload, args)
+        print('{0:<14}{1:>10.0f}{2:>8.3f}{3:>9.2f}{4:>9.2f}{5:>9.2f}{6:>9.1f}'
+              '{7:>7}{8:>9}{9:>9}{10:>7}'.format(
+                  name, *[result[column] for column in columns]))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=2,
+                      sort_keys=True)
+            f.write('\n')
+
+
+if __name__ == '__main__':
+    main()
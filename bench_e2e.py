@@ -0,0 +1,391 @@
+'''
+端到端的回环基准测试。
+
+在本机启动隧道服务器、隧道客户端和一个目标服务器，由若干个并发的客户端通过HTTP CONNECT建立隧道，测量：
+
+* 批量传输：每条隧道上传（目标服务器丢弃数据）和下载（目标服务器发送数据）的总吞吐量，MB/s。
+* 往返延迟：在已经建立的隧道上收发64字节的消息，每次往返时间的p50和p99。
+* 握手：每秒完成多少次CONNECT（建立隧道并收到目标服务器回显的第一个字节），以及每次握手时间的p50和p99。
+* CPU：批量传输期间隧道客户端和服务器进程消耗的CPU秒数，折算为每GB数据的CPU秒数。
+
+不需要访问外部网络，只能在Linux上运行（从/proc读取进程的CPU时间）。结果以JSON写入--output，
+--compare读入之前的结果，逐项比较，可以用来发现不同提交之间的性能退化。
+
+    python bench_e2e.py [--connections N] [--bulk-size MB] [--rounds N] [--handshake-time SECONDS]
+                        [-m METHOD] [-e ENGINE] [--client-args ARGS] [--server-args ARGS]
+                        [--output FILE] [--compare FILE]
+'''
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shlex
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+PASSWORD = 'bench-e2e'
+
+# 目标服务器的模式，由隧道中的第一个字节选择
+MODE_ECHO = b'E'  # 原样返回
+MODE_SINK = b'S'  # 读到EOF后回复收到的字节数（8字节）
+MODE_SOURCE = b'D'  # 读到8字节的长度，发送这么多字节后关闭连接
+
+CHUNK = 64 * 1024
+
+# 结果中每一项的说明和单位，比较时higher表示越大越好
+RESULTS = [
+    ('upload_mbps', 'MB/s', True),
+    ('download_mbps', 'MB/s', True),
+    ('rtt_p50_ms', 'ms', False),
+    ('rtt_p99_ms', 'ms', False),
+    ('handshakes_per_sec', '/s', True),
+    ('handshake_p50_ms', 'ms', False),
+    ('handshake_p99_ms', 'ms', False),
+    ('client_cpu_s_per_gb', 's/GB', False),
+    ('server_cpu_s_per_gb', 's/GB', False),
+]
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_for_port(port, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError('端口{0}没有在{1}秒内开始监听'.format(port, timeout))
+
+
+def recv_exactly(sock, size):
+    chunks = []
+    while size > 0:
+        data = sock.recv(min(size, 1 << 20))
+        if not data:
+            raise EOFError('隧道提前关闭')
+        chunks.append(data)
+        size -= len(data)
+    return b''.join(chunks)
+
+
+def serve_target(conn):
+    with conn:
+        mode = conn.recv(1)
+        if mode == MODE_ECHO:
+            while True:
+                data = conn.recv(CHUNK)
+                if not data:
+                    break
+                conn.sendall(data)
+        elif mode == MODE_SINK:
+            total = 0
+            while True:
+                data = conn.recv(1 << 20)
+                if not data:
+                    break
+                total += len(data)
+            conn.sendall(struct.pack('!Q', total))
+        elif mode == MODE_SOURCE:
+            size = struct.unpack('!Q', recv_exactly(conn, 8))[0]
+            chunk = bytes(CHUNK)
+            while size > 0:
+                conn.sendall(chunk[:size])
+                size -= len(chunk)
+
+
+def run_target(listener):
+    '''
+    目标服务器，在单独的进程中运行，不和测量用的客户端争抢GIL。
+    '''
+    while True:
+        conn, _ = listener.accept()
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        threading.Thread(target=serve_target, args=(conn,),
+                         daemon=True).start()
+
+
+def cpu_seconds(pid):
+    '''
+    进程已经消耗的用户态和内核态CPU秒数。
+    '''
+    with open('/proc/{0}/stat'.format(pid)) as f:
+        # 进程名可能含有空格，从右括号之后开始数字段
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+class Bench:
+    '''
+    启动目标服务器、隧道服务器和隧道客户端，运行各项测量。
+    '''
+
+    def __init__(self, args):
+        self.args = args
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1024)
+        self.target_port = listener.getsockname()[1]
+        self.target = multiprocessing.Process(target=run_target,
+                                              args=(listener,), daemon=True)
+        self.target.start()
+        listener.close()
+
+        server_port = free_port()
+        self.client_port = free_port()
+        common = ['-c', PASSWORD, '-m', args.method, '-e', args.engine]
+        # 每个连接的INFO日志照常产生，这也是实际运行时的开销，只是不显示
+        self.server = subprocess.Popen(
+            [sys.executable, 'server.py', '-l', str(server_port)] + common +
+            shlex.split(args.server_args), cwd=ROOT,
+            stderr=subprocess.DEVNULL)
+        wait_for_port(server_port)
+        self.client = subprocess.Popen(
+            [sys.executable, 'client.py', '-i', '127.0.0.1', '-p',
+             str(server_port), '-l', str(self.client_port)] + common +
+            shlex.split(args.client_args), cwd=ROOT,
+            stderr=subprocess.DEVNULL)
+        wait_for_port(self.client_port)
+
+    def connect(self, mode):
+        '''
+        建立一条到目标服务器的隧道，发送模式字节，返回套接字。
+        '''
+        sock = socket.create_connection(('127.0.0.1', self.client_port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(30)
+        sock.sendall('CONNECT 127.0.0.1:{0} HTTP/1.1\r\n\r\n'.format(
+            self.target_port).encode() + mode)
+        reply = b''
+        while b'\r\n\r\n' not in reply:
+            data = sock.recv(1024)
+            if not data:
+                raise EOFError('隧道在回复之前关闭')
+            reply += data
+        if not reply.startswith(b'HTTP/1.1 200'):
+            raise RuntimeError('CONNECT失败: {0!r}'.format(reply))
+        return sock
+
+    def parallel(self, func):
+        '''
+        在args.connections个线程中并发调用func(i)，返回结果的列表和经过的秒数。
+        '''
+        results = [None] * self.args.connections
+        errors = []
+
+        def worker(i):
+            try:
+                results[i] = func(i)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(i,))
+                   for i in range(self.args.connections)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        if errors:
+            raise errors[0]
+        return results, elapsed
+
+    def measure_bulk(self):
+        size = int(self.args.bulk_size * 1e6)
+        payload = os.urandom(CHUNK)
+
+        def upload(i):
+            sock = self.connect(MODE_SINK)
+            sent = 0
+            while sent < size:
+                sock.sendall(payload[:size - sent])
+                sent += len(payload)
+            sock.shutdown(socket.SHUT_WR)
+            total = struct.unpack('!Q', recv_exactly(sock, 8))[0]
+            sock.close()
+            assert total == size, (total, size)
+
+        def download(i):
+            sock = self.connect(MODE_SOURCE + struct.pack('!Q', size))
+            total = 0
+            while True:
+                data = sock.recv(1 << 20)
+                if not data:
+                    break
+                total += len(data)
+            sock.close()
+            assert total == size, (total, size)
+
+        cpu = self.cpu()
+        _, up = self.parallel(upload)
+        _, down = self.parallel(download)
+        client_cpu, server_cpu = [b - a for a, b in zip(cpu, self.cpu())]
+        gigabytes = size * self.args.connections * 2 / 1e9
+        return {
+            'upload_mbps': size * self.args.connections / up / 1e6,
+            'download_mbps': size * self.args.connections / down / 1e6,
+            'client_cpu_s_per_gb': client_cpu / gigabytes,
+            'server_cpu_s_per_gb': server_cpu / gigabytes,
+        }
+
+    def measure_rtt(self):
+        message = os.urandom(64)
+
+        def ping(i):
+            sock = self.connect(MODE_ECHO)
+            times = []
+            for _ in range(self.args.rounds):
+                start = time.perf_counter()
+                sock.sendall(message)
+                recv_exactly(sock, len(message))
+                times.append(time.perf_counter() - start)
+            sock.close()
+            return times
+
+        results, _ = self.parallel(ping)
+        times = [t for result in results for t in result]
+        return {
+            'rtt_p50_ms': percentile(times, 0.5) * 1000,
+            'rtt_p99_ms': percentile(times, 0.99) * 1000,
+        }
+
+    def measure_handshakes(self):
+        deadline = time.perf_counter() + self.args.handshake_time
+
+        def handshake(i):
+            times = []
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                sock = self.connect(MODE_ECHO + b'x')
+                recv_exactly(sock, 1)
+                times.append(time.perf_counter() - start)
+                sock.close()
+            return times
+
+        results, elapsed = self.parallel(handshake)
+        times = [t for result in results for t in result]
+        return {
+            'handshakes_per_sec': len(times) / elapsed,
+            'handshake_p50_ms': percentile(times, 0.5) * 1000,
+            'handshake_p99_ms': percentile(times, 0.99) * 1000,
+        }
+
+    def cpu(self):
+        return cpu_seconds(self.client.pid), cpu_seconds(self.server.pid)
+
+    def run(self):
+        results = {}
+        results.update(self.measure_bulk())
+        results.update(self.measure_rtt())
+        results.update(self.measure_handshakes())
+        return results
+
+    def close(self):
+        for proc in (self.client, self.server):
+            proc.terminate()
+            proc.wait()
+        self.target.terminate()
+        self.target.join()
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, old=None):
+    if old is None:
+        print('{0:<24}{1:>12}{2:>8}'.format('metric', 'value', 'unit'))
+        for name, unit, _ in RESULTS:
+            print('{0:<24}{1:>12.2f}{2:>8}'.format(name, results[name], unit))
+        return
+
+    print('{0:<24}{1:>12}{2:>12}{3:>8}{4:>10}'.format(
+        'metric', 'old', 'new', 'unit', 'change'))
+    for name, unit, higher in RESULTS:
+        before, after = old.get(name), results[name]
+        if not before:
+            print('{0:<24}{1:>12}{2:>12.2f}{3:>8}'.format(
+                name, '-', after, unit))
+            continue
+        change = (after - before) / before * 100
+        # 变差超过5%时标记出来
+        worse = change < -5 if higher else change > 5
+        print('{0:<24}{1:>12.2f}{2:>12.2f}{3:>8}{4:>+9.1f}%{5}'.format(
+            name, before, after, unit, change, ' !' if worse else ''))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='端到端回环基准测试')
+    parser.add_argument('--connections', type=int, default=8,
+                        help='并发的客户端数')
+    parser.add_argument('--bulk-size', type=float, default=16,
+                        help='批量传输时每个客户端上传和下载的MB数')
+    parser.add_argument('--rounds', type=int, default=500,
+                        help='测量往返延迟时每个客户端往返的次数')
+    parser.add_argument('--handshake-time', type=float, default=3,
+                        help='测量握手的秒数')
+    parser.add_argument('-m', '--method', default='aes-256-cfb',
+                        help='加密方法')
+    parser.add_argument('-e', '--engine', choices=('selector', 'asyncio'),
+                        default='selector', help='事件引擎')
+    parser.add_argument('--client-args', default='',
+                        help='传给隧道客户端的其他参数，如"--mux 2"')
+    parser.add_argument('--server-args', default='',
+                        help='传给隧道服务器的其他参数，如"--crypto-threads 2"')
+    parser.add_argument('--output', help='把结果以JSON写入这个文件')
+    parser.add_argument('--compare', help='和这个文件中之前的结果比较')
+    args = parser.parse_args()
+
+    bench = Bench(args)
+    try:
+        results = bench.run()
+    finally:
+        bench.close()
+
+    report = {
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'args': vars(args),
+        'results': results,
+    }
+    old = None
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)['results']
+    print_results(results, old)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+'''
+LRUCache微基准测试。
+
+比较当前的lru_cache.LRUCache和原来基于访问记录队列的实现：
+每秒操作数、内存峰值，以及单次sweep()最长的停顿时间。
+
+    python bench_lru_cache.py [--ops N] [--keys K] [--timeout T]
+'''
+
+import argparse
+import collections
+import collections.abc
+import logging
+import random
+import time
+import tracemalloc
+
+import lru_cache
+
+
+class LegacyLRUCache(collections.abc.MutableMapping):
+    '''
+    原来的实现，仅用于对比。每次访问都会追加访问记录，内存随访问频率增长，
+    sweep()需要处理所有过期的访问记录。
+    '''
+
+    def __init__(self, timeout=60, close_callback=None, *args, **kwargs):
+        self.timeout = timeout
+        self.close_callback = close_callback
+        self._store = {}
+        self._time_to_keys = collections.defaultdict(list)
+        self._keys_to_last_time = {}
+        self._last_visits = collections.deque()
+        self._closed_values = set()
+        self.update(dict(*args, **kwargs))
+
+    def __getitem__(self, key):
+        t = time.time()
+        self._keys_to_last_time[key] = t
+        self._time_to_keys[t].append(key)
+        self._last_visits.append(t)
+        return self._store[key]
+
+    def __setitem__(self, key, value):
+        t = time.time()
+        self._keys_to_last_time[key] = t
+        self._store[key] = value
+        self._time_to_keys[t].append(key)
+        self._last_visits.append(t)
+
+    def __delitem__(self, key):
+        del self._store[key]
+        del self._keys_to_last_time[key]
+
+    def __iter__(self):
+        return iter(self._store)
+
+    def __len__(self):
+        return len(self._store)
+
+    def sweep(self):
+        now = time.time()
+        c = 0
+        while len(self._last_visits) > 0:
+            least = self._last_visits[0]
+            if now - least <= self.timeout:
+                break
+            self._last_visits.popleft()
+            for key in self._time_to_keys[least]:
+                if key in self._store:
+                    if now - self._keys_to_last_time[key] > self.timeout:
+                        if self.close_callback is not None:
+                            value = self._store[key]
+                            if value not in self._closed_values:
+                                self.close_callback(value)
+                                self._closed_values.add(value)
+                        del self._store[key]
+                        del self._keys_to_last_time[key]
+                        c += 1
+            del self._time_to_keys[least]
+        if c:
+            self._closed_values.clear()
+        return c
+
+
+def run(cache, ops, keys, sweep_every):
+    '''
+    模拟DNS缓存的访问：大部分访问集中在少数热门的键上，未命中时写入。
+    '''
+    rng = random.Random(1)
+    names = ['host%d.example.com' % i for i in range(keys)]
+    pattern = [names[min(int(rng.paretovariate(1.2)) - 1, keys - 1)]
+               for _ in range(ops)]
+
+    tracemalloc.start()
+    max_pause = 0.0
+    start = time.perf_counter()
+    for i, name in enumerate(pattern):
+        if name in cache:
+            cache[name]
+        else:
+            cache[name] = '127.0.0.1'
+        if i % sweep_every == 0:
+            t = time.perf_counter()
+            cache.sweep()
+            max_pause = max(max_pause, time.perf_counter() - t)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return ops / elapsed, peak, max_pause
+
+
+def main():
+    parser = argparse.ArgumentParser(description='LRUCache 微基准测试')
+    parser.add_argument('--ops', type=int, default=300000, help='操作次数')
+    parser.add_argument('--keys', type=int, default=20000, help='不同键的数量')
+    parser.add_argument('--timeout', type=float, default=300, help='缓存超时秒数')
+    parser.add_argument('--sweep-every', type=int, default=10000,
+                        help='每隔多少次操作调用一次 sweep()')
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    print('{0:<10}{1:>14}{2:>14}{3:>16}'.format(
+        'cache', 'ops/s', 'peak KB', 'max sweep ms'))
+    for name, cache in (
+            ('legacy', LegacyLRUCache(timeout=args.timeout)),
+            ('current', lru_cache.LRUCache(timeout=args.timeout,
+                                           max_entries=args.keys))):
+        rate, peak, pause = run(cache, args.ops, args.keys, args.sweep_every)
+        print('{0:<10}{1:>14.0f}{2:>14.0f}{3:>16.3f}'.format(
+            name, rate, peak / 1024, pause * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+'''
+空闲隧道的内存基准测试。
+
+在一个进程中用selector引擎建立count条隧道，停在连接已经建立、没有数据的状态，
+用tracemalloc测量每条空闲隧道占用的Python堆内存。测试代码自己的套接字对（本地一侧）在测量开始前创建，
+不计算在内；内核的套接字缓冲区和PyCryptodome在C代码中分配的加密状态也不在tracemalloc的统计范围内。
+
+    python bench_memory.py [--tunnels N] [--check]
+
+--check时与BUDGET比较，超过预算就以非零状态退出，test_relay.py用它防止每条隧道的内存变大。
+'''
+
+import argparse
+import gc
+import logging
+import os
+import sys
+import time
+import tracemalloc
+from selectors import EVENT_READ
+from socket import socket, socketpair
+
+import client_connection
+import server_connection
+from common import make_shadow_head
+from encypt import CyptorFactory
+
+# 每条空闲隧道的内存预算（字节）。Python 3.11上实测客户端和服务器都约1800字节，
+# 预算留出一些余量；为每个连接创建闭包的旧实现约3500字节
+BUDGET = {
+    'client': 2048,
+    'server': 2048,
+}
+
+PASSWORD = b'bench-memory'
+
+
+def run_until(module, cond, timeout=10):
+    '''
+    运行模块的事件循环，直到cond()为真。
+    '''
+    end = time.monotonic() + timeout
+    while not cond():
+        if time.monotonic() > end:
+            raise RuntimeError('隧道没有在{0}秒内建立'.format(timeout))
+        for key, mask in module.selector.select(0.01):
+            key.data(key, mask)
+        module.timers.update_time()
+        module.timers.run_due()
+
+
+def start_listener(module, accepted):
+    '''
+    在模块的事件循环中监听一个端口，接受的连接只保存文件描述符，不创建套接字对象。
+    '''
+    listener = socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1024)
+    listener.setblocking(False)
+
+    def on_accept(key, mask):
+        while True:
+            try:
+                fd, _ = listener._accept()
+            except BlockingIOError:
+                return
+            accepted.append(fd)
+
+    module.selector.register(listener, EVENT_READ, on_accept)
+    return listener
+
+
+def measure(module, count, start_tunnel):
+    '''
+    用start_tunnel(i)建立count条隧道，返回每条空闲隧道占用的字节数。
+    '''
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    conns = [start_tunnel(i) for i in range(count)]
+    established = module.Connection.S_ESTABLISHED
+    run_until(module, lambda: all(conn.state == established
+                                  for conn in conns))
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    for conn in conns:
+        conn.destory()
+    return (after - before) / count
+
+
+def measure_client(count):
+    '''
+    客户端：本地发来CONNECT请求，连接隧道服务器后发送Shadow头。
+    '''
+    accepted = []
+    listener = start_listener(client_connection, accepted)
+    server_addr = listener.getsockname()
+    factory = CyptorFactory('aes-256-cfb', PASSWORD)
+    pairs = [socketpair() for _ in range(count)]
+    for local, peer in pairs:
+        local.setblocking(False)
+        peer.send(b'CONNECT 127.0.0.1:443 HTTP/1.1\r\n\r\n')
+
+    def start_tunnel(i):
+        return client_connection.Connection(pairs[i][0], ('127.0.0.1', i),
+                                            factory, server_addr)
+
+    try:
+        return measure(client_connection, count, start_tunnel)
+    finally:
+        client_connection.selector.unregister(listener)
+        listener.close()
+        for _, peer in pairs:
+            peer.close()
+        for fd in accepted:
+            os.close(fd)
+
+
+def measure_server(count):
+    '''
+    服务器：隧道客户端发来加密的Shadow头，连接远程服务器。
+    '''
+    accepted = []
+    listener = start_listener(server_connection, accepted)
+    factory = CyptorFactory('aes-256-cfb', PASSWORD)
+    head = make_shadow_head((b'127.0.0.1', listener.getsockname()[1]))
+    pairs = [socketpair() for _ in range(count)]
+    for local, peer in pairs:
+        local.setblocking(False)
+        peer.send(factory.new().cipher(head))
+
+    def start_tunnel(i):
+        return server_connection.Connection(pairs[i][0], ('127.0.0.1', i),
+                                            factory)
+
+    try:
+        return measure(server_connection, count, start_tunnel)
+    finally:
+        server_connection.selector.unregister(listener)
+        listener.close()
+        for _, peer in pairs:
+            peer.close()
+        for fd in accepted:
+            os.close(fd)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='空闲隧道内存基准测试')
+    parser.add_argument('--tunnels', type=int, default=1000,
+                        help='建立的隧道数')
+    parser.add_argument('--check', action='store_true',
+                        help='超过预算时以非零状态退出')
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    results = {
+        'client': measure_client(args.tunnels),
+        'server': measure_server(args.tunnels),
+    }
+
+    failed = False
+    print('{0:<10}{1:>16}{2:>12}'.format('engine', 'bytes/tunnel', 'budget'))
+    for name, size in results.items():
+        print('{0:<10}{1:>16.0f}{2:>12}'.format(name, size, BUDGET[name]))
+        if size > BUDGET[name]:
+            failed = True
+    if args.check and failed:
+        sys.exit('每条空闲隧道占用的内存超过了预算')
+
+
+if __name__ == '__main__':
+    main()
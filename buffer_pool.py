@@ -0,0 +1,79 @@
+'''
+预先分配的缓冲区池。
+
+转发数据时从池中取出一块固定大小的bytearray，用recv_into直接读入，原地加密或解密后发送，
+用完再放回池中。这样每次读写不需要重新分配内存。
+
+连接的输出队列大部分时间是空的。空的输出队列用共享的b''表示，有数据需要排队时才分配bytearray，
+写完之后释放，空闲的连接不为输出队列占用内存。append_queue和consume_queue维护这个约定。
+'''
+
+
+class BufferPool:
+    '''
+    固定大小的bytearray缓冲区池。这个类不是线程安全的。
+    '''
+
+    def __init__(self, size, count=16):
+        self.size = size
+        self.capacity = count
+        self._free = [bytearray(size) for _ in range(count)]
+
+    def acquire(self):
+        '''
+        取出一块缓冲区。池为空时分配一块新的。
+        '''
+        if self._free:
+            return self._free.pop()
+        return bytearray(self.size)
+
+    def release(self, buf):
+        '''
+        归还缓冲区。池已满时直接丢弃。
+        '''
+        if len(self._free) < self.capacity and len(buf) == self.size:
+            self._free.append(buf)
+
+
+def append_queue(queue, data):
+    '''
+    把data追加到输出队列queue的尾部，返回追加后的队列。queue为b''时分配新的bytearray。
+    '''
+    if type(queue) is not bytearray:
+        queue = bytearray(queue)
+    queue += data
+    return queue
+
+
+def consume_queue(queue, n):
+    '''
+    去掉输出队列queue开头的n字节，返回剩下的队列。全部去掉时返回b''，释放缓冲区。
+    '''
+    if n >= len(queue):
+        return b''
+    if type(queue) is not bytearray:
+        queue = bytearray(queue)
+    del queue[:n]
+    return queue
+
+
+def test():
+    queue = append_queue(b'', b'hello')
+    assert type(queue) is bytearray and queue == b'hello'
+    assert append_queue(queue, b' world') is queue
+    queue = consume_queue(queue, 6)
+    assert queue == b'world'
+    assert type(consume_queue(queue, 5)) is bytes
+    assert consume_queue(b'abc', 1) == b'bc'
+
+    pool = BufferPool(16, count=1)
+    a = pool.acquire()
+    b = pool.acquire()
+    assert len(a) == len(b) == 16 and a is not b
+    pool.release(a)
+    pool.release(b)
+    assert pool.acquire() is a
+
+
+if __name__ == '__main__':
+    test()
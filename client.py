@@ -5,24 +5,32 @@ import socket
 import struct
 import sys
 
-import client_connection
-
 def check_python():
     '''
     检查Python版本。
 
-    仅支持Python3.4及以上版本。
+    仅支持Python3.7及以上版本。
     '''
-    if sys.version_info < (3, 4):
-        print('抱歉，仅支持Python 3.4 及以上版本.')
+    if sys.version_info < (3, 7):
+        print('抱歉，仅支持Python 3.7 及以上版本.')
         exit(1)
 
 
+# 下面的模块在导入时就会用到3.7才有的接口，必须先检查版本
+check_python()
+
+import aio_connection
+import client_connection
+import encypt
+import log_queue
+import workers
+
+
 def get_config():
     '''
     返回命令行参数。
 
-    获得本地监听端口，远程主机地址、端口号和密码。加密模式目前只支持aes-256-cfb，可以选择开启Verbose模式。
+    获得本地监听端口，远程主机地址、端口号和密码。加密方法可以从encypt.METHODS中选择，可以选择开启Verbose模式。
     '''
     parser = argparse.ArgumentParser(description='ShadowHTTP 客户端')
     parser.add_argument("-i", "--host", required=True,
@@ -34,25 +42,67 @@ def get_config():
     parser.add_argument("-c", "--password", required=True,
                         help="连接 Shadowhttp 服务器的密码")
     parser.add_argument(
-        "-m", "--method", help="加密方法, 只支持 aes-256-cfb", default="aes-256-cfb")
+        "-m", "--method", choices=sorted(encypt.METHODS),
+        help="加密方法, 默认使用 aes-256-cfb, 与服务器一致", default="aes-256-cfb")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="工作进程数，大于 1 时使用 SO_REUSEPORT 共享监听端口, 默认使用 1")
+    parser.add_argument("-t", "--timeout", type=float, default=300,
+                        help="连接空闲超时秒数, 默认使用 300")
+    parser.add_argument("--connect-timeout", type=float, default=10,
+                        help="连接远程地址的超时秒数, 默认使用 10")
+    parser.add_argument("--recv-size", type=int, default=64 * 1024,
+                        help="每次 recv 最多读取的字节数, 默认使用 65536")
+    parser.add_argument("--batch-size", type=int, default=256 * 1024,
+                        help="每次可读事件最多读取并作为一批加密发送的字节数, 默认使用 262144")
+    parser.add_argument("--pool-size", type=int, default=0,
+                        help="预先建立并保持的到 Shadowhttp 服务器的空闲连接数, 只用于 selector 引擎, 默认使用 0 (不开启)")
+    parser.add_argument("--pool-idle", type=float, default=30,
+                        help="预先建立的连接最多空闲的秒数, 应小于服务器的空闲超时, 默认使用 30")
+    parser.add_argument("--mux", type=int, default=0,
+                        help="到 Shadowhttp 服务器的多路复用会话数, 所有隧道作为流在这些会话中转发, 服务器不支持时自动使用经典模式, 只用于 selector 引擎, 默认使用 0 (不开启)")
+    parser.add_argument("--crypto-threads", type=int, default=0,
+                        help="加密线程数, 较大的一批数据交给线程池加密和解密, 只用于 selector 引擎, 默认使用 0 (在事件循环中加密)")
+    parser.add_argument("--offload-size", type=int, default=64 * 1024,
+                        help="交给加密线程池的一批数据的最小字节数, 默认使用 65536")
+    parser.add_argument("--slow-callback", type=float, default=0,
+                        help="开启事件循环的监控, 记录每个回调的耗时, 超过这个秒数的回调写警告日志, 只用于 selector 引擎, 默认使用 0 (关闭)")
+    parser.add_argument("-e", "--engine", choices=("selector", "asyncio"),
+                        default="selector",
+                        help="事件引擎, selector 或 asyncio (安装了 uvloop 时自动使用), 默认使用 selector")
     parser.add_argument("-v", "--verbose", action="store_true", help="开启日志输出")
+    parser.add_argument("--log-sample", type=int, default=1,
+                        help="开启 -v 时每个连接每 N 次收发数据记录一次日志, 默认使用 1 (全部记录)")
+    parser.add_argument("--metrics-port", type=int, default=0,
+                        help="在 127.0.0.1 的这个端口上提供 Prometheus 格式的运行指标, 多进程模式下工作进程依次使用后面的端口, 只用于 selector 引擎, 默认使用 0 (关闭)")
 
     args = parser.parse_args()
     verbose = args.verbose
 
     # 开启日志输出
     level = logging.DEBUG if verbose else logging.INFO
-    logging.basicConfig(level=level,
-                        format='[%(asctime)s]%(levelname)-s: %(message)s',
-                        datefmt='%H:%M:%S')
+    # 日志由后台线程写出，不会阻塞事件循环
+    log_queue.setup_logging(level,
+                            format='[%(asctime)s]%(levelname)-s: %(message)s',
+                            datefmt='%H:%M:%S')
+
+    if args.workers > 1 and not workers.is_supported():
+        logging.warning("当前平台不支持多进程模式，使用单进程运行")
+        args.workers = 1
 
     return args
 
 
 def main():
-    check_python()
     args = get_config()
-    client_connection.main(args)
+    if args.engine == "asyncio":
+        run = aio_connection.client_main
+    else:
+        run = client_connection.main
+
+    if args.workers > 1:
+        workers.supervise(args.workers, run, args)
+    else:
+        run(args)
 
 
 if __name__ == "__main__":
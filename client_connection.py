@@ -1,12 +1,34 @@
 import logging
 from selectors import EVENT_READ, EVENT_WRITE, DefaultSelector
-from socket import SHUT_WR, SO_REUSEADDR, TCP_NODELAY, socket, SOL_TCP, SOL_SOCKET
-
-from common import (BadHttpHeader, NoAcceptableMethods, make_shadow_head,
-                    parse_http, to_bytes)
-from encypt import aes_256_cfb_Cyptor
+from socket import (SHUT_WR, SO_ERROR, SOL_SOCKET, SOL_TCP, TCP_NODELAY,
+                    socket)
+
+from common import (BadHttpHeader, NoAcceptableMethods, create_listener,
+                    make_shadow_head, parse_http, to_bytes)
+from buffer_pool import BufferPool, append_queue, consume_queue
+from encypt import CyptorFactory, DecipherError
+from crypto_pool import CryptoPool
+from eventloop import LoopMonitor, TimerWheel, run
+from warm_pool import WarmPool
+from metrics import MetricsServer
+import metrics
+import mux
+import workers
 
 selector = DefaultSelector()
+timers = TimerWheel()
+
+# 到隧道服务器的预连接池，没有开启时为None
+warm_pool = None
+
+# 到隧道服务器的多路复用会话池，没有开启时为None
+mux_client = None
+
+# 加密线程池，没有开启时为None
+crypto_pool = None
+
+# 提供运行指标的HTTP服务器，没有开启时为None
+metrics_server = None
 
 
 class Connection:
@@ -22,7 +44,7 @@ class Connection:
     S_REMOTE_CONNECT = 1
 
     # 连接已经建立状态
-    # 等待远程套接字可读，本地套接字可读
+    # 等待远程套接字可读，本地套接字可读。输出队列不为空时还等待对应的套接字可写
     S_ESTABLISHED = 2
 
     statemap = {
@@ -31,11 +53,46 @@ class Connection:
         S_ESTABLISHED: "S_ESTABLISHED"
     }
 
-    BUF_SIZE = 4096
+    # 每次recv最多读取的字节数
+    RECV_SIZE = 64 * 1024
+
+    # 每次可读事件最多读取的字节数。读到的数据作为一批加密，用一次send发出
+    BATCH_SIZE = 256 * 1024
+
+    # 连接空闲超时和远程连接超时的秒数
+    TIMEOUT = 300
+    CONNECT_TIMEOUT = 10
+
+    # 开启加密线程池时，超过这么多字节的一批数据交给线程池处理
+    OFFLOAD_SIZE = 64 * 1024
+
+    # 每个连接每LOG_SAMPLE次收发数据块记录一次DEBUG日志，0表示不记录。
+    # 转发数据时日志只在这里判断一次，没有开启DEBUG日志时不会准备日志的参数
+    LOG_SAMPLE = 0
+
+    # 输出队列的高水位和低水位。
+    # 发往一侧的队列超过高水位时停止读另一侧的套接字，降到低水位以下时恢复。
+    HIGH_WATER = 256 * 1024
+    LOW_WATER = 64 * 1024
 
     count = 0
 
-    def __init__(self, local_sock, local_addr, passwd, remote_addr):
+    # 套接字在连接中的角色，和状态一起决定事件的处理函数
+    LOCAL = 0
+    REMOTE = 1
+
+    # 每条隧道都有一个连接对象，用__slots__代替实例字典。
+    # 连接对象本身注册为两个套接字的回调，事件处理函数是类中的普通方法，按(状态, 角色)查表分派，
+    # 不再为每个连接、每次状态转换创建闭包。
+    __slots__ = ('state', 'local_sock', 'local_addr', 'remote_sock',
+                 'remote_addr', 'dst_addr', 'cryptor', 'upstream_buffer',
+                 'downstream_buffer', 'local_closed', 'remote_closed',
+                 'local_shutdown', 'remote_shutdown', 'local_paused',
+                 'remote_paused', 'local_busy', 'remote_busy', 'destoryed',
+                 'id', 'last_active', 'idle_timer', 'connect_timer',
+                 'chunk_events', 'accept_time', 'state_since')
+
+    def __init__(self, local_sock, local_addr, cyptor_factory, remote_addr):
         '''
         初始化连接的状态。
 
@@ -49,204 +106,575 @@ class Connection:
 
         self.dst_addr = None  # 远程服务器
 
-        self.passwd = passwd
-
-        self.cryptor = aes_256_cfb_Cyptor(to_bytes(passwd))
+        self.cryptor = cyptor_factory.new()
 
+        # 输出队列，空的时候是b''，见buffer_pool.append_queue
         self.upstream_buffer = b''  # 从本地读，向远程写
         self.downstream_buffer = b''  # 从远程读，向本地写
 
-        self.local_closed = False
-        self.remote_closed = False
+        self.local_closed = False  # 本地已经读到EOF
+        self.remote_closed = False  # 远程已经读到EOF
+        self.local_shutdown = False  # 已经关闭本地的写
+        self.remote_shutdown = False  # 已经关闭远程的写
+        self.local_paused = False  # 远程输出队列过长，暂停读本地
+        self.remote_paused = False  # 本地输出队列过长，暂停读远程
+        self.local_busy = False  # 本地读到的一批数据正在加密线程池中处理
+        self.remote_busy = False  # 远程读到的一批数据正在加密线程池中处理
+        self.destoryed = False
+        self.chunk_events = 0  # 收发数据块的次数，用于日志采样
         self.id = Connection.count
         Connection.count = Connection.count + 1
 
+        # 空闲定时器不会在每次读写时重新设置，只记录最后活动的时间，到期时再检查
+        self.last_active = timers.now
+        self.idle_timer = timers.call_later(self.TIMEOUT, self._on_idle_timeout)
+        self.connect_timer = None
+
+        # 接受连接的时间，收到隧道服务器的第一个字节后设为None
+        self.accept_time = timers.now
+        self.state_since = timers.now  # 进入当前状态的时间
+        connections_total.inc()
+
         self.update_state(self.S_INIT)
 
-    def update_state(self, new_state):
+    def __call__(self, key, mask):
         '''
-        更新连接的状态。
-
-        对每一个状态，为套接字注册相应的回调函数。
+        套接字事件的回调函数，按照当前状态和套接字的角色调用handlers中的处理函数。
         '''
+        # 同一批事件中前面的事件已经销毁了连接，这个事件属于已经关闭的套接字
+        if self.destoryed:
+            return
+        role = self.LOCAL if key.fileobj is self.local_sock else self.REMOTE
+        self.handlers[self.state, role](self, mask)
 
-        def init_on_local_read(key, mask):
-            data = self.local_sock.recv(1024)
-
-            # 如果本地套接字提前终止，就销毁这个连接
-            if not data:
-                logging.warning("[{0}]远程连接{1}:{2}提前终止".format(
-                    self.id, self.remote_addr[0], self.remote_addr[1]))
-                self.destory()
-                return
-
-            # 将已读到的内容加入缓冲区
-            self.upstream_buffer += data
+    def event_handler(self, key):
+        '''
+        返回处理这个套接字事件的函数，供eventloop.LoopMonitor按处理函数统计耗时。
+        '''
+        role = self.LOCAL if key.fileobj is self.local_sock else self.REMOTE
+        return self.handlers[self.state, role]
 
-            # 如果读到完整的HTTP请求，就解析它，获得远程地址和端口。
-            # 尝试连接远程套接字，并转换到等待远程连接状态。
-            if b'\r\n\r\n' in self.upstream_buffer:
-                try:
-                    self.dst_addr = parse_http(
-                        self.upstream_buffer)  # (ip_addr, port)
-                    logging.info("[{0}]本地请求连接到 {1}:{2}".format(
-                        self.id, self.dst_addr[0].decode('utf-8'),
-                        self.dst_addr[1]))
-                    self.remote_sock = socket()
-                    self.remote_sock.setblocking(False)
-                    self.remote_sock.setsockopt(SOL_TCP, TCP_NODELAY, 1)
-                    try:
-                        self.remote_sock.connect(
-                            self.remote_addr)  # 这里是从终端输入的地址
-                    except BlockingIOError:
-                        logging.debug("[{0}]尝试非阻塞连接服务器".format(self.id))
-
-                    self.upstream_buffer = b''
-                    self.update_state(self.S_REMOTE_CONNECT)
-
-                # 如果解析失败就销毁这个连接
-                except BadHttpHeader:
-                    logging.error("[{0}]解析本地连接隧道请求失败：非HTTP头部".format(self.id))
-                    self.destory()
-                except NoAcceptableMethods:
-                    logging.error("[{0}]解析本地连接隧道头请求失败：不支持的HTTP请求方法".format(
-                        self.id))
-                    self.destory()
-
-        def rconn_on_local_read(key, mask):
-            '''
-            本地可读，说明本地出现了错误，此时销毁这个连接。
-            '''
-            _ = self.local_sock.recv(1024)
-            logging.debug("[{0}]本地连接{1}:{2}提前断开连接".format(
+    def init_on_local_read(self, mask):
+        try:
+            data = self.local_sock.recv(self.RECV_SIZE)
+        except BlockingIOError:
+            return
+        except ConnectionError:
+            logging.error("[{0}]连接已经被 {1}:{2} 重置".format(
                 self.id, self.local_addr[0], self.local_addr[1]))
+            self.destory()
+            return
 
+        # 如果本地套接字提前终止，就销毁这个连接
+        if not data:
+            logging.warning("[{0}]远程连接{1}:{2}提前终止".format(
+                self.id, self.remote_addr[0], self.remote_addr[1]))
             self.destory()
+            return
 
-        def rconn_on_remote_write(key, mask):
-            '''
-            远程套接字变为可写，说明连接已经建立
-            '''
-            shadow_head = make_shadow_head(self.dst_addr)
-            # 加密shadow协议头
-            c_head = self.cryptor.cipher(shadow_head)
+        # 将已读到的内容加入缓冲区
+        self.upstream_buffer = append_queue(self.upstream_buffer, data)
 
+        # 如果读到完整的HTTP请求，就解析它，获得远程地址和端口。
+        # 尝试连接远程套接字，并转换到等待远程连接状态。
+        end = self.upstream_buffer.find(b'\r\n\r\n')
+        if end >= 0:
             try:
-                self.remote_sock.send(c_head)
+                self.dst_addr = parse_http(
+                    bytes(self.upstream_buffer))  # (ip_addr, port)
+                logging.info("[{0}]本地请求连接到 {1}:{2}".format(
+                    self.id, self.dst_addr[0].decode('utf-8'),
+                    self.dst_addr[1]))
+                # HTTP头之后的内容等连接建立后和Shadow头一起发送
+                self.upstream_buffer = consume_queue(self.upstream_buffer,
+                                                     end + 4)
+
+                # 有已经协商好的多路复用会话时，作为会话中的一条流转发
+                if mux_client is not None and mux_client.ready():
+                    logging.debug("[%s]使用多路复用会话", self.id)
+                    self._hand_over()
+                    mux_client.open_stream(
+                        self.local_sock, self.local_addr,
+                        make_shadow_head(self.dst_addr),
+                        bytes(self.upstream_buffer))
+                    return
+
+                # 预连接池中有已经建立的连接时直接使用，立刻发送Shadow头
+                if warm_pool is not None:
+                    self.remote_sock = warm_pool.acquire()
+                if self.remote_sock:
+                    logging.debug("[%s]使用预先建立的连接", self.id)
+                    self._on_remote_connected()
+                    return
 
-            # 连接失败，此时发送会失败
-            except ConnectionError:
-                logging.debug("[{0}]远程连接{1}:{2}失败".format(
-                    self.id, self.remote_addr[0], self.remote_addr[1]))
+                self.remote_sock = socket()
+                self.remote_sock.setblocking(False)
+                self.remote_sock.setsockopt(SOL_TCP, TCP_NODELAY, 1)
+                try:
+                    self.remote_sock.connect(
+                        self.remote_addr)  # 这里是从终端输入的地址
+                except BlockingIOError:
+                    logging.debug("[%s]尝试非阻塞连接服务器", self.id)
+                self.update_state(self.S_REMOTE_CONNECT)
+
+            # 如果解析失败就销毁这个连接
+            except BadHttpHeader:
+                logging.error("[{0}]解析本地连接隧道请求失败：非HTTP头部".format(self.id))
+                self.destory()
+            except NoAcceptableMethods:
+                logging.error("[{0}]解析本地连接隧道头请求失败：不支持的HTTP请求方法".format(
+                    self.id))
                 self.destory()
-                return
 
-            logging.info("[{0}]远程地址{1}:{2}连接成功...".format(
-                self.id, self.remote_addr[0], self.remote_addr[1]))
+    def rconn_on_local_read(self, mask):
+        '''
+        本地可读，说明本地出现了错误，此时销毁这个连接。
+        '''
+        try:
+            self.local_sock.recv(self.RECV_SIZE)
+        except BlockingIOError:
+            return
+        except ConnectionError:
+            pass
+        logging.debug("[%s]本地连接%s:%s提前断开连接", self.id, self.local_addr[0],
+                      self.local_addr[1])
+
+        self.destory()
+
+    def rconn_on_remote_write(self, mask):
+        '''
+        远程套接字变为可写，说明连接已经建立
+        '''
+        err = self.remote_sock.getsockopt(SOL_SOCKET, SO_ERROR)
+        if err:
+            logging.debug("[%s]远程连接%s:%s失败", self.id, self.remote_addr[0],
+                          self.remote_addr[1])
+            connect_errors.inc()
+            self.destory()
+            return
+        connect_seconds.observe(timers.now - self.state_since)
+
+        logging.info("[{0}]远程地址{1}:{2}连接成功...".format(
+            self.id, self.remote_addr[0], self.remote_addr[1]))
+        self._on_remote_connected()
 
-            #向本地套接字发送HTTP回复
-            self.local_sock.send(
+    def _on_remote_connected(self):
+        '''
+        到隧道服务器的连接已经建立，发送Shadow头并回复本地
+        '''
+        # 加密shadow协议头，和已经缓存的数据一起发送
+        shadow_head = make_shadow_head(self.dst_addr)
+        c_head = self.cryptor.cipher(shadow_head + bytes(self.upstream_buffer))
+        self.upstream_buffer = b''
+
+        self.update_state(self.S_ESTABLISHED)
+        self._send_to_sock(self.remote_sock, c_head)
+        logging.debug("[%s]向远程服务器发送%s:%s %s字节Shadow头", self.id,
+                      self.remote_addr[0], self.remote_addr[1], len(c_head))
+
+        #向本地套接字发送HTTP回复
+        if not self.destoryed:
+            self._send_to_sock(
+                self.local_sock,
                 b'HTTP/1.1 200 Connection Established\r\n\r\n')
 
-            logging.debug("[{0}]向远程服务器发送{1}:{2} {3}字节Shadow头".format(
-                self.id, self.remote_addr[0], self.remote_addr[1],
-                len(c_head)))
-            self.update_state(self.S_ESTABLISHED)
+    def establised_on_local_event(self, mask):
+        if mask & EVENT_WRITE:
+            self._flush(self.local_sock)
+        if mask & EVENT_READ and not self.destoryed:
+            self.establised_on_local_read()
 
-        def establised_on_local_read(key, mask):
-            '''
-            本地可读，读入之后加密，写入远程套接字
-            '''
-            data = self._recv_from_sock(self.local_sock)
+    def establised_on_remote_event(self, mask):
+        if mask & EVENT_WRITE:
+            self._flush(self.remote_sock)
+        if mask & EVENT_READ and not self.destoryed:
+            self.establised_on_remote_read()
 
-            if data is None:
+    def establised_on_local_read(self):
+        '''
+        本地可读，读入一批数据之后原地加密，写入远程套接字
+        '''
+        buf = buffer_pool.acquire()
+        result = self._recv_from_sock(self.local_sock, buf)
+        if result is None:
+            buffer_pool.release(buf)
+            return
+        n, eof = result
+        self._process_batch(self.local_sock, self.cryptor.cipher_batch, buf,
+                            n, eof, self._on_local_ciphered)
+
+    def _on_local_ciphered(self, buf, eof, result, error):
+        '''
+        一批本地数据加密完成，写入远程套接字
+        '''
+        busy, self.local_busy = self.local_busy, False
+        try:
+            if self.destoryed:
+                return
+            if error is not None:
+                self._on_crypto_error(error)
                 return
 
-            if not data:  #b''
-                logging.info("[{0}]本地关闭连接".format(self.id))
-                if self.remote_closed == True:
-                    self.destory()
-                    return
-                self.remote_sock.shutdown(SHUT_WR)
-                selector.unregister(self.local_sock)
+            if result:
+                prefix, data = result
+                self._send_to_sock(self.remote_sock, data, prefix)
+                if self.LOG_SAMPLE and self._sample_chunk():
+                    logging.debug("[%s]向远程服务器%s:%s发送%s字节数据", self.id,
+                                  self.remote_addr[0], self.remote_addr[1],
+                                  len(prefix) + len(data))
 
+            if eof and not self.destoryed:
+                logging.info("[{0}]本地关闭连接".format(self.id))
                 self.local_closed = True
-                return
+                self._update_events()
+            elif busy and not self.destoryed:
+                self._update_events()
+        finally:
+            buffer_pool.release(buf)
 
-            ciphered = self.cryptor.cipher(data)
-            self.remote_sock.send(ciphered)
-            logging.debug("[{0}]向远程服务器{1}:{2}发送{3}字节数据".format(
-                self.id, self.remote_addr[0], self.remote_addr[1],
-                len(ciphered)))
+    def establised_on_remote_read(self):
+        '''
+        远程可读，读入一批数据之后原地解密，写入本地套接字
+        '''
+        buf = buffer_pool.acquire()
+        result = self._recv_from_sock(self.remote_sock, buf)
 
-        def establised_on_remote_read(key, mask):
-            '''
-            远程可读，读入之后解密，写入本地套接字
-            '''
-            data = self._recv_from_sock(self.remote_sock)
+        # 出现异常，已经被销毁
+        if result is None:
+            buffer_pool.release(buf)
+            return
+        n, eof = result
+        self._process_batch(self.remote_sock, self.cryptor.decipher_into, buf,
+                            n, eof, self._on_remote_deciphered)
 
-            # 出现异常，已经被销毁
-            if data is None:
+    def _on_remote_deciphered(self, buf, eof, deciphered, error):
+        '''
+        一批远程数据解密完成，写入本地套接字
+        '''
+        busy, self.remote_busy = self.remote_busy, False
+        try:
+            if self.destoryed:
                 return
+            if error is not None:
+                self._on_crypto_error(error)
+                return
+
+            if deciphered:
+                self._send_to_sock(self.local_sock, deciphered)
+                if self.LOG_SAMPLE and self._sample_chunk():
+                    logging.debug("[%s]向本地服务器%s:%s发送%s字节数据", self.id,
+                                  self.local_addr[0], self.local_addr[1],
+                                  len(deciphered))
 
-            if not data:
+            if eof and not self.destoryed:
                 logging.info("[{0}]远程服务器关闭连接".format(self.id))
-                if self.local_closed == True:
-                    self.destory()
-                    return
-                self.local_sock.shutdown(SHUT_WR)
-                selector.unregister(self.remote_sock)
                 self.remote_closed = True
-                return
+                self._update_events()
+            elif busy and not self.destoryed:
+                self._update_events()
+        finally:
+            buffer_pool.release(buf)
+
+    # (状态, 套接字的角色) -> 事件处理函数
+    handlers = {
+        (S_INIT, LOCAL): init_on_local_read,
+        (S_REMOTE_CONNECT, LOCAL): rconn_on_local_read,
+        (S_REMOTE_CONNECT, REMOTE): rconn_on_remote_write,
+        (S_ESTABLISHED, LOCAL): establised_on_local_event,
+        (S_ESTABLISHED, REMOTE): establised_on_remote_event,
+    }
 
-            deciphered = self.cryptor.decipher(data)
-            x = self.local_sock.send(deciphered)
-            logging.debug("[{0}]向本地服务器{1}:{2}发送{3}字节数据".format(
-                self.id, self.local_addr[0], self.local_addr[1], x))
+    def update_state(self, new_state):
+        '''
+        更新连接的状态。
 
+        对每一个状态，为套接字注册关注的事件，事件的处理函数由handlers决定。
+        '''
         if new_state == self.state:
             return
 
         if new_state == self.S_INIT:  #注册新的事件
-            selector.register(self.local_sock, EVENT_READ, init_on_local_read)
+            self._set_events(self.local_sock, EVENT_READ)
+
+        elif new_state == self.S_REMOTE_CONNECT:  #注册远程事件
+            self._set_events(self.local_sock, EVENT_READ)
+            self._set_events(self.remote_sock, EVENT_WRITE)
+
+        if new_state == self.S_REMOTE_CONNECT:
+            self.connect_timer = timers.call_later(self.CONNECT_TIMEOUT,
+                                                   self._on_connect_timeout)
+        elif self.connect_timer:
+            self.connect_timer.cancel()
+            self.connect_timer = None
+
+        if self.state is not None:
+            tunnel_gauges[self.state].dec()
+        tunnel_gauges[new_state].inc()
+        self.state = new_state
+        self.state_since = timers.now
+        logging.debug("[%s]切换到状态%s", self.id, self.statemap[self.state])
 
-        elif new_state == self.S_REMOTE_CONNECT:  #修改本地事件处理函数 注册远程事件处理函数
-            selector.modify(self.local_sock, EVENT_READ, rconn_on_local_read)
-            selector.register(self.remote_sock, EVENT_WRITE,
-                              rconn_on_remote_write)
+        if new_state == self.S_ESTABLISHED:
+            self._update_events()
 
-        elif new_state == self.S_ESTABLISHED:
-            selector.modify(self.local_sock, EVENT_READ,
-                            establised_on_local_read)
-            selector.modify(self.remote_sock, EVENT_READ,
-                            establised_on_remote_read)
+    def _on_idle_timeout(self):
+        '''
+        空闲定时器到期。如果期间有过读写，就按剩余的时间重新设置定时器。
+        '''
+        idle = timers.now - self.last_active
+        if idle >= self.TIMEOUT:
+            logging.info("[{0}]连接空闲超时".format(self.id))
+            self.destory()
+        else:
+            self.idle_timer = timers.call_later(self.TIMEOUT - idle,
+                                                self._on_idle_timeout)
 
-        self.state = new_state
-        logging.debug("[{0}]切换到状态{1}".format(self.id,
-                                             self.statemap[self.state]))
+    def _on_connect_timeout(self):
+        logging.info("[{0}]远程连接{1}:{2}超时".format(
+            self.id, self.remote_addr[0], self.remote_addr[1]))
+        connect_timeouts.inc()
+        self.destory()
 
-    def _recv_from_sock(self, sock):
+    def _set_events(self, sock, events):
+        '''
+        修改套接字在事件循环中关注的事件。没有关注的事件时解除注册。
+        '''
+        try:
+            key = selector.get_key(sock)
+        except KeyError:
+            if events:
+                selector.register(sock, events, self)
+            return
+
+        if not events:
+            selector.unregister(sock)
+        elif key.events != events:
+            selector.modify(sock, events, self)
+
+    def _update_events(self):
+        '''
+        连接建立后，根据输出队列和关闭状态重新计算两个套接字关注的事件。
+
+        一侧读到EOF并且发往另一侧的数据已经写完，就关闭另一侧的写。两个方向都关闭后销毁连接。
+        '''
+        try:
+            if self.local_closed and not self.remote_shutdown and \
+                    not self.upstream_buffer:
+                self.remote_sock.shutdown(SHUT_WR)
+                self.remote_shutdown = True
+            if self.remote_closed and not self.local_shutdown and \
+                    not self.downstream_buffer:
+                self.local_sock.shutdown(SHUT_WR)
+                self.local_shutdown = True
+        except OSError:
+            self.destory()
+            return
+
+        if self.local_shutdown and self.remote_shutdown:
+            self.destory()
+            return
+
+        # 高水位暂停读，低水位恢复读
+        if len(self.upstream_buffer) >= self.HIGH_WATER:
+            self.local_paused = True
+        elif len(self.upstream_buffer) <= self.LOW_WATER:
+            self.local_paused = False
+        if len(self.downstream_buffer) >= self.HIGH_WATER:
+            self.remote_paused = True
+        elif len(self.downstream_buffer) <= self.LOW_WATER:
+            self.remote_paused = False
+
+        local_events = 0
+        if not self.local_closed and not self.local_paused and \
+                not self.local_busy:
+            local_events |= EVENT_READ
+        if self.downstream_buffer:
+            local_events |= EVENT_WRITE
+        self._set_events(self.local_sock, local_events)
+
+        remote_events = 0
+        if not self.remote_closed and not self.remote_paused and \
+                not self.remote_busy:
+            remote_events |= EVENT_READ
+        if self.upstream_buffer:
+            remote_events |= EVENT_WRITE
+        self._set_events(self.remote_sock, remote_events)
+
+    def _process_batch(self, sock, func, buf, n, eof, done):
+        '''
+        对从sock读到的一批数据调用func加密或者解密，然后调用done(buf, eof, 结果, 异常)。
+
+        超过OFFLOAD_SIZE并且开启了加密线程池时，交给线程池处理，完成后在事件循环中调用done。
+        处理期间暂停读sock，所以同一个方向上的数据仍然按顺序加密和发送。
+        '''
+        view = memoryview(buf)[:n]
+        if n >= self.OFFLOAD_SIZE and crypto_pool is not None:
+            if sock == self.local_sock:
+                self.local_busy = True
+            else:
+                self.remote_busy = True
+            self._update_events()
+            crypto_pool.submit(
+                func, view,
+                lambda result, error: done(buf, eof, result, error))
+            return
+
+        try:
+            result = func(view) if n else None
+        except DecipherError as e:
+            done(buf, eof, None, e)
+            return
+        done(buf, eof, result, None)
+
+    def _on_crypto_error(self, error):
+        if isinstance(error, DecipherError):
+            logging.error("[{0}]解密失败，数据可能被篡改或者密码不一致".format(self.id))
+        else:
+            logging.error("[{0}]加密线程出错: {1}".format(self.id, error))
+        self.destory()
+
+    def _send_to_sock(self, sock, data, prefix=b''):
+        '''
+        向套接字写数据。prefix（如初始向量）会和data一起用sendmsg发送，不需要先拼接。
+
+        输出队列为空时直接发送，写不完的部分复制到输出队列，等待套接字可写时再发送。
+        所以调用返回后data所在的缓冲区就可以重用。
+        '''
+        if sock == self.local_sock:
+            buf = self.downstream_buffer
+        else:
+            buf = self.upstream_buffer
+
+        # Windows没有sendmsg，只能拼接后发送
+        if prefix and not hasattr(sock, 'sendmsg'):
+            data = prefix + bytes(data)
+            prefix = b''
+
+        if not buf:
+            try:
+                if prefix:
+                    n = sock.sendmsg([prefix, data])
+                else:
+                    n = sock.send(data)
+            except BlockingIOError:
+                n = 0
+            except OSError as e:
+                logging.error("[{0}]发送数据失败: {1}".format(self.id, e))
+                self.destory()
+                return
+            if n < len(prefix):
+                prefix = prefix[n:]
+            else:
+                n -= len(prefix)
+                prefix = b''
+                if n == len(data):
+                    return
+                data = data[n:]
+
+        buf = append_queue(buf, prefix)
+        buf += data
+        if sock == self.local_sock:
+            self.downstream_buffer = buf
+        else:
+            self.upstream_buffer = buf
+        self._update_events()
+
+    def _flush(self, sock):
+        '''
+        套接字可写时，尽量写出输出队列中的数据。
+        '''
+        if sock == self.local_sock:
+            buf = self.downstream_buffer
+        else:
+            buf = self.upstream_buffer
+
+        try:
+            n = sock.send(buf)
+        except BlockingIOError:
+            n = 0
+        except OSError as e:
+            logging.error("[{0}]发送数据失败: {1}".format(self.id, e))
+            self.destory()
+            return
+
+        if n:
+            self.last_active = timers.now
+        # 写完之后释放输出队列的缓冲区
+        buf = consume_queue(buf, n)
+        if sock == self.local_sock:
+            self.downstream_buffer = buf
+        else:
+            self.upstream_buffer = buf
+        self._update_events()
+
+    def _recv_from_sock(self, sock, buf):
+        '''
+        从套接字读数据到buf中，直到没有数据可读、读到EOF或者填满buf。
+
+        每次recv最多读RECV_SIZE字节。返回(读到的字节数, 是否读到EOF)，
+        出现异常时销毁连接并返回None。
+        '''
         if sock == self.local_sock:
             addr = self.local_addr
         else:
             addr = self.remote_addr
 
+        view = memoryview(buf)
+        size = len(buf)
+        n = 0
+        eof = False
         try:
-            data = sock.recv(4086)
+            while n < size:
+                want = min(size - n, self.RECV_SIZE)
+                try:
+                    r = sock.recv_into(view[n:], want)
+                except BlockingIOError:
+                    break
+                if not r:
+                    eof = True
+                    break
+                n += r
+                # 没有读满，说明内核缓冲区已经读空，不必再调用一次recv等待EAGAIN
+                if r < want:
+                    break
 
         # 接受时被对方重置连接
-        except (ConnectionResetError, ConnectionAbortedError):
+        except ConnectionError:
             logging.error("[{0}]连接已经被 {1}:{2} 重置".format(
                 self.id, addr[0], addr[1]))
             self.destory()
             return
 
-        else:
-            # 读到EOF时不写日志
-            if data:
-                logging.debug("[{0}]从 {1}:{2} 收到{3}字节数据".format(
-                    self.id, addr[0], addr[1], len(data)))
-            return data
+        # 读到EOF时不写日志
+        if n:
+            self.last_active = timers.now
+            if sock is self.local_sock:
+                upstream_bytes.inc(n)
+            else:
+                downstream_bytes.inc(n)
+                if self.accept_time is not None:
+                    first_byte_seconds.observe(timers.now - self.accept_time)
+                    self.accept_time = None
+            if self.LOG_SAMPLE and self._sample_chunk():
+                logging.debug("[%s]从 %s:%s 收到%s字节数据", self.id, addr[0],
+                              addr[1], n)
+        return n, eof
+
+    def _sample_chunk(self):
+        '''
+        这一次收发数据块是否记录日志。每个连接记录第一次，之后每LOG_SAMPLE次记录一次。
+        '''
+        self.chunk_events += 1
+        return (self.chunk_events - 1) % self.LOG_SAMPLE == 0
+
+    def _hand_over(self):
+        '''
+        把本地套接字交给多路复用会话。连接对象不再使用，但是不关闭套接字。
+        '''
+        self.destoryed = True
+        tunnel_gauges[self.state].dec()
+        self.idle_timer.cancel()
+        selector.unregister(self.local_sock)
 
     def destory(self):
         '''
@@ -254,10 +682,17 @@ class Connection:
 
         分别销毁对应的套接字。并在事件循环中删除。
         '''
+        if self.destoryed:
+            return
+        self.destoryed = True
+        tunnel_gauges[self.state].dec()
         logging.info("[{0}]连接已被销毁".format(self.id))
 
-        # 由于之前可能会提前解除注册.. 这里捕获这个异常。
-        # TODO: 重构关闭和解除注册的逻辑
+        self.idle_timer.cancel()
+        if self.connect_timer:
+            self.connect_timer.cancel()
+
+        # 套接字可能因为暂时没有关注的事件而没有注册，这里捕获这个异常。
         if self.local_sock:
             try:
                 selector.unregister(self.local_sock)
@@ -273,10 +708,40 @@ class Connection:
             self.remote_sock.close()
 
 
+# 转发数据用的缓冲区池，每块缓冲区在一次读写回调中取出并归还
+buffer_pool = BufferPool(Connection.BATCH_SIZE)
+
+# 运行指标，见metrics.py。连接中用到的子指标预先取出，更新时不再按标签查找
+connections_total = metrics.registry.counter(
+    'shadow_client_connections_total', '接受的本地连接数').labels()
+tunnels = metrics.registry.gauge('shadow_client_tunnels', '各个状态的隧道数',
+                                 ('state',))
+tunnel_gauges = [tunnels.labels(Connection.statemap[state])
+                 for state in sorted(Connection.statemap)]
+relayed_bytes = metrics.registry.counter(
+    'shadow_client_bytes_total',
+    '收到的字节数，upstream是来自本地的数据，downstream是来自隧道服务器的密文',
+    ('direction',))
+upstream_bytes = relayed_bytes.labels('upstream')
+downstream_bytes = relayed_bytes.labels('downstream')
+connect_failures = metrics.registry.counter(
+    'shadow_client_connect_failures_total', '连接隧道服务器失败的隧道数',
+    ('reason',))
+connect_errors = connect_failures.labels('error')
+connect_timeouts = connect_failures.labels('timeout')
+connect_seconds = metrics.registry.histogram(
+    'shadow_client_connect_seconds',
+    '连接隧道服务器的秒数，不包括使用预连接池和多路复用的隧道').labels()
+first_byte_seconds = metrics.registry.histogram(
+    'shadow_client_first_byte_seconds',
+    '从接受本地连接到收到隧道服务器第一个字节的秒数').labels()
+
+
 def on_new_conn(args):
 
     server_addr = args.host, args.port
-    passwd = args.password
+    # 这个监听端口上所有连接共用的加密器工厂，密钥只生成一次
+    cyptor_factory = CyptorFactory(args.method, to_bytes(args.password))
 
     def on_accept(key, mask):
         '''
@@ -285,26 +750,70 @@ def on_new_conn(args):
         建立一个新连接对象，并在连接表中注册。
         '''
         new_socket, addr = key.fileobj.accept()
-        Connection(new_socket, addr, passwd, server_addr)
-        logging.debug("建立新的连接请求，本地{0}:{1}".format(addr[0], addr[1]))
+        # 转发时会循环读到没有数据为止，必须是非阻塞套接字
+        new_socket.setblocking(False)
+        Connection(new_socket, addr, cyptor_factory, server_addr)
+        logging.debug("建立新的连接请求，本地%s:%s", addr[0], addr[1])
 
     return on_accept
 
 
+def reset_loop():
+    '''
+    重新创建事件循环。
+
+    工作进程由fork产生，会继承父进程的selector。每个进程需要有自己的epoll实例，
+    否则各进程注册的套接字会混在一起。
+    '''
+    global selector, timers
+    selector.close()
+    selector = DefaultSelector()
+    timers = TimerWheel()
+
+
 def main(args):
-    sock = socket()
-    sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-    sock.bind(('', args.local))
-    sock.listen(5)
+    global buffer_pool, warm_pool, mux_client, crypto_pool, metrics_server
+    if args.workers > 1:
+        reset_loop()
+
+    Connection.RECV_SIZE = args.recv_size
+    Connection.BATCH_SIZE = args.batch_size
+    Connection.TIMEOUT = args.timeout
+    Connection.CONNECT_TIMEOUT = args.connect_timeout
+    Connection.OFFLOAD_SIZE = args.offload_size
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        Connection.LOG_SAMPLE = args.log_sample
+    mux.Stream.TIMEOUT = args.timeout
+    buffer_pool = BufferPool(args.batch_size)
+    if args.crypto_threads > 0:
+        crypto_pool = CryptoPool(selector, args.crypto_threads)
+    if args.pool_size > 0:
+        warm_pool = WarmPool(selector, timers, (args.host, args.port),
+                             args.pool_size, args.pool_idle)
+    if args.mux > 0:
+        mux_client = mux.MuxClient(selector, timers, (args.host, args.port),
+                                   CyptorFactory(args.method,
+                                                 to_bytes(args.password)),
+                                   args.mux)
+    if args.metrics_port > 0:
+        # 多进程模式下每个工作进程的指标在各自的端口上，端口号加上工作进程的编号
+        metrics_server = MetricsServer(
+            selector, timers, args.metrics_port + (workers.worker_index or 0))
+        logging.info("运行指标: http://{0}:{1}/metrics".format(
+            *metrics_server.address))
+
+    # 开启事件循环的监控时，记录每个回调的耗时，超过阈值的写警告日志
+    monitor = None
+    if args.slow_callback > 0:
+        monitor = LoopMonitor(metrics.registry, 'shadow_client',
+                              args.slow_callback)
+
+    sock = create_listener(args.local, reuse_port=args.workers > 1)
 
     on_accept = on_new_conn(args)  # 设定当新连接到来时触发的事件
     selector.register(sock, EVENT_READ, on_accept)  #注册事件
     try:
-        while True:
-            events = selector.select()  # 程序会在这里阻塞等待事件发生
-            for key, mask in events:
-                callback = key.data
-                callback(key, mask)
+        run(selector, timers, monitor)  # 程序会在这里阻塞等待事件发生
 
     except KeyboardInterrupt:
         sock.close()
@@ -318,5 +827,19 @@ if __name__ == "__main__":
             self.host = '127.0.0.1'
             self.port = 8888
             self.password = '1234567'
+            self.method = 'aes-256-cfb'
+            self.workers = 1
+            self.recv_size = 64 * 1024
+            self.batch_size = 256 * 1024
+            self.timeout = 300
+            self.connect_timeout = 10
+            self.crypto_threads = 0
+            self.offload_size = 64 * 1024
+            self.pool_size = 0
+            self.pool_idle = 30
+            self.mux = 0
+            self.log_sample = 1
+            self.metrics_port = 0
+            self.slow_callback = 0
 
     main(Data())
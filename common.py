@@ -1,4 +1,6 @@
-from socket import AF_INET, AF_INET6, inet_pton, inet_ntop
+from socket import (AF_INET, AF_INET6, SO_REUSEADDR, SOL_SOCKET, inet_ntop,
+                    inet_pton, socket)
+import socket as _socket
 import struct
 
 def compat_ord(s):
@@ -38,6 +40,22 @@ def is_ip(address):
     return False
 
 
+def create_listener(port, reuse_port=False):
+    '''
+    创建监听套接字。
+
+    多进程模式下需要开启reuse_port，让每个工作进程都能绑定同一个端口，
+    由内核在它们之间分配新连接。
+    '''
+    sock = socket()
+    sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(SOL_SOCKET, _socket.SO_REUSEPORT, 1)
+    sock.bind(('', port))
+    sock.listen(128)
+    return sock
+
+
 class BadHttpHeader(Exception):
     pass
 
@@ -78,16 +96,32 @@ def make_shadow_head(addr):
 
     elif family == AF_INET:
         head += b'\x01'
-        head += to_bytes(inet_pton(family, host))
+        head += inet_pton(family, to_str(host))
 
     else:
         head += b'\x04'
-        head += to_bytes(inet_pton(family, host))
+        head += inet_pton(family, to_str(host))
 
     head += port.to_bytes(2, 'big')
     return head
 
 
+def shadow_head_length(head):
+    '''
+    返回完整的Shadow头的长度，数据还不够确定长度时返回None。地址类型不合法时抛出BadShadowHeader。
+    '''
+    if not head:
+        return None
+    atype = head[0]
+    if atype == 0x01:
+        return 1 + 4 + 2
+    if atype == 0x04:
+        return 1 + 16 + 2
+    if atype == 0x03:
+        return 1 + 1 + head[1] + 2 if len(head) >= 2 else None
+    raise BadShadowHeader
+
+
 def parse_shadow_head(head):
     '''
     解析Shadow头，并返回主机名，端口号和头部长度
@@ -102,7 +136,7 @@ def parse_shadow_head(head):
 
     # IPv6
     elif atype == 0x04:
-        host = inet_ntop(AF_INET, head[length:length + 16])
+        host = inet_ntop(AF_INET6, head[length:length + 16])
         length += 16
 
     # 域名
@@ -128,6 +162,8 @@ def test_shadow(addr):
     host, port, length = parse_shadow_head(head)
 
     assert len(head) == length
+    assert shadow_head_length(head) == length
+    assert shadow_head_length(head[:1]) in (None, length)
     assert to_bytes(origin_host) == host
     assert origin_port == port
 
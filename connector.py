@@ -0,0 +1,105 @@
+'''
+按照Happy Eyeballs（RFC 8305）连接远程服务器。
+
+域名的多个地址依次发起非阻塞连接：上一次尝试一段时间内没有结果，或者已经失败，就开始连接下一个地址，
+之前的尝试不会取消，先连上的一个胜出。这样某个地址不通时，不必等待内核的SYN超时。
+'''
+
+import logging
+from selectors import EVENT_WRITE
+from socket import SO_ERROR, SOCK_STREAM, SOL_SOCKET, socket
+
+from common import is_ip, to_str
+
+# 上一次连接尝试没有结果，等待这么多秒后开始连接下一个地址
+CONNECTION_ATTEMPT_DELAY = 0.25
+
+
+class Connector:
+    '''
+    依次连接addrs中的地址。
+
+    连接成功时调用callback(sock, addr)，返回的套接字已经从selector中解除注册；
+    所有地址都失败时调用callback(None, None)。conn_id只用于日志。
+    '''
+
+    def __init__(self, selector, timers, addrs, port, callback, conn_id=''):
+        self.selector = selector
+        self.timers = timers
+        self.pending_addrs = list(addrs)  # 还没有尝试的地址
+        self.port = port
+        self.callback = callback
+        self.conn_id = conn_id
+        self.attempts = {}  # 正在进行的连接尝试 sock -> (ip, port)
+        self.attempt_timer = None
+
+    def start(self):
+        self._start_next_attempt()
+
+    def cancel(self):
+        '''
+        关闭还在进行的连接尝试，不再调用callback。
+        '''
+        self.pending_addrs = []
+        if self.attempt_timer:
+            self.attempt_timer.cancel()
+            self.attempt_timer = None
+        for sock in self.attempts:
+            self.selector.unregister(sock)
+            sock.close()
+        self.attempts = {}
+
+    def _start_next_attempt(self):
+        '''
+        连接下一个地址。之前的尝试不会取消，哪个先连上就使用哪个。
+        '''
+        if self.attempt_timer:
+            self.attempt_timer.cancel()
+            self.attempt_timer = None
+
+        while self.pending_addrs:
+            ip = self.pending_addrs.pop(0)
+            addr = to_str(ip), self.port
+            sock = socket(is_ip(ip), SOCK_STREAM)
+            sock.setblocking(False)
+            try:
+                sock.connect(addr)
+            except BlockingIOError:
+                pass
+            except OSError as e:
+                # 例如没有IPv6路由，立刻尝试下一个地址
+                logging.debug("[{0}]连接{1}:{2}失败: {3}".format(
+                    self.conn_id, addr[0], addr[1], e))
+                sock.close()
+                continue
+
+            logging.debug("[{0}]尝试非阻塞连接远程服务器{1}:{2}".format(
+                self.conn_id, addr[0], addr[1]))
+            self.attempts[sock] = addr
+            self.selector.register(sock, EVENT_WRITE, self._on_attempt_write)
+            if self.pending_addrs:
+                self.attempt_timer = self.timers.call_later(
+                    CONNECTION_ATTEMPT_DELAY, self._start_next_attempt)
+            return
+
+        if not self.attempts:
+            self.callback(None, None)
+
+    def _on_attempt_write(self, key, mask):
+        '''
+        连接尝试的套接字变为可写，说明连接已经建立或者失败
+        '''
+        sock = key.fileobj
+        addr = self.attempts.pop(sock)
+        self.selector.unregister(sock)
+        err = sock.getsockopt(SOL_SOCKET, SO_ERROR)
+        if err:
+            logging.debug("[{0}]远程连接{1}:{2}失败".format(
+                self.conn_id, addr[0], addr[1]))
+            sock.close()
+            # 不必等待定时器，立刻尝试下一个地址
+            self._start_next_attempt()
+            return
+
+        self.cancel()
+        self.callback(sock, addr)
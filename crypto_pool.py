@@ -0,0 +1,105 @@
+'''
+加密线程池。
+
+PyCryptodome和cryptography在C代码中加密和解密时都会释放GIL。连接把较大的一批数据交给线程池处理，
+事件循环在此期间继续处理其他连接的事件，一个进程就能用上多个CPU核心做加密运算。
+
+处理完成后，结果放入完成队列，并通过一对本地套接字唤醒事件循环，回调函数总是在事件循环的线程中调用。
+'''
+
+import collections
+import logging
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from selectors import EVENT_READ
+
+
+class CryptoPool:
+    '''
+    加密线程池。submit可以在事件循环的线程中调用，回调函数也在事件循环的线程中调用。
+
+    线程池不保证任务的顺序。调用者需要保证同一个加密器的同一个方向上最多只有一个任务在处理。
+    '''
+
+    def __init__(self, selector, threads):
+        self.selector = selector
+        self._executor = ThreadPoolExecutor(threads,
+                                            thread_name_prefix='crypto')
+        self._done = collections.deque()  # (回调函数, 结果, 异常)
+        self._rsock, self._wsock = socket.socketpair()
+        self._rsock.setblocking(False)
+        self._wsock.setblocking(False)
+        selector.register(self._rsock, EVENT_READ, self._on_wakeup)
+
+    def submit(self, func, arg, callback):
+        '''
+        在线程池中调用func(arg)，完成后在事件循环中调用callback(结果, 异常)。
+        '''
+
+        def run():
+            try:
+                self._done.append((callback, func(arg), None))
+            except Exception as e:
+                self._done.append((callback, None, e))
+            try:
+                self._wsock.send(b'\0')
+            except OSError:
+                # 唤醒的字节已经填满缓冲区，事件循环一定会被唤醒
+                pass
+
+        self._executor.submit(run)
+
+    def _on_wakeup(self, key, mask):
+        try:
+            self._rsock.recv(4096)
+        except BlockingIOError:
+            pass
+        while self._done:
+            callback, result, error = self._done.popleft()
+            try:
+                callback(result, error)
+            except Exception:
+                logging.exception("加密线程池回调出错")
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.selector.unregister(self._rsock)
+        self._rsock.close()
+        self._wsock.close()
+
+
+def test():
+    import threading
+    import time
+    from selectors import DefaultSelector
+
+    selector = DefaultSelector()
+    pool = CryptoPool(selector, 2)
+    results = []
+    main_thread = threading.current_thread()
+
+    def callback(result, error):
+        assert threading.current_thread() is main_thread
+        results.append((result, error))
+
+    def work(n):
+        if n < 0:
+            raise ValueError(n)
+        return threading.current_thread() is not main_thread
+
+    for n in (1, 2, -1):
+        pool.submit(work, n, callback)
+
+    end = time.monotonic() + 2
+    while len(results) < 3:
+        assert time.monotonic() < end
+        for key, mask in selector.select(0.1):
+            key.data(key, mask)
+
+    assert sorted(r for r, e in results if e is None) == [True, True]
+    assert sum(isinstance(e, ValueError) for r, e in results) == 1
+    pool.close()
+
+
+if __name__ == '__main__':
+    test()
@@ -1,5 +1,9 @@
 '''
-用于加密的模块。暂时只支持aes-256-cfb。
+用于加密的模块。
+
+支持的加密方法记录在METHODS中：流加密aes-256-cfb，以及与Shadowsocks AEAD规范兼容的
+aes-128-gcm、aes-256-gcm和chacha20-ietf-poly1305。有AES硬件指令时AES-GCM最快，
+没有AES硬件指令的ARM服务器上ChaCha20-Poly1305更快。AEAD方法在安装了cryptography库时才快，见AEADCyptor。
 '''
 # AES的总体加密流程如下：
 # 1.把明文按照128bit拆分成若干个明文块。
@@ -11,14 +15,34 @@
 
 import base64
 import hashlib
+import hmac
 import os
+import struct
+import threading
+import time
+
+from Crypto.Cipher import AES, ChaCha20_Poly1305
 
-from Crypto.Cipher import AES
+# 安装了cryptography库时，AEAD方法每个方向只创建一个加密对象，每次调用时给出nonce
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers.aead import (AESGCM,
+                                                            ChaCha20Poly1305)
+except ImportError:
+    AESGCM = ChaCha20Poly1305 = None
+    InvalidTag = ValueError
 
 # 密钥缓存
 cached_keys = {}
 
 
+class DecipherError(Exception):
+    '''
+    密文没有通过认证，可能被篡改或者密码不一致。
+    '''
+    pass
+
+
 class aes_256_cfb_Cyptor:
     '''
     AES-256-cfb加密类。
@@ -28,15 +52,18 @@ class aes_256_cfb_Cyptor:
     KEYLEN = 32
     IVLEN = 16
 
-    def __init__(self, passwd):
+    def __init__(self, passwd, key=None, random=os.urandom):
         self._ciptor = None
         self._deciptor = None
-        self._passwd = passwd
-        self._key, _ = EVP_BytesToKey(self._passwd, self.KEYLEN, self.IVLEN)
+        self._iv_buf = b''  # 还没有收全的对方初始向量
+        self._random = random
+        if key is None:
+            key, _ = EVP_BytesToKey(passwd, self.KEYLEN, self.IVLEN)
+        self._key = key
 
     def cipher(self, data):
         if not self._ciptor:
-            iv = os.urandom(self.IVLEN)
+            iv = self._random(self.IVLEN)
             self._ciptor = AES.new(
                 self._key, AES.MODE_CFB, iv=iv, segment_size=128)
             encrypted = self._ciptor.encrypt(data)
@@ -47,23 +74,381 @@ class aes_256_cfb_Cyptor:
 
     def decipher(self, data):
         if not self._deciptor:
-            iv = data[:self.IVLEN]
-            data = data[self.IVLEN:]
+            data = self._take_iv(data)
+            if self._deciptor is None:
+                return b''
+        return self._deciptor.decrypt(data)
 
-            deciptor = AES.new(self._key, AES.MODE_CFB,
-                               iv=iv, segment_size=128)
-            text = deciptor.decrypt(data)
-            self._deciptor = deciptor
-        else:
-            text = self._deciptor.decrypt(data)
-        return text
+    def cipher_into(self, buf):
+        '''
+        原地加密可写的缓冲区buf（bytearray或memoryview）。
+
+        返回需要在这段密文之前发送的初始向量，第一次加密之后返回b''。
+        '''
+        iv = b''
+        if not self._ciptor:
+            iv = self._random(self.IVLEN)
+            self._ciptor = AES.new(
+                self._key, AES.MODE_CFB, iv=iv, segment_size=128)
+        self._ciptor.encrypt(buf, output=buf)
+        return iv
+
+    def decipher_into(self, buf):
+        '''
+        原地解密可写的缓冲区buf，返回解密后数据的memoryview。
+
+        开头的初始向量会被跳过，所以返回的视图可能比buf短。
+        '''
+        view = memoryview(buf)
+        if not self._deciptor:
+            view = self._take_iv(view)
+            if self._deciptor is None:
+                return view
+        self._deciptor.decrypt(view, output=view)
+        return view
+
+    def cipher_batch(self, buf):
+        '''
+        加密一批可写的数据，返回(需要先发送的前缀, 密文)。
+
+        流加密可以原地加密，返回的密文就是buf本身，前缀是第一次加密时的初始向量。
+        '''
+        return self.cipher_into(buf), buf
+
+    def _take_iv(self, data):
+        '''
+        从对方发来的数据开头取出初始向量，创建解密器，返回剩下的数据。
+
+        初始向量可能被拆分在多个数据包中，没有收全时先缓存起来。
+        '''
+        need = self.IVLEN - len(self._iv_buf)
+        self._iv_buf += bytes(data[:need])
+        if len(self._iv_buf) == self.IVLEN:
+            self._deciptor = AES.new(self._key, AES.MODE_CFB,
+                                     iv=self._iv_buf, segment_size=128)
+        return data[need:]
+
+
+class AEADCyptor:
+    '''
+    Shadowsocks AEAD加密类，具体的算法由子类的new_cipher决定。
+
+    每个方向的开头是一个随机的盐，用HKDF-SHA1从密码生成的主密钥和盐派生出这个方向的子密钥。
+    之后的数据分成若干块，每块是[加密的长度][长度的标签][加密的数据][数据的标签]，长度2字节，最大0x3FFF。
+    nonce是从0开始的12字节小端计数器，每次加密或者解密之后加一。
+
+    PyCryptodome的加密对象创建后不能更换nonce，每个块的长度和数据都要新建一个，
+    创建的耗时远大于加密本身。安装了cryptography库时改用new_aead返回的对象，每个方向只创建一次。
+    '''
+    KEYLEN = 32
+    SALTLEN = 32
+    TAGLEN = 16
+    NONCELEN = 12
+    MAX_CHUNK = 0x3FFF
+
+    LENGTH = struct.Struct('!H')
+
+    def __init__(self, passwd, key=None, random=os.urandom):
+        if key is None:
+            key, _ = EVP_BytesToKey(passwd, self.KEYLEN, 0)
+        self._key = key
+        self._random = random
+        self._cipher_key = None
+        self._cipher_aead = None
+        self._cipher_nonce = 0
+        self._decipher_key = None
+        self._decipher_aead = None
+        self._decipher_nonce = 0
+        self._salt_buf = b''  # 还没有收全的对方的盐
+        self._chunk_buf = bytearray()  # 还没有收全的密文块
+        self._chunk_len = None  # 已经解密了长度、还没有收全数据的块的长度
+
+    def new_cipher(self, key, nonce):
+        raise NotImplementedError
+
+    def new_aead(self, key):
+        '''
+        返回cryptography库中可以重复使用的AEAD对象，没有安装时返回None。
+        '''
+        return None
+
+    def _subkey(self, salt):
+        '''
+        HKDF-SHA1（RFC 5869）。直接用标准库的hmac.digest计算，比PyCryptodome的HKDF快十几倍。
+        '''
+        prk = hmac.digest(salt, self._key, 'sha1')
+        okm = b''
+        block = b''
+        counter = 1
+        while len(okm) < self.KEYLEN:
+            block = hmac.digest(prk, block + b'ss-subkey' + bytes((counter,)),
+                                'sha1')
+            okm += block
+            counter += 1
+        return okm[:self.KEYLEN]
+
+    def _seal(self, data):
+        '''
+        加密一块数据，返回密文和标签。
+        '''
+        nonce = self._cipher_nonce.to_bytes(self.NONCELEN, 'little')
+        self._cipher_nonce += 1
+        if self._cipher_aead is not None:
+            return self._cipher_aead.encrypt(nonce, data, None)
+        data, tag = self.new_cipher(self._cipher_key,
+                                    nonce).encrypt_and_digest(data)
+        return data + tag
+
+    def _open(self, data):
+        '''
+        解密以标签结尾的一块密文。
+        '''
+        nonce = self._decipher_nonce.to_bytes(self.NONCELEN, 'little')
+        self._decipher_nonce += 1
+        try:
+            if self._decipher_aead is not None:
+                return self._decipher_aead.decrypt(nonce, data, None)
+            return self.new_cipher(self._decipher_key, nonce).decrypt_and_verify(
+                data[:-self.TAGLEN], data[-self.TAGLEN:])
+        except (ValueError, InvalidTag):
+            raise DecipherError
+
+    def cipher(self, data):
+        out = []
+        if self._cipher_key is None:
+            salt = self._random(self.SALTLEN)
+            self._cipher_key = self._subkey(salt)
+            self._cipher_aead = self.new_aead(self._cipher_key)
+            out.append(salt)
+
+        view = memoryview(data)
+        for i in range(0, len(view), self.MAX_CHUNK):
+            chunk = view[i:i + self.MAX_CHUNK]
+            out.append(self._seal(self.LENGTH.pack(len(chunk))))
+            out.append(self._seal(chunk))
+        return b''.join(out)
+
+    def decipher(self, data):
+        '''
+        解密对方发来的数据，返回已经收全的块中的明文。认证失败时抛出DecipherError。
+        '''
+        if self._decipher_key is None:
+            need = self.SALTLEN - len(self._salt_buf)
+            self._salt_buf += bytes(data[:need])
+            data = data[need:]
+            if len(self._salt_buf) < self.SALTLEN:
+                return b''
+            self._decipher_key = self._subkey(self._salt_buf)
+            self._decipher_aead = self.new_aead(self._decipher_key)
+
+        buf = self._chunk_buf
+        buf += data
+        out = []
+        offset = 0
+        while True:
+            if self._chunk_len is None:
+                end = offset + self.LENGTH.size + self.TAGLEN
+                if len(buf) < end:
+                    break
+                length = self._open(buf[offset:end])
+                self._chunk_len = self.LENGTH.unpack(length)[0]
+                if self._chunk_len > self.MAX_CHUNK:
+                    raise DecipherError
+                offset = end
+
+            end = offset + self._chunk_len + self.TAGLEN
+            if len(buf) < end:
+                break
+            out.append(self._open(buf[offset:end]))
+            self._chunk_len = None
+            offset = end
+
+        del buf[:offset]
+        return b''.join(out)
+
+    def decipher_into(self, buf):
+        '''
+        解密buf，返回明文的memoryview。密文块带有长度和标签，不能原地解密，明文在新的缓冲区中。
+        '''
+        return memoryview(self.decipher(buf))
+
+    def cipher_batch(self, buf):
+        '''
+        加密一批数据，返回(b'', 密文)。密文比明文长，不能原地加密。
+        '''
+        return b'', self.cipher(buf)
+
+
+class aes_128_gcm_Cyptor(AEADCyptor):
+    KEYLEN = 16
+    SALTLEN = 16
+
+    def new_cipher(self, key, nonce):
+        return AES.new(key, AES.MODE_GCM, nonce=nonce, mac_len=self.TAGLEN)
+
+    def new_aead(self, key):
+        return AESGCM(key) if AESGCM else None
+
+
+class aes_256_gcm_Cyptor(aes_128_gcm_Cyptor):
+    KEYLEN = 32
+    SALTLEN = 32
+
+
+class chacha20_ietf_poly1305_Cyptor(AEADCyptor):
+    KEYLEN = 32
+    SALTLEN = 32
+
+    def new_cipher(self, key, nonce):
+        return ChaCha20_Poly1305.new(key=key, nonce=nonce)
+
+    def new_aead(self, key):
+        return ChaCha20Poly1305(key) if ChaCha20Poly1305 else None
+
+
+# 加密方法名 -> 加密类
+METHODS = {
+    'aes-256-cfb': aes_256_cfb_Cyptor,
+    'aes-128-gcm': aes_128_gcm_Cyptor,
+    'aes-256-gcm': aes_256_gcm_Cyptor,
+    'chacha20-ietf-poly1305': chacha20_ietf_poly1305_Cyptor,
+}
+
+
+def new_cyptor(method, passwd):
+    '''
+    按照加密方法名创建加密器。
+    '''
+    return METHODS[method](passwd)
+
+
+class EntropyPool:
+    '''
+    随机字节池。一次从os.urandom读取size字节，之后的初始向量和盐从池中切出，用完再补充，
+    大量连接同时建立时不必为每个连接调用一次getrandom。
+
+    加密可能在加密线程池中进行，取随机字节时需要加锁。fork之后子进程必须清空池，
+    否则父子进程会用相同的初始向量。
+    '''
+
+    def __init__(self, size=4096):
+        self.size = size
+        self._buf = b''
+        self._offset = 0
+        self._lock = threading.Lock()
+
+    def random(self, n):
+        with self._lock:
+            offset = self._offset
+            if offset + n > len(self._buf):
+                self._buf = os.urandom(max(self.size, n))
+                offset = 0
+            self._offset = offset + n
+            return self._buf[offset:offset + n]
+
+    def clear(self):
+        self._buf = b''
+        self._offset = 0
+        self._lock = threading.Lock()
+
+
+# 所有加密器工厂共用的随机字节池
+entropy_pool = EntropyPool()
+os.register_at_fork(after_in_child=entropy_pool.clear)
+
+
+class CyptorFactory:
+    '''
+    一个监听端口的加密器工厂。
+
+    密钥只在创建工厂时从密码生成一次，new()创建的加密器共用这个密钥，初始向量和盐取自entropy_pool。
+    PyCryptodome的加密对象在创建时绑定了初始向量或nonce，不能换一个初始向量重新使用，
+    所以各连接共享的是密钥，每个连接仍然有自己的加密对象。
+    '''
+
+    def __init__(self, method, passwd, pool=entropy_pool):
+        self.method = method
+        self.cls = METHODS[method]
+        self.key, _ = EVP_BytesToKey(passwd, self.cls.KEYLEN, 0)
+        self.random = pool.random
+
+    def new(self):
+        return self.cls(None, self.key, self.random)
+
+
+def measure_setup(method, use_factory=True, count=2000):
+    '''
+    测量每个连接建立加密的耗时：创建客户端和服务器两端的加密器，各加密、解密第一个64字节的数据包。
+
+    use_factory为False时每个连接都用new_cyptor从密码创建加密器。返回每个连接的微秒数。
+    '''
+    passwd = b'measure'
+    factory = CyptorFactory(method, passwd)
+    if use_factory:
+        create = factory.new
+    else:
+        create = lambda: new_cyptor(method, passwd)
+    data = bytes(64)
+    start = time.perf_counter()
+    for _ in range(count):
+        local, remote = create(), create()
+        remote.decipher(local.cipher(data))
+        local.decipher(remote.cipher(data))
+    return (time.perf_counter() - start) / count * 1e6
+
+
+def measure_method(method, size, duration=0.1):
+    '''
+    测量加密方法处理size字节数据块的速度，按连接转发时的方式调用cipher_batch和decipher_into。
+
+    返回(加密MB/s, 解密MB/s, 每次加密的微秒数)。
+    '''
+    cpt = new_cyptor(method, b'measure')
+    buf = bytearray(size)
+    calls = 0
+    start = time.perf_counter()
+    while True:
+        cpt.cipher_batch(buf)
+        calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= duration:
+            break
+    encrypt = elapsed / calls
+
+    # 解密需要真实的密文，预先生成，总量不超过16MB
+    count = max(1, min(calls, (16 << 20) // size))
+    cpt = new_cyptor(method, b'measure')
+    chunks = []
+    for _ in range(count):
+        prefix, data = cpt.cipher_batch(bytearray(size))
+        chunks.append(bytearray(prefix) + data)
+    dpt = new_cyptor(method, b'measure')
+    start = time.perf_counter()
+    for chunk in chunks:
+        dpt.decipher_into(chunk)
+    decrypt = (time.perf_counter() - start) / count
+
+    return size / encrypt / 1e6, size / decrypt / 1e6, encrypt * 1e6
+
+
+def fastest_method(size=16 * 1024, duration=0.05):
+    '''
+    返回本机上加密和解密size字节数据块合计最快的方法。
+    '''
+    best = None
+    for method in sorted(METHODS):
+        encrypt, decrypt, _ = measure_method(method, size, duration)
+        speed = 1 / (1 / encrypt + 1 / decrypt)
+        if best is None or speed > best[0]:
+            best = speed, method
+    return best[1]
 
 
 def EVP_BytesToKey(password, key_len, iv_len):
     '''
     使用OpenSSL中的同名函数，通过不定长的密码生成定长的密钥和初始向量。
     '''
-    cached_key = '%s-%d-%d' % (password, key_len, iv_len)
+    cached_key = password, key_len, iv_len
     r = cached_keys.get(cached_key, None)
     if r:
         return r
@@ -91,5 +476,106 @@ def test_enc():
     assert cpt.decipher(cdata) == b'Hello, world\nThank you!'
 
 
+def test_enc_inplace():
+    cpt = aes_256_cfb_Cyptor(b'123456')
+    plain = b'Hello, world\n' * 100
+
+    buf = bytearray(plain)
+    iv = cpt.cipher_into(buf)
+    assert len(iv) == cpt.IVLEN
+    assert cpt.cipher_into(bytearray(4)) == b''
+    cdata = iv + bytes(buf)
+
+    # 初始向量被拆分在两个数据包中
+    dpt = aes_256_cfb_Cyptor(b'123456')
+    first = dpt.decipher_into(bytearray(cdata[:10]))
+    rest = dpt.decipher_into(bytearray(cdata[10:]))
+    assert len(first) == 0
+    assert bytes(rest) == plain
+
+
+def test_aead():
+    plain = os.urandom(40000)
+    for method in METHODS:
+        cpt = new_cyptor(method, b'123456')
+        prefix, cdata = cpt.cipher_batch(bytearray(plain[:100]))
+        cdata = prefix + bytes(cdata) + cpt.cipher(plain[100:])
+
+        # 任意拆分的数据包都能正确解密
+        dpt = new_cyptor(method, b'123456')
+        out = b''.join(bytes(dpt.decipher_into(bytearray(cdata[i:i + 7000])))
+                       for i in range(0, len(cdata), 7000))
+        assert out == plain, method
+
+    # cryptography库和PyCryptodome得到相同的密文，可以互相解密
+    def zeros(n):
+        return bytes(n)
+
+    for method in ('aes-128-gcm', 'aes-256-gcm', 'chacha20-ietf-poly1305'):
+        fast = METHODS[method](b'123456', random=zeros)
+        slow = METHODS[method](b'123456', random=zeros)
+        slow.new_aead = lambda key: None
+        cdata = fast.cipher(plain)
+        assert slow.cipher(plain) == cdata, method
+        slow = METHODS[method](b'123456')
+        slow.new_aead = lambda key: None
+        assert slow.decipher(cdata) == plain, method
+
+    # 篡改的密文无法通过认证
+    cpt = new_cyptor('aes-256-gcm', b'123456')
+    cdata = bytearray(cpt.cipher(b'Hello, world\n'))
+    cdata[-1] ^= 1
+    try:
+        new_cyptor('aes-256-gcm', b'123456').decipher(cdata)
+        assert False
+    except DecipherError:
+        pass
+
+    # 密码不一致
+    cdata = new_cyptor('chacha20-ietf-poly1305', b'123456').cipher(b'x')
+    try:
+        new_cyptor('chacha20-ietf-poly1305', b'654321').decipher(cdata)
+        assert False
+    except DecipherError:
+        pass
+
+
+def test_factory():
+    from Crypto.Hash import SHA1
+    from Crypto.Protocol.KDF import HKDF
+
+    for method in METHODS:
+        factory = CyptorFactory(method, b'123456')
+        cpt, dpt = factory.new(), new_cyptor(method, b'123456')
+        assert dpt.decipher(cpt.cipher(b'Hello, world\n')) == b'Hello, world\n'
+        assert cpt.decipher(dpt.cipher(b'Thank you!')) == b'Thank you!'
+        # 同一个工厂创建的加密器使用不同的初始向量
+        assert factory.new().cipher(b'x') != factory.new().cipher(b'x')
+
+    # 与PyCryptodome的HKDF结果一致
+    for cls in (aes_128_gcm_Cyptor, aes_256_gcm_Cyptor):
+        cpt = cls(b'123456')
+        salt = os.urandom(cls.SALTLEN)
+        assert cpt._subkey(salt) == HKDF(cpt._key, cls.KEYLEN, salt, SHA1,
+                                         context=b'ss-subkey')
+
+    # 随机字节池用完后补充，超过池大小的请求也能满足
+    pool = EntropyPool(64)
+    parts = [pool.random(24) for _ in range(5)] + [pool.random(100)]
+    assert [len(part) for part in parts] == [24] * 5 + [100]
+    assert len(set(parts)) == len(parts)
+    assert measure_setup('aes-256-cfb', True, 10) > 0
+
+
+def test_measure():
+    encrypt, decrypt, per_call = measure_method('aes-256-gcm', 1024, 0.01)
+    assert encrypt > 0 and decrypt > 0 and per_call > 0
+    assert fastest_method(1024, 0.01) in METHODS
+
+
 if __name__ == "__main__":
     test_enc()
+    test_enc_inplace()
+    test_aead()
+    test_factory()
+    test_measure()
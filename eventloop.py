@@ -0,0 +1,326 @@
+'''
+事件循环和定时器。
+
+TimerWheel是一个哈希时间轮：时间被划分为固定长度的刻度，每个定时器按到期的刻度放进对应的槽。
+设置和取消定时器都是O(1)，每个刻度只检查一个槽，所以即使有大量连接各自带着定时器，
+推进时间的开销也很小。定时器的精度为一个刻度。
+
+LoopMonitor是可选的事件循环监控：记录每个回调函数的耗时、每轮循环的耗时和每次select返回的事件数，
+超过阈值的回调写一条警告日志。
+'''
+
+import logging
+import math
+import time
+
+# 回调函数耗时和每轮循环耗时的直方图的桶（秒）
+CALLBACK_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                    0.01, 0.025, 0.05, 0.1, 0.25, 1)
+# 每次select返回的事件数的直方图的桶
+EVENT_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+
+
+class Timer:
+    '''
+    由TimerWheel.call_later返回的定时器，可以用cancel取消。
+    '''
+    __slots__ = ('tick', 'callback', 'args', '_wheel')
+
+    def __init__(self, tick, callback, args, wheel):
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+        self._wheel = wheel
+
+    def cancel(self):
+        '''
+        取消定时器。已经触发或者已经取消的定时器再次取消没有影响。
+        '''
+        if self._wheel is not None:
+            self._wheel._remove(self)
+            self._wheel = None
+
+
+class TimerWheel:
+    '''
+    哈希时间轮。这个类不是线程安全的。
+
+    tick是每个刻度的秒数，slots是槽的个数。超过一圈的定时器会在经过它的槽时被跳过，直到真正到期。
+    '''
+
+    def __init__(self, tick=0.1, slots=512):
+        self.tick = tick
+        self._slots = [set() for _ in range(slots)]
+        self._start = time.monotonic()
+        self._current = 0  # 已经处理到的刻度
+        self._count = 0
+        # 最近一次select返回时的时间，事件回调中可以用它代替time.monotonic()
+        self.now = self._start
+
+    def __len__(self):
+        return self._count
+
+    def update_time(self):
+        self.now = time.monotonic()
+        return self.now
+
+    def call_later(self, delay, callback, *args):
+        '''
+        在delay秒之后调用callback(*args)，返回Timer。
+        '''
+        now = time.monotonic()
+        # 至少推迟到下一个刻度，避免在本轮处理中立刻触发
+        tick = max(int(math.ceil((now + delay - self._start) / self.tick)),
+                   self._current + 1)
+        timer = Timer(tick, callback, args, self)
+        self._slots[tick % len(self._slots)].add(timer)
+        self._count += 1
+        return timer
+
+    def call_periodic(self, interval, callback, *args):
+        '''
+        每隔interval秒调用一次callback(*args)，用于周期性的清理工作。
+
+        周期任务在事件循环的整个生命周期内运行，不能取消。
+        '''
+
+        def run():
+            self.call_later(interval, run)
+            callback(*args)
+
+        self.call_later(interval, run)
+
+    def _remove(self, timer):
+        slot = self._slots[timer.tick % len(self._slots)]
+        if timer in slot:
+            slot.discard(timer)
+            self._count -= 1
+
+    def next_timeout(self):
+        '''
+        返回select应该等待的秒数。没有定时器时返回None，一直等待到有事件发生。
+        '''
+        if not self._count:
+            return None
+        next_tick_time = self._start + (self._current + 1) * self.tick
+        return max(0, next_tick_time - time.monotonic())
+
+    def run_due(self):
+        '''
+        推进时间，调用所有已经到期的定时器。
+        '''
+        target = int((time.monotonic() - self._start) / self.tick)
+        steps = min(target - self._current, len(self._slots))
+        first = self._current + 1
+        self._current = target
+
+        for i in range(steps):
+            slot = self._slots[(first + i) % len(self._slots)]
+            if not slot:
+                continue
+            due = [t for t in slot if t.tick <= target]
+            for timer in due:
+                slot.discard(timer)
+                self._count -= 1
+                timer._wheel = None
+            for timer in due:
+                try:
+                    timer.callback(*timer.args)
+                except Exception:
+                    logging.exception("定时器回调出错")
+
+
+def handler_name(handler):
+    '''
+    返回处理函数的名字，如Connection.establised_on_remote_event。
+    '''
+    func = getattr(handler, '__func__', handler)
+    return getattr(func, '__qualname__', type(func).__qualname__)
+
+
+class LoopMonitor:
+    '''
+    事件循环的监控，指标注册在registry中，名字以prefix开头。
+
+    每个回调函数前后各取一次时间，按处理函数的名字记入直方图。耗时超过slow_callback秒的回调写一条警告日志，
+    回调对象有id和state时（如连接对象）一起写出。每轮循环从select返回到处理完事件和定时器的时间记为loop_lag，
+    也就是这一轮中就绪的事件最多要等待的时间。
+    '''
+
+    def __init__(self, registry, prefix, slow_callback):
+        self.slow_callback = slow_callback
+        self.lag = registry.histogram(
+            prefix + '_loop_lag_seconds', '每轮事件循环处理事件和定时器的秒数',
+            buckets=CALLBACK_BUCKETS).labels()
+        self.events = registry.histogram(
+            prefix + '_loop_events', '每次select返回的事件数',
+            buckets=EVENT_BUCKETS).labels()
+        self.slow = registry.counter(
+            prefix + '_slow_callbacks_total', '耗时超过阈值的回调次数').labels()
+        self._callbacks = registry.histogram(
+            prefix + '_callback_seconds', '事件循环中每个回调的秒数，按处理函数分类',
+            ('handler',), buckets=CALLBACK_BUCKETS)
+        self._handlers = {}  # 代码对象或者类型 -> (名字, 直方图)
+
+    def handler_stats(self, handler):
+        '''
+        返回处理函数的(名字, 耗时直方图)。
+
+        按函数的代码对象查找，同一个方法的各个绑定方法、同一个闭包每次创建的函数对象都使用同一个直方图，
+        名字只在第一次遇到时生成。没有代码对象的可调用对象按类型查找。
+        '''
+        code = getattr(handler, '__code__', None) or type(handler)
+        stats = self._handlers.get(code)
+        if stats is None:
+            name = handler_name(handler)
+            stats = self._handlers[code] = name, self._callbacks.labels(name)
+        return stats
+
+    def record(self, stats, callback, elapsed):
+        '''
+        记录一次回调的耗时，超过阈值时写警告日志。
+        '''
+        name, histogram = stats
+        histogram.observe(elapsed)
+        if elapsed < self.slow_callback:
+            return
+
+        self.slow.inc()
+        statemap = getattr(callback, 'statemap', None)
+        if statemap is not None:
+            logging.warning("[{0}]回调{1}耗时{2:.1f}毫秒，当前状态{3}".format(
+                callback.id, name, elapsed * 1000,
+                statemap.get(callback.state)))
+        else:
+            logging.warning("回调{0}耗时{1:.1f}毫秒".format(name, elapsed * 1000))
+
+    def run(self, selector, timers):
+        clock = time.perf_counter
+        # 回调对象的类型 -> 它的event_handler方法，没有时为None
+        dispatchers = {}
+        run_due = self.handler_stats(timers.run_due)
+        while True:
+            events = selector.select(timers.next_timeout())
+            start = timers.update_time()
+            for key, mask in events:
+                callback = key.data
+                cls = type(callback)
+                try:
+                    dispatch = dispatchers[cls]
+                except KeyError:
+                    dispatch = dispatchers[cls] = getattr(cls, 'event_handler',
+                                                          None)
+                # 处理函数要在调用之前确定，回调中连接的状态可能改变
+                handler = callback if dispatch is None else \
+                    dispatch(callback, key)
+                stats = self.handler_stats(handler)
+                t = clock()
+                callback(key, mask)
+                self.record(stats, callback, clock() - t)
+            t = clock()
+            timers.run_due()
+            self.record(run_due, timers, clock() - t)
+            self.events.observe(len(events))
+            self.lag.observe(time.monotonic() - start)
+
+
+def run(selector, timers, monitor=None):
+    '''
+    运行事件循环：等待套接字事件并调用注册的回调函数，然后处理到期的定时器。
+
+    给出monitor（LoopMonitor）时记录每个回调的耗时，没有时循环中没有任何额外的开销。
+    '''
+    if monitor is not None:
+        monitor.run(selector, timers)
+        return
+    while True:
+        events = selector.select(timers.next_timeout())
+        timers.update_time()
+        for key, mask in events:
+            callback = key.data
+            callback(key, mask)
+        timers.run_due()
+
+
+def test():
+    wheel = TimerWheel(tick=0.01, slots=8)
+    fired = []
+
+    wheel.call_later(0.02, fired.append, 'a')
+    # 超过一圈的定时器
+    wheel.call_later(0.15, fired.append, 'b')
+    cancelled = wheel.call_later(0.02, fired.append, 'c')
+    cancelled.cancel()
+    cancelled.cancel()
+    assert len(wheel) == 2
+
+    time.sleep(0.05)
+    wheel.run_due()
+    assert fired == ['a']
+
+    time.sleep(0.15)
+    wheel.run_due()
+    assert fired == ['a', 'b']
+    assert len(wheel) == 0
+    assert wheel.next_timeout() is None
+
+    ticks = []
+    wheel.call_periodic(0.01, ticks.append, 1)
+    for _ in range(6):
+        time.sleep(0.015)
+        wheel.run_due()
+    assert len(ticks) >= 2
+
+    # 监控每个回调的耗时，慢回调写警告日志
+    import socket
+    from selectors import EVENT_READ, DefaultSelector
+    from metrics import Registry
+
+    class Conn:
+        statemap = {0: 'S_TEST'}
+
+        def __init__(self, sock):
+            self.id = 7
+            self.state = 0
+            self.sock = sock
+
+        def __call__(self, key, mask):
+            self.on_read(mask)
+
+        def event_handler(self, key):
+            return Conn.on_read
+
+        def on_read(self, mask):
+            self.sock.recv(1)
+            time.sleep(0.02)
+
+    def stop():
+        raise KeyboardInterrupt
+
+    registry = Registry()
+    monitor = LoopMonitor(registry, 'test', 0.01)
+    selector = DefaultSelector()
+    rsock, wsock = socket.socketpair()
+    selector.register(rsock, EVENT_READ, Conn(rsock))
+    wsock.send(b'x')
+    timers = TimerWheel(tick=0.01)
+    timers.call_later(0.05, stop)
+    try:
+        run(selector, timers, monitor)
+        assert False
+    except KeyboardInterrupt:
+        pass
+    assert handler_name(stop) == 'test.<locals>.stop'
+    assert handler_name(timers.run_due) == 'TimerWheel.run_due'
+
+    assert monitor.slow.value == 1
+    text = registry.render()
+    name = 'test.<locals>.Conn.on_read'
+    assert 'test_callback_seconds_count{handler="%s"} 1' % name in text
+    assert 'test_loop_events_count' in text
+    rsock.close()
+    wsock.close()
+
+
+if __name__ == '__main__':
+    test()
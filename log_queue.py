@@ -0,0 +1,115 @@
+'''
+在后台线程中写日志。
+
+事件循环只有一个线程，直接写标准错误或者文件时，磁盘和终端的I/O会阻塞所有连接。
+QueueLogHandler把日志记录放入队列，由一个后台线程交给真正的处理器写出，事件循环中只有格式化和入队的开销。
+'''
+
+import logging
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+
+class QueueLogHandler(QueueHandler):
+    '''
+    把日志记录放入队列，由后台线程交给handlers写出。
+
+    fork出的子进程中没有父进程的线程，也可能继承一个正被后台线程持有的队列，
+    所以fork之后在子进程中重新创建队列和线程。close时写出队列中剩下的日志。
+    '''
+
+    def __init__(self, *handlers):
+        super().__init__(queue.SimpleQueue())
+        self.handlers = handlers
+        self.listener = None
+        self._start()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        if self.listener is not None:
+            self._start()
+
+    def _start(self):
+        self.queue = queue.SimpleQueue()
+        self.listener = QueueListener(self.queue, *self.handlers,
+                                      respect_handler_level=True)
+        self.listener.start()
+
+    def prepare(self, record):
+        '''
+        在事件循环中只合并消息的参数，格式化和异常的堆栈留给后台线程。
+
+        队列在进程内，记录不需要像QueueHandler默认的那样复制一份。
+        '''
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+        super().close()
+
+
+def setup_logging(level, format=None, datefmt=None):
+    '''
+    配置根日志记录器，日志由后台线程写到标准错误。返回添加的QueueLogHandler。
+    '''
+    stream = logging.StreamHandler()
+    stream.setFormatter(logging.Formatter(format, datefmt))
+    handler = QueueLogHandler(stream)
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(level)
+    return handler
+
+
+def test():
+    import tempfile
+    import threading
+
+    with tempfile.TemporaryFile('w+') as f:
+        stream = logging.StreamHandler(f)
+        stream.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+        handler = QueueLogHandler(stream)
+        logger = logging.getLogger('log_queue.test')
+        logger.propagate = False
+        logger.addHandler(handler)
+        logger.setLevel(logging.DEBUG)
+
+        # 写出日志的是后台线程
+        threads = []
+        stream.emit = lambda record, emit=stream.emit: (
+            threads.append(threading.current_thread()), emit(record))
+        logger.debug('%s-%d', 'debug', 1)
+        logger.info('info')
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            logger.exception('error')
+
+        # fork出的子进程重新创建写日志的线程
+        pid = os.fork()
+        if pid == 0:
+            logger.info('child')
+            handler.close()
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+        handler.close()
+        logger.removeHandler(handler)
+        f.seek(0)
+        lines = f.read().splitlines()
+
+    # 子进程的日志和父进程的日志可能交错
+    assert 'INFO child' in lines
+    lines.remove('INFO child')
+    assert lines[:3] == ['DEBUG debug-1', 'INFO info', 'ERROR error']
+    assert 'ZeroDivisionError: division by zero' in lines
+    assert threading.current_thread() not in threads
+
+
+if __name__ == '__main__':
+    test()
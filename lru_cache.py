@@ -1,8 +1,7 @@
 """
 最近最少使用缓存。
 
-来自 shadowsocks/shadowsocks/lru_cache.py
-使用 Apache 协议。
+最初来自 shadowsocks/shadowsocks/lru_cache.py，使用 Apache 协议。
 Copyright 2015 clowwindy
 """
 
@@ -10,51 +9,53 @@ from __future__ import absolute_import, division, print_function, \
     with_statement
 
 import collections
+import collections.abc
 import logging
 import time
 
+# 默认的最大条目数
+MAX_ENTRIES = 4096
 
-# this LRUCache is optimized for concurrency, not QPS
-# n: concurrency, keys stored in the cache
-# m: visits not timed out, proportional to QPS * timeout
-# get & set is O(1), not O(n). thus we can support very large n
-# TODO: if timeout or QPS is too large, then this cache is not very efficient,
-#       as sweep() causes long pause
+# 每次sweep()最多检查的条目数
+SWEEP_BATCH = 1024
 
 
-class LRUCache(collections.MutableMapping):
+# 条目按最近访问的顺序保存在OrderedDict中，最久没有访问的在最前面。
+# n: 缓存中的条目数，不超过max_entries
+# get & set & 淘汰都是O(1)，内存只和条目数有关，和访问频率无关
+# 过期的条目由sweep()从最前面开始清理，每次最多清理SWEEP_BATCH个，
+# 所以不会长时间阻塞事件循环
+
+
+class LRUCache(collections.abc.MutableMapping):
     """This class is not thread safe"""
 
-    def __init__(self, timeout=60, close_callback=None, *args, **kwargs):
+    def __init__(self, timeout=60, close_callback=None, *args,
+                 max_entries=MAX_ENTRIES, **kwargs):
         self.timeout = timeout
         self.close_callback = close_callback
-        self._store = {}
-        self._time_to_keys = collections.defaultdict(list)
-        self._keys_to_last_time = {}
-        self._last_visits = collections.deque()
-        self._closed_values = set()
+        self.max_entries = max_entries
+        self._store = collections.OrderedDict()  # key -> [value, 最后访问时间]
         self.update(dict(*args, **kwargs))  # use the free update to set keys
 
     def __getitem__(self, key):
         # O(1)
-        t = time.time()
-        self._keys_to_last_time[key] = t
-        self._time_to_keys[t].append(key)
-        self._last_visits.append(t)
-        return self._store[key]
+        entry = self._store[key]
+        entry[1] = time.time()
+        self._store.move_to_end(key)
+        return entry[0]
 
     def __setitem__(self, key, value):
         # O(1)
-        t = time.time()
-        self._keys_to_last_time[key] = t
-        self._store[key] = value
-        self._time_to_keys[t].append(key)
-        self._last_visits.append(t)
+        if key in self._store:
+            self._store.move_to_end(key)
+        self._store[key] = [value, time.time()]
+        while len(self._store) > self.max_entries:
+            self._evict(next(iter(self._store)))
 
     def __delitem__(self, key):
         # O(1)
         del self._store[key]
-        del self._keys_to_last_time[key]
 
     def __iter__(self):
         return iter(self._store)
@@ -62,30 +63,29 @@ class LRUCache(collections.MutableMapping):
     def __len__(self):
         return len(self._store)
 
-    def sweep(self):
-        # O(m)
+    def _evict(self, key, closed=None):
+        value = self._store.pop(key)[0]
+        if self.close_callback is not None:
+            if closed is None:
+                self.close_callback(value)
+            elif value not in closed:
+                self.close_callback(value)
+                closed.add(value)
+
+    def sweep(self, max_work=SWEEP_BATCH):
+        # O(max_work)
         now = time.time()
+        closed = set()
         c = 0
-        while len(self._last_visits) > 0:
-            least = self._last_visits[0]
-            if now - least <= self.timeout:
+        while self._store and c < max_work:
+            key, entry = next(iter(self._store.items()))
+            if now - entry[1] <= self.timeout:
                 break
-            self._last_visits.popleft()
-            for key in self._time_to_keys[least]:
-                if key in self._store:
-                    if now - self._keys_to_last_time[key] > self.timeout:
-                        if self.close_callback is not None:
-                            value = self._store[key]
-                            if value not in self._closed_values:
-                                self.close_callback(value)
-                                self._closed_values.add(value)
-                        del self._store[key]
-                        del self._keys_to_last_time[key]
-                        c += 1
-            del self._time_to_keys[least]
+            self._evict(key, closed)
+            c += 1
         if c:
-            self._closed_values.clear()
             logging.debug('%d keys swept' % c)
+        return c
 
 
 def test():
@@ -135,5 +135,25 @@ def test():
     time.sleep(0.3)
     c.sweep()
 
+    # 超过最大条目数时淘汰最久没有访问的
+    c = LRUCache(timeout=10, max_entries=3)
+    for k in 'abc':
+        c[k] = k
+    c['a']
+    c['d'] = 'd'
+    assert 'b' not in c
+    assert sorted(c) == ['a', 'c', 'd']
+
+    # 每次清理的数量有上限
+    c = LRUCache(timeout=0.05)
+    for i in range(10):
+        c[i] = i
+    time.sleep(0.1)
+    assert c.sweep(max_work=4) == 4
+    assert len(c) == 6
+    assert c.sweep() == 6
+    assert len(c) == 0
+
+
 if __name__ == '__main__':
     test()
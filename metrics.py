@@ -0,0 +1,356 @@
+'''
+运行指标。
+
+Registry保存计数器、仪表和直方图，render把它们输出为Prometheus的文本格式。
+连接在事件循环中直接修改指标的值：计数器加一只是一次属性赋值，直方图的记录只多一次二分查找，
+所以转发数据时更新指标的开销很小。指标不是线程安全的，只能在事件循环的线程中修改。
+
+MetricsServer在同一个事件循环中监听一个本地的HTTP端口，对任何GET请求回复当前的指标。
+'''
+
+import bisect
+import logging
+import socket
+from selectors import EVENT_READ, EVENT_WRITE
+
+# 直方图默认的桶（秒），适合DNS解析、建立连接这类耗时
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10)
+
+
+class Counter:
+    '''
+    只增不减的计数器。
+    '''
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class Gauge(Counter):
+    '''
+    可以增减的仪表，如各个状态的隧道数。
+    '''
+    __slots__ = ()
+
+    def dec(self, n=1):
+        self.value -= n
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    '''
+    直方图。每个桶只记录落在其中的次数，输出时再累加成Prometheus要求的累积计数。
+    '''
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 最后一个是+Inf
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self, name, labels):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield name + '_bucket', labels + (('le', repr(float(bound))),), \
+                total
+        total += self.counts[-1]
+        yield name + '_bucket', labels + (('le', '+Inf'),), total
+        yield name + '_sum', labels, self.sum
+        yield name + '_count', labels, total
+
+
+class _FuncValue:
+    '''
+    输出时才调用func取值的指标，用于已经在别处计数的值，如DNS缓存的命中次数。
+    '''
+    __slots__ = ('func',)
+
+    def __init__(self, func):
+        self.func = func
+
+    def samples(self, name, labels):
+        yield name, labels, self.func()
+
+
+class Family:
+    '''
+    同名的一组指标，每一组标签的值对应一个子指标。没有标签时只有一个子指标。
+    '''
+
+    def __init__(self, name, help, type, labelnames, factory):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.labelnames = tuple(labelnames)
+        self._factory = factory
+        self._children = {}
+        if not self.labelnames:
+            self.labels()
+
+    def labels(self, *values):
+        '''
+        返回标签值为values的子指标，没有标签的指标用labels()取出唯一的子指标。
+        转发数据的路径上应该预先取出子指标，不要每次查找。
+        '''
+        if len(values) != len(self.labelnames):
+            raise ValueError('{0}需要标签{1}'.format(self.name,
+                                                 self.labelnames))
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._factory()
+        return child
+
+    def render(self):
+        lines = ['# HELP {0} {1}'.format(self.name, _escape_help(self.help)),
+                 '# TYPE {0} {1}'.format(self.name, self.type)]
+        for values, child in self._children.items():
+            labels = tuple(zip(self.labelnames, values))
+            for name, labels, value in child.samples(self.name, labels):
+                lines.append(_format_sample(name, labels, value))
+        return '\n'.join(lines) + '\n'
+
+
+def _escape_help(text):
+    return text.replace('\\', '\\\\').replace('\n', '\\n')
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+def _format_sample(name, labels, value):
+    if labels:
+        name += '{' + ','.join('{0}="{1}"'.format(k, _escape_label(v))
+                               for k, v in labels) + '}'
+    return '{0} {1}'.format(name, value)
+
+
+class Registry:
+    '''
+    一个进程中所有的指标。指标名不能重复。
+    '''
+
+    def __init__(self):
+        self._families = {}
+
+    def _add(self, family):
+        if family.name in self._families:
+            raise ValueError('重复的指标名{0}'.format(family.name))
+        self._families[family.name] = family
+        return family
+
+    def counter(self, name, help, labelnames=(), func=None):
+        '''
+        注册计数器。给出func时，输出时调用func()取值，不能再有标签。
+        '''
+        factory = Counter if func is None else lambda: _FuncValue(func)
+        return self._add(Family(name, help, 'counter', labelnames, factory))
+
+    def gauge(self, name, help, labelnames=(), func=None):
+        '''
+        注册仪表。给出func时，输出时调用func()取值，不能再有标签。
+        '''
+        factory = Gauge if func is None else lambda: _FuncValue(func)
+        return self._add(Family(name, help, 'gauge', labelnames, factory))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        buckets = tuple(sorted(buckets))
+        return self._add(Family(name, help, 'histogram', labelnames,
+                                lambda: Histogram(buckets)))
+
+    def render(self):
+        '''
+        返回Prometheus文本格式的全部指标。
+        '''
+        return ''.join(family.render()
+                       for family in self._families.values())
+
+
+# 进程的默认指标表，客户端和服务器的指标使用不同的前缀
+registry = Registry()
+
+
+class MetricsServer:
+    '''
+    在事件循环中提供指标的HTTP服务器。只监听本地地址，每个请求回复一次后关闭连接。
+    '''
+
+    # 请求头的最大长度，和读完请求头的超时秒数
+    MAX_REQUEST = 8192
+    TIMEOUT = 10
+
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self, selector, timers, port, registry=registry,
+                 host='127.0.0.1', reuse_port=False):
+        self.selector = selector
+        self.timers = timers
+        self.registry = registry
+        self._sock = socket.socket()
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self._sock.bind((host, port))
+        self._sock.listen(16)
+        self._sock.setblocking(False)
+        self.address = self._sock.getsockname()
+        selector.register(self._sock, EVENT_READ, self._on_accept)
+
+    def _on_accept(self, key, mask):
+        try:
+            sock, _ = self._sock.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        request = bytearray()
+        response = None
+        timer = None
+
+        def close():
+            if timer:
+                timer.cancel()
+            try:
+                self.selector.unregister(sock)
+            except KeyError:
+                pass
+            sock.close()
+
+        def on_event(key, mask):
+            nonlocal response
+            try:
+                if response is None:
+                    data = sock.recv(self.MAX_REQUEST)
+                    if not data:
+                        close()
+                        return
+                    request.extend(data)
+                    if b'\r\n\r\n' not in request:
+                        if len(request) >= self.MAX_REQUEST:
+                            close()
+                        return
+                    response = memoryview(self._respond(bytes(request)))
+                    self.selector.modify(sock, EVENT_WRITE, on_event)
+                n = sock.send(response)
+            except BlockingIOError:
+                return
+            except OSError as e:
+                logging.debug('[metrics]请求失败: %s', e)
+                close()
+                return
+            response = response[n:]
+            if not response:
+                close()
+
+        self.selector.register(sock, EVENT_READ, on_event)
+        timer = self.timers.call_later(self.TIMEOUT, close)
+
+    def _respond(self, request):
+        line = request.split(b'\r\n', 1)[0].split()
+        if len(line) >= 2 and line[0] in (b'GET', b'HEAD'):
+            status = '200 OK'
+            body = self.registry.render().encode('utf-8')
+        else:
+            status = '405 Method Not Allowed'
+            body = b''
+        head = 'HTTP/1.1 {0}\r\nContent-Type: {1}\r\nContent-Length: {2}\r\n' \
+               'Connection: close\r\n\r\n'.format(status, self.CONTENT_TYPE,
+                                                  len(body))
+        if line[:1] == [b'HEAD']:
+            body = b''
+        return head.encode('ascii') + body
+
+    def close(self):
+        self.selector.unregister(self._sock)
+        self._sock.close()
+
+
+def test():
+    import time
+    from selectors import DefaultSelector
+    from eventloop import TimerWheel
+
+    reg = Registry()
+    requests = reg.counter('test_requests_total', 'Requests.\nSecond line',
+                           ('code',))
+    requests.labels('200').inc()
+    requests.labels('200').inc(2)
+    requests.labels('a"b').inc()
+    reg.gauge('test_open', 'Open sockets.').labels().set(5)
+    reg.gauge('test_func', 'Computed.', func=lambda: 7)
+    latency = reg.histogram('test_seconds', 'Latency.',
+                            buckets=(0.1, 1)).labels()
+    for v in (0.05, 0.1, 0.5, 3):
+        latency.observe(v)
+    try:
+        reg.counter('test_open', 'Duplicate.')
+        assert False
+    except ValueError:
+        pass
+    try:
+        requests.labels()
+        assert False
+    except ValueError:
+        pass
+
+    text = reg.render()
+    assert text.splitlines() == [
+        '# HELP test_requests_total Requests.\\nSecond line',
+        '# TYPE test_requests_total counter',
+        'test_requests_total{code="200"} 3',
+        'test_requests_total{code="a\\"b"} 1',
+        '# HELP test_open Open sockets.',
+        '# TYPE test_open gauge',
+        'test_open 5',
+        '# HELP test_func Computed.',
+        '# TYPE test_func gauge',
+        'test_func 7',
+        '# HELP test_seconds Latency.',
+        '# TYPE test_seconds histogram',
+        'test_seconds_bucket{le="0.1"} 2',
+        'test_seconds_bucket{le="1.0"} 3',
+        'test_seconds_bucket{le="+Inf"} 4',
+        'test_seconds_sum 3.65',
+        'test_seconds_count 4',
+    ]
+
+    # 在事件循环中回复HTTP请求
+    selector = DefaultSelector()
+    timers = TimerWheel()
+    server = MetricsServer(selector, timers, 0, reg)
+    client = socket.create_connection(server.address)
+    client.sendall(b'GET /metrics HTTP/1.1\r\nHost: x\r\n\r\n')
+    client.setblocking(False)
+    response = b''
+    end = time.monotonic() + 2
+    while not response.endswith(b'test_seconds_count 4\n'):
+        assert time.monotonic() < end
+        for key, mask in selector.select(0.05):
+            key.data(key, mask)
+        try:
+            response += client.recv(65536)
+        except BlockingIOError:
+            pass
+    assert response.startswith(b'HTTP/1.1 200 OK\r\n')
+    assert response.endswith(text.encode('utf-8'))
+    client.close()
+    server.close()
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,810 @@
+'''
+多路复用协议。
+
+经典模式下，每个CONNECT请求都是一条到隧道服务器的TCP连接，各自握手、交换初始向量。
+多路复用模式下，客户端和服务器之间保持少数几条长期的加密连接（会话），每个CONNECT请求是会话中的一条逻辑流。
+
+协商：客户端新建会话时，加密发送的Shadow头使用保留的地址类型ATYP_MUX，后面是一个字节的协议版本。
+支持多路复用的服务器回复HELLO帧；不支持的服务器无法解析这个头部，会直接关闭连接，
+客户端在一段时间内不再尝试，继续使用经典模式。
+
+之后双方在会话的加密流中依次发送帧，每帧有7字节的帧头：
+
+    +------+--------+--------+----------+
+    | 类型 | 流ID   | 长度   | 数据     |
+    +------+--------+--------+----------+
+    |  1   |   4    |   2    | 0~16384  |
+    +------+--------+--------+----------+
+
+* HELLO：服务器确认使用多路复用，流ID为0，数据为4字节的服务器连接远程地址的超时毫秒数。
+* SYN：客户端打开一条流，数据为Shadow头。
+* DATA：流中的数据。
+* FIN：发送方不再发送数据（半关闭），对方写完已经收到的数据后关闭套接字的写。
+* RST：中止流，例如服务器连接远程地址失败。
+* WINDOW：数据为4字节的窗口增量。服务器连接上远程地址后发送增量为0的WINDOW帧作为确认，
+  客户端在这个超时再加ClientStream.ACK_MARGIN秒内没有收到这条流的任何帧时中止它。
+
+流量控制：每条流每个方向有STREAM_WINDOW字节的窗口，发送方发出的DATA不超过窗口。
+接收方把数据写入套接字之后，累计超过半个窗口时用WINDOW帧归还。所以一条慢速的流最多占用一个窗口的缓冲，
+不会阻塞会话中的其他流。
+'''
+
+import logging
+import struct
+from selectors import EVENT_READ, EVENT_WRITE
+from socket import (SHUT_WR, SO_ERROR, SO_KEEPALIVE, SOL_SOCKET, SOL_TCP,
+                    TCP_NODELAY, socket)
+
+from common import parse_shadow_head, to_str
+from connector import Connector
+from encypt import DecipherError
+
+# 多路复用请求头：保留的地址类型和协议版本
+ATYP_MUX = 0x7f
+VERSION = 1
+MUX_HEAD = bytes((ATYP_MUX, VERSION))
+
+# 帧类型
+HELLO = 0
+SYN = 1
+DATA = 2
+FIN = 3
+RST = 4
+WINDOW = 5
+
+FRAME_HEAD = struct.Struct('!BIH')
+WINDOW_INCREMENT = struct.Struct('!I')
+CONNECT_TIMEOUT_MS = struct.Struct('!I')
+
+# 每个DATA帧最多携带的字节数
+MAX_FRAME_SIZE = 16 * 1024
+
+# 每条流每个方向的窗口
+STREAM_WINDOW = 256 * 1024
+
+# 会话输出队列的高水位和低水位。超过高水位时各条流暂停读套接字，降到低水位以下时恢复
+HIGH_WATER = 256 * 1024
+LOW_WATER = 64 * 1024
+
+# 每次recv最多读取的字节数
+RECV_SIZE = 64 * 1024
+
+# 会话断开或者连接失败后等待多少秒重新连接
+RETRY_DELAY = 1
+
+# 服务器不支持多路复用时，等待多少秒再尝试协商
+NEGOTIATE_RETRY = 60
+
+REPLY = b'HTTP/1.1 200 Connection Established\r\n\r\n'
+
+
+def is_mux_head(data):
+    '''
+    判断解密后的第一段数据是否是多路复用的请求头。
+    '''
+    return bytes(data[:len(MUX_HEAD)]) == MUX_HEAD
+
+
+def encode_frame(ftype, stream_id, payload=b''):
+    return FRAME_HEAD.pack(ftype, stream_id, len(payload)) + bytes(payload)
+
+
+def decode_frames(buf):
+    '''
+    解析buf开头的完整帧，返回[(类型, 流ID, 数据)]，并从buf中删除已经解析的部分。
+
+    不完整的帧留在buf中，等待更多数据。
+    '''
+    frames = []
+    offset = 0
+    while len(buf) - offset >= FRAME_HEAD.size:
+        ftype, stream_id, length = FRAME_HEAD.unpack_from(buf, offset)
+        start = offset + FRAME_HEAD.size
+        if start + length > len(buf):
+            break
+        frames.append((ftype, stream_id, bytes(buf[start:start + length])))
+        offset = start + length
+    del buf[:offset]
+    return frames
+
+
+class Stream:
+    '''
+    会话中的一条流，对应本机的一个套接字：客户端是浏览器的连接，服务器是到远程服务器的连接。
+    '''
+    # 流空闲超时和服务器连接远程地址超时的秒数
+    TIMEOUT = 300
+    CONNECT_TIMEOUT = 10
+
+    def __init__(self, session, stream_id, sock=None, addr=None):
+        self.session = session
+        self.id = stream_id
+        self.tag = 'm{0}.{1}'.format(session.id, stream_id)  # 日志中的标识
+        self.sock = sock
+        self.addr = addr
+
+        self.outbuf = bytearray()  # 对方发来、等待写入套接字的数据
+        self.send_window = STREAM_WINDOW  # 还可以发送给对方的字节数
+        self.unacked = 0  # 已经写入套接字、还没有归还窗口的字节数
+
+        self.closed = False  # 套接字已经读到EOF，已经发送FIN
+        self.peer_closed = False  # 已经收到FIN
+        self.shutdown = False  # 已经关闭套接字的写
+        self.destoryed = False
+
+        timers = session.timers
+        self.last_active = timers.now
+        self.idle_timer = timers.call_later(self.TIMEOUT, self._on_idle_timeout)
+        session.streams[stream_id] = self
+
+    def update_events(self):
+        '''
+        根据窗口、输出队列和关闭状态重新计算套接字关注的事件。
+
+        收到FIN并且输出队列已经写完，就关闭套接字的写。两个方向都关闭后销毁流。
+        '''
+        if self.sock is None or self.destoryed:
+            return
+
+        try:
+            if self.peer_closed and not self.shutdown and not self.outbuf:
+                self.sock.shutdown(SHUT_WR)
+                self.shutdown = True
+        except OSError:
+            self.reset()
+            return
+
+        if self.closed and self.shutdown:
+            self.destory()
+            return
+
+        events = 0
+        if not self.closed and self.send_window > 0 and \
+                not self.session.congested:
+            events |= EVENT_READ
+        if self.outbuf:
+            events |= EVENT_WRITE
+
+        selector = self.session.selector
+        try:
+            key = selector.get_key(self.sock)
+        except KeyError:
+            if events:
+                selector.register(self.sock, events, self._on_event)
+            return
+        if not events:
+            selector.unregister(self.sock)
+        elif key.events != events:
+            selector.modify(self.sock, events, self._on_event)
+
+    def _on_event(self, key, mask):
+        if mask & EVENT_WRITE:
+            self._flush()
+        if mask & EVENT_READ and not self.destoryed:
+            self._on_read()
+
+    def _on_read(self):
+        '''
+        套接字可读，读入不超过窗口的数据，分成DATA帧发送给对方
+        '''
+        try:
+            data = self.sock.recv(min(self.send_window, RECV_SIZE))
+        except BlockingIOError:
+            return
+        except OSError as e:
+            logging.error("[{0}]连接已经被 {1}:{2} 重置: {3}".format(
+                self.tag, self.addr[0], self.addr[1], e))
+            self.reset()
+            return
+
+        self.last_active = self.session.timers.now
+        if not data:
+            logging.info("[{0}]{1}:{2}关闭连接".format(
+                self.tag, self.addr[0], self.addr[1]))
+            self.closed = True
+            self.session.send_frame(FIN, self.id)
+        else:
+            self.send(data)
+        self.update_events()
+
+    def send(self, data):
+        '''
+        把数据分成DATA帧发送给对方，调用者保证不超过窗口。
+        '''
+        self.send_window -= len(data)
+        view = memoryview(data)
+        for i in range(0, len(data), MAX_FRAME_SIZE):
+            self.session.send_frame(DATA, self.id, view[i:i + MAX_FRAME_SIZE])
+
+    def _flush(self):
+        '''
+        尽量写出输出队列中的数据，累计超过半个窗口时归还给对方。
+        '''
+        try:
+            n = self.sock.send(self.outbuf)
+        except BlockingIOError:
+            n = 0
+        except OSError as e:
+            logging.error("[{0}]发送数据失败: {1}".format(self.tag, e))
+            self.reset()
+            return
+
+        if n:
+            self.last_active = self.session.timers.now
+        del self.outbuf[:n]
+        self.unacked += n
+        if self.unacked >= STREAM_WINDOW // 2:
+            self.session.send_frame(WINDOW, self.id,
+                                    WINDOW_INCREMENT.pack(self.unacked))
+            self.unacked = 0
+        self.update_events()
+
+    def on_data(self, payload):
+        if self.peer_closed:
+            return
+        self.outbuf += payload
+        if len(self.outbuf) > STREAM_WINDOW:
+            logging.error("[{0}]对方发送的数据超过了窗口".format(self.tag))
+            self.reset()
+            return
+        # 还没有连接上远程地址时先缓存，连接建立后再写出
+        if self.sock is not None:
+            self._flush()
+
+    def on_fin(self):
+        self.peer_closed = True
+        self.update_events()
+
+    def on_window(self, increment):
+        self.send_window += increment
+        self.update_events()
+
+    def on_reset(self):
+        logging.info("[{0}]流被对方中止".format(self.tag))
+        self.destory()
+
+    def reset(self):
+        '''
+        通知对方中止流，然后销毁它。
+        '''
+        self.session.send_frame(RST, self.id)
+        self.destory()
+
+    def _on_idle_timeout(self):
+        idle = self.session.timers.now - self.last_active
+        if idle >= self.TIMEOUT:
+            logging.info("[{0}]流空闲超时".format(self.tag))
+            self.reset()
+        else:
+            self.idle_timer = self.session.timers.call_later(
+                self.TIMEOUT - idle, self._on_idle_timeout)
+
+    def destory(self):
+        '''
+        销毁流，关闭对应的套接字。
+        '''
+        if self.destoryed:
+            return
+        self.destoryed = True
+        logging.debug("[{0}]流已被销毁".format(self.tag))
+
+        self.idle_timer.cancel()
+        self.session.streams.pop(self.id, None)
+        if self.sock:
+            try:
+                self.session.selector.unregister(self.sock)
+            except KeyError:
+                pass
+            self.sock.close()
+
+
+class ServerStream(Stream):
+    '''
+    服务器一侧的流：解析域名并连接远程地址，连接建立之前收到的数据先缓存。
+    '''
+
+    def __init__(self, session, stream_id):
+        super().__init__(session, stream_id)
+        self.connector = None
+        self.connect_timer = None
+
+    def open_remote(self, host, port):
+        self.addr = host, port
+        self.connect_timer = self.session.timers.call_later(
+            self.CONNECT_TIMEOUT, self._on_connect_timeout)
+        self.session.resolver.resolve(host, self._on_dns_resolved)
+
+    def _on_dns_resolved(self, result, error):
+        # 等待解析期间流已经被中止
+        if self.destoryed:
+            return
+
+        # 域名为空或者不合法时，解析器直接以error调用回调
+        if result is None or error:
+            logging.info("[{0}]域名{1}DNS解析失败: {2}".format(
+                self.tag, self.addr[0], error))
+            self.reset()
+            return
+        hostname, addrs = result
+        if not addrs:
+            logging.info("[{0}]域名{1}DNS解析失败".format(self.tag, hostname))
+            self.reset()
+            return
+
+        self.connector = Connector(self.session.selector, self.session.timers,
+                                   addrs, self.addr[1],
+                                   self._on_remote_connected, self.tag)
+        self.connector.start()
+
+    def _on_remote_connected(self, sock, addr):
+        self.connector = None
+        if sock is None:
+            logging.info("[{0}]远程地址{1}:{2}全部连接失败".format(
+                self.tag, self.addr[0], self.addr[1]))
+            self.reset()
+            return
+
+        logging.info("[{0}]远程地址{1}:{2}连接成功...".format(
+            self.tag, addr[0], addr[1]))
+        self.connect_timer.cancel()
+        self.connect_timer = None
+        self.sock = sock
+        self.addr = addr
+        self.session.send_frame(WINDOW, self.id, WINDOW_INCREMENT.pack(0))
+        if self.outbuf:
+            self._flush()
+        else:
+            self.update_events()
+
+    def _on_connect_timeout(self):
+        self.connect_timer = None
+        logging.info("[{0}]远程连接{1}:{2}超时".format(
+            self.tag, self.addr[0], self.addr[1]))
+        self.reset()
+
+    def destory(self):
+        if self.connector:
+            self.connector.cancel()
+            self.connector = None
+        if self.connect_timer:
+            self.connect_timer.cancel()
+            self.connect_timer = None
+        super().destory()
+
+
+class ClientStream(Stream):
+    '''
+    客户端一侧的流：等待服务器确认已经连接上远程地址，超时中止流并关闭本地连接。
+    '''
+    # 在服务器的连接超时之外多等的秒数，通常服务器连接失败的RST先到达
+    ACK_MARGIN = 5
+
+    def __init__(self, session, stream_id, sock, addr):
+        super().__init__(session, stream_id, sock, addr)
+        self.ack_timer = session.timers.call_later(
+            session.connect_timeout + self.ACK_MARGIN, self._on_ack_timeout)
+
+    def _on_ack(self):
+        if self.ack_timer:
+            self.ack_timer.cancel()
+            self.ack_timer = None
+
+    def on_data(self, payload):
+        self._on_ack()
+        super().on_data(payload)
+
+    def on_fin(self):
+        self._on_ack()
+        super().on_fin()
+
+    def on_window(self, increment):
+        self._on_ack()
+        super().on_window(increment)
+
+    def _on_ack_timeout(self):
+        self.ack_timer = None
+        logging.info("[{0}]服务器没有确认连接".format(self.tag))
+        self.reset()
+
+    def destory(self):
+        self._on_ack()
+        super().destory()
+
+
+class Session:
+    '''
+    一条多路复用会话：一个加密的TCP连接，以及其中的所有流。
+    '''
+    count = 0
+
+    def __init__(self, selector, timers, sock, addr, cryptor):
+        self.selector = selector
+        self.timers = timers
+        self.sock = sock
+        self.addr = addr
+        self.cryptor = cryptor
+
+        self.streams = {}  # 流ID -> Stream
+        self.inbuf = bytearray()  # 已经解密、还没有组成完整帧的数据
+        self.outbuf = bytearray()  # 已经加密、等待写入套接字的数据
+        self.congested = False  # 输出队列超过高水位，各条流暂停读套接字
+        self.closed = False
+        self.id = Session.count
+        Session.count = Session.count + 1
+
+        # 会话长期空闲，靠TCP保活发现已经断开的对方
+        sock.setsockopt(SOL_SOCKET, SO_KEEPALIVE, 1)
+
+    def send_frame(self, ftype, stream_id, payload=b''):
+        self._send(self.cryptor.cipher(encode_frame(ftype, stream_id, payload)))
+
+    def _send(self, data):
+        '''
+        输出队列为空时直接发送，写不完的部分放入输出队列。
+        '''
+        if self.closed:
+            return
+        if not self.outbuf:
+            try:
+                n = self.sock.send(data)
+            except BlockingIOError:
+                n = 0
+            except OSError as e:
+                logging.error("[m{0}]会话发送数据失败: {1}".format(self.id, e))
+                self.close()
+                return
+            if n == len(data):
+                return
+            data = data[n:]
+
+        self.outbuf += data
+        if len(self.outbuf) >= HIGH_WATER:
+            self.congested = True
+        self._update_events()
+
+    def _update_events(self):
+        events = EVENT_READ
+        if self.outbuf:
+            events |= EVENT_WRITE
+        try:
+            key = self.selector.get_key(self.sock)
+        except KeyError:
+            self.selector.register(self.sock, events, self._on_event)
+            return
+        if key.events != events or key.data != self._on_event:
+            self.selector.modify(self.sock, events, self._on_event)
+
+    def _on_event(self, key, mask):
+        if mask & EVENT_WRITE:
+            self._flush()
+        if mask & EVENT_READ and not self.closed:
+            self._on_read()
+
+    def _flush(self):
+        try:
+            n = self.sock.send(self.outbuf)
+        except BlockingIOError:
+            n = 0
+        except OSError as e:
+            logging.error("[m{0}]会话发送数据失败: {1}".format(self.id, e))
+            self.close()
+            return
+
+        del self.outbuf[:n]
+        self._update_events()
+        if self.congested and len(self.outbuf) <= LOW_WATER:
+            self.congested = False
+            for stream in list(self.streams.values()):
+                stream.update_events()
+
+    def _on_read(self):
+        try:
+            data = self.sock.recv(RECV_SIZE)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            logging.error("[m{0}]会话已经被 {1}:{2} 重置: {3}".format(
+                self.id, self.addr[0], self.addr[1], e))
+            self.close()
+            return
+
+        if not data:
+            logging.info("[m{0}]{1}:{2}关闭会话".format(
+                self.id, self.addr[0], self.addr[1]))
+            self.close()
+            return
+
+        try:
+            self.inbuf += self.cryptor.decipher(data)
+        except DecipherError:
+            logging.error("[m{0}]解密失败，数据可能被篡改或者密码不一致".format(self.id))
+            self.close()
+            return
+        self.on_frames(decode_frames(self.inbuf))
+
+    def on_frames(self, frames):
+        for ftype, stream_id, payload in frames:
+            if self.closed:
+                return
+            stream = self.streams.get(stream_id)
+            if ftype == HELLO:
+                self.on_hello(payload)
+            elif ftype == SYN:
+                self.on_syn(stream_id, payload)
+            elif ftype not in (DATA, FIN, RST, WINDOW):
+                logging.error("[m{0}]未知的帧类型{1}".format(self.id, ftype))
+                self.close()
+            # 已经销毁的流还可能收到对方在此之前发出的帧，直接丢弃
+            elif stream is None:
+                continue
+            elif ftype == DATA:
+                stream.on_data(payload)
+            elif ftype == FIN:
+                stream.on_fin()
+            elif ftype == RST:
+                stream.on_reset()
+            elif len(payload) != WINDOW_INCREMENT.size:
+                logging.error("[m{0}]WINDOW帧的长度错误".format(self.id))
+                self.close()
+            else:
+                stream.on_window(WINDOW_INCREMENT.unpack(payload)[0])
+
+    def on_hello(self, payload):
+        logging.error("[m{0}]收到意外的HELLO帧".format(self.id))
+        self.close()
+
+    def on_syn(self, stream_id, payload):
+        logging.error("[m{0}]收到意外的SYN帧".format(self.id))
+        self.close()
+
+    def on_close(self):
+        pass
+
+    def close(self):
+        '''
+        关闭会话和其中所有的流。
+        '''
+        if self.closed:
+            return
+        self.closed = True
+        logging.info("[m{0}]会话已被关闭，销毁{1}条流".format(
+            self.id, len(self.streams)))
+
+        for stream in list(self.streams.values()):
+            stream.destory()
+        try:
+            self.selector.unregister(self.sock)
+        except KeyError:
+            pass
+        self.sock.close()
+        self.on_close()
+
+
+class ServerSession(Session):
+    '''
+    服务器一侧的会话。由收到多路复用请求头的连接创建，data是请求头之后已经解密的数据。
+    '''
+
+    def __init__(self, selector, timers, sock, addr, cryptor, resolver,
+                 data=b''):
+        super().__init__(selector, timers, sock, addr, cryptor)
+        self.resolver = resolver
+        logging.info("[m{0}]{1}:{2}建立多路复用会话".format(
+            self.id, addr[0], addr[1]))
+        # 告诉客户端连接远程地址的超时，客户端据此等待每条流的确认
+        self.send_frame(HELLO, 0, CONNECT_TIMEOUT_MS.pack(
+            int(ServerStream.CONNECT_TIMEOUT * 1000)))
+        self._update_events()
+        self.inbuf += data
+        self.on_frames(decode_frames(self.inbuf))
+
+    def on_syn(self, stream_id, payload):
+        if stream_id in self.streams:
+            logging.error("[m{0}]流{1}已经存在".format(self.id, stream_id))
+            self.close()
+            return
+        # 域名不是合法的UTF-8时同样中止这条流
+        try:
+            host, port, _ = parse_shadow_head(payload)
+            host = to_str(host)
+        except Exception:
+            logging.error("[m{0}.{1}]解析Shadow头失败".format(self.id, stream_id))
+            self.send_frame(RST, stream_id)
+            return
+
+        stream = ServerStream(self, stream_id)
+        logging.info("[{0}]请求连接到 {1}:{2}".format(stream.tag, host, port))
+        stream.open_remote(host, port)
+
+
+class ClientSession(Session):
+    '''
+    客户端一侧的会话。连接建立后发送多路复用请求头，收到HELLO后才可以打开流。
+    '''
+
+    def __init__(self, selector, timers, addr, cryptor, close_callback):
+        sock = socket()
+        sock.setblocking(False)
+        sock.setsockopt(SOL_TCP, TCP_NODELAY, 1)
+        super().__init__(selector, timers, sock, addr, cryptor)
+        self.close_callback = close_callback
+        self.connected = False  # TCP连接已经建立
+        self.ready = False  # 服务器已经确认多路复用
+        self.connect_timeout = None  # 服务器连接远程地址的超时秒数，由HELLO帧告知
+        self.next_id = 1
+
+    def start(self):
+        try:
+            self.sock.connect(self.addr)
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            logging.warning("[m{0}]连接隧道服务器{1}:{2}失败: {3}".format(
+                self.id, self.addr[0], self.addr[1], e))
+            self.close()
+            return
+        self.selector.register(self.sock, EVENT_WRITE, self._on_connected)
+
+    def _on_connected(self, key, mask):
+        err = self.sock.getsockopt(SOL_SOCKET, SO_ERROR)
+        if err:
+            logging.warning("[m{0}]连接隧道服务器{1}:{2}失败".format(
+                self.id, self.addr[0], self.addr[1]))
+            self.close()
+            return
+
+        self.connected = True
+        self.selector.unregister(self.sock)
+        self._send(self.cryptor.cipher(MUX_HEAD))
+        self._update_events()
+
+    def on_hello(self, payload):
+        if self.ready:
+            super().on_hello(payload)
+            return
+        if len(payload) != CONNECT_TIMEOUT_MS.size:
+            logging.error("[m{0}]HELLO帧的长度错误".format(self.id))
+            self.close()
+            return
+        self.connect_timeout = CONNECT_TIMEOUT_MS.unpack(payload)[0] / 1000
+        logging.info("[m{0}]隧道服务器{1}:{2}确认多路复用，连接超时{3}秒".format(
+            self.id, self.addr[0], self.addr[1], self.connect_timeout))
+        self.ready = True
+
+    def open_stream(self, sock, addr, head, data=b''):
+        '''
+        为本地套接字打开一条流。head是Shadow头，data是HTTP头之后已经读到的数据。
+
+        不需要等待服务器确认，立刻向本地回复HTTP 200。服务器连接远程地址失败时会中止这条流。
+        回复本地失败时关闭本地套接字，返回None。
+        '''
+        # 回复不是对方发来的数据，不经过有流量控制的输出队列，直接写入本地套接字。
+        # 新连接的发送缓冲区是空的，一次就能写完
+        try:
+            if sock.send(REPLY) < len(REPLY):
+                raise OSError('发送缓冲区已满')
+        except OSError as e:
+            logging.error("[m{0}]回复本地连接{1}:{2}失败: {3}".format(
+                self.id, addr[0], addr[1], e))
+            sock.close()
+            return None
+
+        stream_id = self.next_id
+        self.next_id += 1
+        stream = ClientStream(self, stream_id, sock, addr)
+        logging.debug("[{0}]打开流".format(stream.tag))
+
+        self.send_frame(SYN, stream_id, head)
+        if data:
+            stream.send(data)
+        stream.update_events()
+        return stream
+
+    def on_close(self):
+        self.close_callback(self)
+
+
+class MuxClient:
+    '''
+    客户端的会话池：保持size条到隧道服务器的多路复用会话，断开后重新连接。
+    '''
+
+    def __init__(self, selector, timers, addr, cyptor_factory, size):
+        self.selector = selector
+        self.timers = timers
+        self.addr = addr
+        self.cyptor_factory = cyptor_factory
+        self.size = size
+        self.sessions = []  # 包括正在连接和协商的会话
+        self.retry_timer = None
+        self._fill()
+
+    def ready(self):
+        '''
+        是否有已经完成协商、可以打开流的会话。
+        '''
+        return any(session.ready for session in self.sessions)
+
+    def open_stream(self, sock, addr, head, data=b''):
+        '''
+        在流最少的会话中打开一条流。没有可用的会话时返回None。
+        '''
+        sessions = [session for session in self.sessions if session.ready]
+        if not sessions:
+            return None
+        session = min(sessions, key=lambda session: len(session.streams))
+        return session.open_stream(sock, addr, head, data)
+
+    def _fill(self):
+        while len(self.sessions) < self.size and self.retry_timer is None:
+            session = ClientSession(self.selector, self.timers, self.addr,
+                                    self.cyptor_factory.new(),
+                                    self._on_session_closed)
+            self.sessions.append(session)
+            session.start()
+
+    def _on_session_closed(self, session):
+        self.sessions.remove(session)
+        if session.connected and not session.ready:
+            # 服务器不认识多路复用请求头，直接关闭了连接
+            logging.warning("隧道服务器{0}:{1}不支持多路复用，{2}秒内使用经典模式".format(
+                self.addr[0], self.addr[1], NEGOTIATE_RETRY))
+            if self.retry_timer:
+                self.retry_timer.cancel()
+            self.retry_timer = self.timers.call_later(NEGOTIATE_RETRY,
+                                                      self._on_retry)
+        elif self.retry_timer is None:
+            self.retry_timer = self.timers.call_later(RETRY_DELAY,
+                                                      self._on_retry)
+
+    def _on_retry(self):
+        self.retry_timer = None
+        self._fill()
+
+
+def test():
+    buf = bytearray(encode_frame(SYN, 1, b'head') + encode_frame(FIN, 1))
+    frame = encode_frame(DATA, 7, b'x' * 100)
+    buf += frame[:50]
+    assert decode_frames(buf) == [(SYN, 1, b'head'), (FIN, 1, b'')]
+    assert bytes(buf) == frame[:50]
+    buf += frame[50:]
+    assert decode_frames(buf) == [(DATA, 7, b'x' * 100)]
+    assert not buf
+
+    assert is_mux_head(MUX_HEAD + b'rest')
+    assert not is_mux_head(b'\x01\x7f\x00\x00\x01\x00\x50')
+
+    # 对方发来的畸形帧只中止流或者关闭会话，不会从事件回调中抛出异常
+    from selectors import DefaultSelector
+    from eventloop import TimerWheel
+
+    class PlainCyptor:
+        def cipher(self, data):
+            return bytes(data)
+
+    listener = socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    client = socket()
+    client.connect(listener.getsockname())
+    sock, addr = listener.accept()
+    listener.close()
+    session = ServerSession(DefaultSelector(), TimerWheel(), sock, addr,
+                            PlainCyptor(), None)
+    # 域名不是合法的UTF-8
+    session.on_frames([(SYN, 1, b'\x03\x02\xff\xfe\x00\x50')])
+    assert not session.streams
+    client.settimeout(1)
+    buf = bytearray(client.recv(1024))
+    assert decode_frames(buf) == [
+        (HELLO, 0, CONNECT_TIMEOUT_MS.pack(Stream.CONNECT_TIMEOUT * 1000)),
+        (RST, 1, b'')]
+    Stream(session, 2)
+    session.on_frames([(WINDOW, 2, b'\x00')])
+    assert session.closed
+    client.close()
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,338 @@
+'''
+用于测试和基准测试的DNS服务器。
+
+StubDNSServer在本地的UDP和TCP端口上回答任何A和AAAA查询，地址由域名的哈希值生成，
+可以设置回应的延迟、丢包的比例、TTL、UDP回应被截断的比例和CNAME链的长度。
+以nx-开头的域名回答NXDOMAIN。不访问外部网络，所以可以对asyncdns.DNSResolver做压力测试。
+
+    python stub_dns.py [--port PORT] [--latency SECONDS] [--jitter SECONDS] [--loss RATIO]
+                       [--ttl SECONDS] [--truncate RATIO] [--cname N] [--no-ipv6]
+'''
+
+import argparse
+import heapq
+import logging
+import multiprocessing
+import random
+import socket
+import struct
+import time
+import zlib
+from selectors import EVENT_READ, DefaultSelector
+
+from asyncdns import (QCLASS_IN, QTYPE_A, QTYPE_AAAA, QTYPE_CNAME, QTYPE_SOA,
+                      RCODE_NXDOMAIN, RECV_BUFFER_SIZE, build_address,
+                      parse_name)
+
+NXDOMAIN_PREFIX = b'nx-'
+
+
+def address_of(hostname, qtype):
+    '''
+    域名对应的地址，同一个域名总是得到同一个地址。
+    '''
+    h = zlib.crc32(hostname)
+    if qtype == QTYPE_A:
+        return socket.inet_aton('10.{0}.{1}.{2}'.format(
+            h >> 16 & 255, h >> 8 & 255, h & 255))
+    return socket.inet_pton(socket.AF_INET6, 'fd00::{0:x}:{1:x}'.format(
+        h >> 16, h & 0xffff))
+
+
+def _record(name, rtype, ttl, rdata):
+    return name + struct.pack('!HHiH', rtype, QCLASS_IN, ttl,
+                              len(rdata)) + rdata
+
+
+class StubDNSServer:
+    '''
+    在host:port上监听UDP和TCP的DNS服务器。port为0时由系统选择，address是实际监听的地址。
+
+    latency和jitter：每个回应延迟latency加上0到jitter之间的随机秒数发出。
+    loss：UDP查询被丢弃的比例。truncate：UDP回应被截断（设置TC，没有记录）的比例，客户端需要改用TCP。
+    cname：回答中地址之前CNAME链的长度。ipv6为False时AAAA查询没有地址。
+    '''
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0, jitter=0, loss=0,
+                 ttl=300, truncate=0, cname=0, ipv6=True, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.ttl = ttl
+        self.truncate = truncate
+        self.cname = cname
+        self.ipv6 = ipv6
+        self.random = random.Random(seed)
+        self.stats = {'queries': 0, 'dropped': 0, 'truncated': 0,
+                      'tcp_queries': 0}
+
+        # port为0时系统只保证UDP端口空闲，TCP的同一个端口被占用时换一个端口
+        for _ in range(10):
+            self._udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            # 基准测试中查询会成批到达
+            self._udp.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+            self._udp.bind((host, port))
+            self.address = self._udp.getsockname()
+            self._tcp = socket.socket()
+            self._tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                self._tcp.bind(self.address)
+                break
+            except OSError:
+                self.close()
+                if port:
+                    raise
+        else:
+            raise OSError('没有UDP和TCP都空闲的端口')
+        self._udp.setblocking(False)
+        self._tcp.listen(128)
+        self._tcp.setblocking(False)
+        self._pending = []  # (发送时间, 序号, 发送函数, 数据)
+        self._seq = 0
+
+    def answer(self, request, tcp=False):
+        '''
+        返回对request的回应。
+        '''
+        length, hostname = parse_name(request, 12)
+        question = request[12:12 + length + 4]
+        qtype = struct.unpack('!H', question[-4:-2])[0]
+        rcode = 0
+        flags = 0x81  # QR、RD
+        records = []
+        authority = []
+        negative = True  # 没有地址，需要SOA
+        if hostname.startswith(NXDOMAIN_PREFIX):
+            rcode = RCODE_NXDOMAIN
+        elif not tcp and self.truncate and \
+                self.random.random() < self.truncate:
+            self.stats['truncated'] += 1
+            flags |= 0x02
+        elif qtype in (QTYPE_A, QTYPE_AAAA):
+            name = b'\xc0\x0c'
+            for i in range(self.cname):
+                target = build_address(b'c%d.' % (i + 1) + hostname)
+                records.append(_record(name, QTYPE_CNAME, self.ttl, target))
+                name = target
+            if qtype == QTYPE_A or self.ipv6:
+                records.append(_record(name, qtype, self.ttl,
+                                       address_of(hostname, qtype)))
+                negative = False
+        if negative and not flags & 0x02:
+            # 否定回答带上SOA，客户端按它的minimum缓存
+            soa = b'\0\0' + struct.pack('!IIIII', 1, 0, 0, 0, self.ttl)
+            authority.append(_record(b'\xc0\x0c', QTYPE_SOA, self.ttl, soa))
+        header = struct.pack('!2sBBHHHH', request[:2], flags, 0x80 | rcode, 1,
+                             len(records), len(authority), 0)
+        return header + question + b''.join(records + authority)
+
+    def _delay(self):
+        if self.jitter:
+            return self.latency + self.random.random() * self.jitter
+        return self.latency
+
+    def _schedule(self, send, data):
+        delay = self._delay()
+        if delay <= 0:
+            send(data)
+            return
+        self._seq += 1
+        heapq.heappush(self._pending,
+                       (time.monotonic() + delay, self._seq, send, data))
+
+    def _on_udp(self, key, mask):
+        while True:
+            try:
+                request, addr = self._udp.recvfrom(RECV_BUFFER_SIZE)
+            except BlockingIOError:
+                return
+            self.stats['queries'] += 1
+            if self.loss and self.random.random() < self.loss:
+                self.stats['dropped'] += 1
+                continue
+            try:
+                response = self.answer(request)
+            except (ValueError, struct.error, IndexError):
+                continue
+            self._schedule(
+                lambda data, addr=addr: self._udp.sendto(data, addr),
+                response)
+
+    def _on_accept(self, key, mask):
+        try:
+            conn, _ = self._tcp.accept()
+        except BlockingIOError:
+            return
+        buf = bytearray()
+
+        def close():
+            self._selector.unregister(conn)
+            conn.close()
+
+        def send(data):
+            try:
+                conn.setblocking(True)
+                conn.sendall(struct.pack('!H', len(data)) + data)
+            except OSError:
+                pass
+            conn.close()
+
+        def on_read(key, mask):
+            try:
+                data = conn.recv(RECV_BUFFER_SIZE)
+            except OSError:
+                data = b''
+            if not data:
+                close()
+                return
+            buf.extend(data)
+            if len(buf) < 2 or \
+                    len(buf) < 2 + struct.unpack('!H', buf[:2])[0]:
+                return
+            self._selector.unregister(conn)
+            self.stats['tcp_queries'] += 1
+            self._schedule(send, self.answer(bytes(buf[2:]), tcp=True))
+
+        self._selector.register(conn, EVENT_READ, on_read)
+
+    def serve_forever(self, control=None):
+        '''
+        处理查询。control是multiprocessing的Connection，收到任何消息时回复stats并返回。
+        '''
+        self._selector = DefaultSelector()
+        self._selector.register(self._udp, EVENT_READ, self._on_udp)
+        self._selector.register(self._tcp, EVENT_READ, self._on_accept)
+        if control is not None:
+            self._selector.register(control, EVENT_READ, None)
+        while True:
+            timeout = None
+            if self._pending:
+                timeout = max(0, self._pending[0][0] - time.monotonic())
+            for key, mask in self._selector.select(timeout):
+                if key.data is None:
+                    control.recv()
+                    control.send(self.stats)
+                    self._selector.close()
+                    return
+                key.data(key, mask)
+            now = time.monotonic()
+            while self._pending and self._pending[0][0] <= now:
+                _, _, send, data = heapq.heappop(self._pending)
+                send(data)
+
+    def close(self):
+        self._udp.close()
+        self._tcp.close()
+
+
+class StubProcess:
+    '''
+    在子进程中运行StubDNSServer，不和被测的解析器争抢GIL。stop返回服务器的统计。
+    '''
+
+    def __init__(self, **options):
+        server = StubDNSServer(**options)
+        self.address = server.address
+        self._control, child = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(
+            target=server.serve_forever, args=(child,), daemon=True)
+        self._process.start()
+        server.close()
+
+    def stop(self):
+        self._control.send(None)
+        stats = self._control.recv()
+        self._process.join()
+        return stats
+
+
+def test():
+    import threading
+
+    from asyncdns import DNSResolver, build_request, parse_response
+    from eventloop import TimerWheel
+
+    server = StubDNSServer(cname=2, ttl=60, ipv6=False, seed=1)
+    response = parse_response(server.answer(
+        build_request(b'www.example.com', QTYPE_A)))
+    assert response.answers == [
+        (b'c1.www.example.com', QTYPE_CNAME, QCLASS_IN, 60),
+        (b'c2.www.example.com', QTYPE_CNAME, QCLASS_IN, 60),
+        (socket.inet_ntoa(address_of(b'www.example.com', QTYPE_A)), QTYPE_A,
+         QCLASS_IN, 60)]
+    response = parse_response(server.answer(
+        build_request(b'www.example.com', QTYPE_AAAA)))
+    assert response.answers[-1][1] == QTYPE_CNAME
+    assert response.negative_ttl == 60
+    response = parse_response(server.answer(
+        build_request(b'nx-a.example.com', QTYPE_A)))
+    assert response.rcode == RCODE_NXDOMAIN
+
+    # 截断的UDP回应由解析器改用TCP重新查询，延迟的回应按时发出
+    server.cname = 0
+    server.truncate = 0.5
+    server.latency = 0.05
+    control, child = multiprocessing.Pipe()
+    thread = threading.Thread(target=server.serve_forever, args=(child,))
+    thread.start()
+
+    selector = DefaultSelector()
+    timers = TimerWheel()
+    resolver = DNSResolver(server_list=['127.0.0.1'],
+                           port=server.address[1])
+    resolver.add_to_loop(selector, timers)
+    results = []
+    for i in range(20):
+        resolver.resolve('h%d.example.com' % i,
+                         lambda result, error: results.append(result))
+    start = time.monotonic()
+    while len(results) < 20:
+        assert time.monotonic() - start < 5
+        for key, mask in selector.select(0.1):
+            key.data(key, mask)
+        timers.run_due()
+    assert time.monotonic() - start >= 0.05
+    assert all(addrs == [socket.inet_ntoa(address_of(hostname, QTYPE_A))]
+               for hostname, addrs in results)
+
+    control.send(None)
+    stats = control.recv()
+    thread.join()
+    assert stats['queries'] == 40
+    assert 0 < stats['truncated'] == stats['tcp_queries']
+    resolver.close()
+    server.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='测试用DNS服务器')
+    parser.add_argument('--host', default='127.0.0.1', help='监听地址')
+    parser.add_argument('--port', type=int, default=5353, help='监听端口')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='每个回应延迟的秒数')
+    parser.add_argument('--jitter', type=float, default=0,
+                        help='在延迟上再加0到这么多秒的随机延迟')
+    parser.add_argument('--loss', type=float, default=0,
+                        help='丢弃UDP查询的比例')
+    parser.add_argument('--ttl', type=int, default=300, help='回答的TTL')
+    parser.add_argument('--truncate', type=float, default=0,
+                        help='截断UDP回应的比例')
+    parser.add_argument('--cname', type=int, default=0,
+                        help='CNAME链的长度')
+    parser.add_argument('--no-ipv6', action='store_true',
+                        help='AAAA查询没有地址')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    server = StubDNSServer(args.host, args.port, args.latency, args.jitter,
+                           args.loss, args.ttl, args.truncate, args.cname,
+                           not args.no_ipv6)
+    logging.info('DNS服务器监听%s:%d', *server.address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.close()
+
+
+if __name__ == '__main__':
+    main()
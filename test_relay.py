@@ -0,0 +1,384 @@
+'''
+隧道转发测试。
+
+在本机启动一个回显服务器，分别使用每种引擎启动隧道服务器和隧道客户端，
+通过HTTP CONNECT建立隧道后检查数据能否原样返回。不需要访问外部网络。
+'''
+
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+import common
+import encypt
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+PASSWORD = 'relay-test'
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_echo_server():
+    '''
+    启动回显服务器。读到EOF后关闭连接，用来检查半关闭的传递。
+    '''
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(128)
+
+    def serve(conn):
+        with conn:
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    break
+                conn.sendall(data)
+
+    def accept_loop():
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=serve, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=accept_loop, daemon=True).start()
+    return listener
+
+
+def wait_for_port(port, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError('port {0} not ready'.format(port))
+
+
+class Tunnel:
+    '''
+    用指定的引擎启动一对隧道服务器和隧道客户端子进程。
+    '''
+
+    def __init__(self, engine, extra_args=(), client_args=(), server_args=()):
+        self.server_port = free_port()
+        self.client_port = free_port()
+        common = ['-c', PASSWORD, '-e', engine] + list(extra_args)
+        # 先启动服务器，客户端的预连接和多路复用会话一开始就能连上
+        self.procs = [
+            subprocess.Popen(
+                [sys.executable, 'server.py', '-l', str(self.server_port)] +
+                common + list(server_args), cwd=ROOT),
+        ]
+        wait_for_port(self.server_port)
+        self.procs.append(
+            subprocess.Popen(
+                [sys.executable, 'client.py', '-i', '127.0.0.1', '-p',
+                 str(self.server_port), '-l', str(self.client_port)] + common +
+                list(client_args), cwd=ROOT))
+        wait_for_port(self.client_port)
+
+    def connect(self, host, port):
+        '''
+        通过隧道客户端建立到host:port的隧道，返回已经建立的套接字。
+        '''
+        sock = socket.create_connection(('127.0.0.1', self.client_port))
+        sock.settimeout(10)
+        sock.sendall('CONNECT {0}:{1} HTTP/1.1\r\nHost: {0}:{1}\r\n\r\n'.format(
+            host, port).encode())
+        reply = b''
+        while b'\r\n\r\n' not in reply:
+            data = sock.recv(1024)
+            assert data, 'tunnel closed before reply'
+            reply += data
+        assert reply.startswith(b'HTTP/1.1 200'), reply
+        return sock
+
+    def close(self):
+        for proc in self.procs:
+            proc.terminate()
+        for proc in self.procs:
+            proc.wait()
+
+
+def recv_exactly(sock, size):
+    chunks = []
+    while size > 0:
+        data = sock.recv(min(size, 1 << 20))
+        assert data, 'unexpected EOF'
+        chunks.append(data)
+        size -= len(data)
+    return b''.join(chunks)
+
+
+def check_echo(tunnel, target_port, size):
+    sock = tunnel.connect('127.0.0.1', target_port)
+    payload = os.urandom(size)
+    sender = threading.Thread(target=sock.sendall, args=(payload,))
+    sender.start()
+    assert recv_exactly(sock, size) == payload
+    sender.join()
+
+    # 半关闭：本地关闭写之后，回显服务器关闭连接，EOF应该传回本地
+    sock.shutdown(socket.SHUT_WR)
+    assert sock.recv(1) == b''
+    sock.close()
+
+
+def check_bad_host(tunnel):
+    '''
+    请求连接到空的或者不合法的域名，只关闭这条隧道，隧道服务器继续工作。
+    '''
+    for host in ('', 'bad-'):
+        sock = socket.create_connection(('127.0.0.1', tunnel.client_port))
+        sock.settimeout(10)
+        sock.sendall('CONNECT {0}:80 HTTP/1.1\r\n\r\n'.format(host).encode())
+        try:
+            while sock.recv(1024):
+                pass
+        except ConnectionResetError:
+            pass
+        sock.close()
+
+
+def check_split_head(tunnel, target_port, method):
+    '''
+    初始向量（AEAD是salt和数据块）和Shadow头被拆分到多次写中，隧道服务器也能正确解析。
+    '''
+    cryptor = encypt.new_cyptor(method, common.to_bytes(PASSWORD))
+    data = cryptor.cipher(
+        common.make_shadow_head((b'127.0.0.1', target_port)) + b'ping')
+    sock = socket.create_connection(('127.0.0.1', tunnel.server_port))
+    sock.settimeout(10)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    for i in range(48):
+        sock.sendall(data[i:i + 1])
+        time.sleep(0.005)
+    sock.sendall(data[48:])
+    reply = b''
+    while len(reply) < 4:
+        data = sock.recv(1024)
+        assert data, 'tunnel closed before reply'
+        reply += cryptor.decipher(data)
+    assert reply == b'ping'
+    sock.close()
+
+
+def run_relay_test(engine, client_args=(), extra_args=()):
+    echo = start_echo_server()
+    target_port = echo.getsockname()[1]
+    tunnel = Tunnel(engine, extra_args, client_args)
+    try:
+        check_bad_host(tunnel)
+        method = extra_args[extra_args.index('-m') + 1] \
+            if '-m' in extra_args else 'aes-256-cfb'
+        check_split_head(tunnel, target_port, method)
+        for size in (1, 1000, 64 * 1024, 8 * 1024 * 1024):
+            check_echo(tunnel, target_port, size)
+
+        errors = []
+
+        def worker():
+            try:
+                check_echo(tunnel, target_port, 16 * 1024)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker) for _ in range(20)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert not errors, errors
+    finally:
+        tunnel.close()
+        echo.close()
+
+
+def test_selector_engine():
+    run_relay_test('selector')
+
+
+def test_selector_engine_warm_pool():
+    run_relay_test('selector', ['--pool-size', '4'])
+
+
+def test_selector_engine_mux():
+    run_relay_test('selector', ['--mux', '2'])
+
+
+def test_selector_engine_aead():
+    run_relay_test('selector', extra_args=['-m', 'aes-256-gcm'])
+    run_relay_test('selector', ['--mux', '2'],
+                   ['-m', 'chacha20-ietf-poly1305'])
+
+
+def test_selector_engine_crypto_threads():
+    threads = ['--crypto-threads', '2', '--offload-size', '1024']
+    run_relay_test('selector', extra_args=threads)
+    run_relay_test('selector', extra_args=threads + ['-m', 'aes-256-gcm'])
+
+
+def test_selector_engine_verbose_log():
+    # 日志由后台线程写出，工作进程中重新创建写日志的线程
+    run_relay_test('selector',
+                   extra_args=['-v', '--log-sample', '64', '-w', '2'])
+
+
+def read_metrics(port):
+    '''
+    读取运行指标，返回{样本名: 值}。
+    '''
+    url = 'http://127.0.0.1:{0}/metrics'.format(port)
+    with urllib.request.urlopen(url, timeout=5) as response:
+        text = response.read().decode('utf-8')
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            samples[name] = float(value)
+    return samples
+
+
+def test_selector_engine_metrics():
+    client_metrics, server_metrics = free_port(), free_port()
+    echo = start_echo_server()
+    target_port = echo.getsockname()[1]
+    tunnel = Tunnel('selector', client_args=['--metrics-port',
+                                             str(client_metrics)],
+                    server_args=['--metrics-port', str(server_metrics)])
+    try:
+        wait_for_port(server_metrics)
+        check_echo(tunnel, target_port, 64 * 1024)
+        check_echo(tunnel, target_port, 1)
+
+        # 隧道关闭之后各个状态的隧道数回到0
+        deadline = time.time() + 5
+        while True:
+            server = read_metrics(server_metrics)
+            client = read_metrics(client_metrics)
+            established = (
+                server['shadow_server_tunnels{state="S_ESTABLISHED"}'] +
+                client['shadow_client_tunnels{state="S_ESTABLISHED"}'])
+            if not established:
+                break
+            assert time.time() < deadline
+            time.sleep(0.05)
+    finally:
+        tunnel.close()
+        echo.close()
+
+    # 启动时wait_for_port检查端口的连接也计算在内
+    assert server['shadow_server_connections_total'] == 3
+    assert client['shadow_client_connections_total'] == 3
+    assert server['shadow_server_bytes_total{direction="downstream"}'] == \
+        64 * 1024 + 1
+    assert client['shadow_client_bytes_total{direction="upstream"}'] == \
+        64 * 1024 + 1
+    assert server['shadow_server_first_byte_seconds_count'] == 2
+    assert server['shadow_server_connect_seconds_count'] == 2
+    assert client['shadow_client_connect_seconds_count'] == 2
+    # 目标是IP地址，不需要DNS解析
+    assert server['shadow_server_dns_seconds_count'] == 0
+    assert server['shadow_server_dns_cache_misses_total'] == 0
+
+
+def test_selector_engine_loop_monitor():
+    # 监控事件循环时数据照常转发，每个处理函数的耗时记入指标
+    server_metrics = free_port()
+    echo = start_echo_server()
+    tunnel = Tunnel('selector', ['--slow-callback', '0.5'],
+                    server_args=['--metrics-port', str(server_metrics)])
+    try:
+        wait_for_port(server_metrics)
+        check_echo(tunnel, echo.getsockname()[1], 1024 * 1024)
+        server = read_metrics(server_metrics)
+    finally:
+        tunnel.close()
+        echo.close()
+
+    handler = 'shadow_server_callback_seconds_count{{handler="{0}"}}'
+    assert server[handler.format('Connection.init_on_local_read')] >= 1
+    assert server[handler.format('Connection.establised_on_local_event')] >= 1
+    assert server[handler.format('TimerWheel.run_due')] >= 1
+    assert server['shadow_server_loop_events_count'] >= 1
+
+
+def test_asyncio_engine():
+    run_relay_test('asyncio')
+
+
+def test_asyncio_engine_aead():
+    run_relay_test('asyncio', extra_args=['-m', 'aes-128-gcm'])
+
+
+def test_selector_idle_tunnel_memory():
+    # 每条空闲隧道占用的内存不能超过bench_memory.BUDGET
+    subprocess.run([sys.executable, 'bench_memory.py', '--tunnels', '500',
+                    '--check'], cwd=ROOT, check=True)
+
+
+def test_e2e_benchmark():
+    # 端到端基准测试能跑完并写出JSON结果
+    with tempfile.TemporaryDirectory() as tmp:
+        output = os.path.join(tmp, 'e2e.json')
+        subprocess.run([sys.executable, 'bench_e2e.py', '--connections', '2',
+                        '--bulk-size', '1', '--rounds', '20',
+                        '--handshake-time', '0.3', '--output', output],
+                       cwd=ROOT, check=True, stdout=subprocess.DEVNULL)
+        with open(output) as f:
+            results = json.load(f)['results']
+    assert results['upload_mbps'] > 0 and results['download_mbps'] > 0
+    assert 0 < results['rtt_p50_ms'] <= results['rtt_p99_ms']
+    assert results['handshakes_per_sec'] > 0
+
+
+def test_dns_resolver_benchmark():
+    # 截断、丢包和第一个服务器不回应时，解析都能完成
+    subprocess.run([sys.executable, '-c', 'import stub_dns; stub_dns.test()'],
+                   cwd=ROOT, check=True)
+    with tempfile.TemporaryDirectory() as tmp:
+        output = os.path.join(tmp, 'dns.json')
+        subprocess.run([sys.executable, 'bench_dns_resolver.py', '--queries',
+                        '2000', '--hosts', '500', '--scenarios',
+                        'fast,truncated,lossy,dead-primary', '--output',
+                        output], cwd=ROOT, check=True,
+                       stdout=subprocess.DEVNULL)
+        with open(output) as f:
+            results = json.load(f)['results']
+    for name, result in results.items():
+        assert result['failures'] == 0, name
+        assert result['cache_hit_ratio'] > 0.5, name
+    assert results['truncated']['tcp_queries'] > 0
+    assert results['lossy']['dropped'] > 0
+
+
+if __name__ == '__main__':
+    test_selector_engine()
+    test_selector_engine_warm_pool()
+    test_selector_engine_mux()
+    test_selector_engine_aead()
+    test_selector_engine_crypto_threads()
+    test_selector_engine_verbose_log()
+    test_selector_engine_metrics()
+    test_selector_engine_loop_monitor()
+    test_asyncio_engine()
+    test_asyncio_engine_aead()
+    test_selector_idle_tunnel_memory()
+    test_e2e_benchmark()
+    test_dns_resolver_benchmark()
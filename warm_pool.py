@@ -0,0 +1,215 @@
+'''
+到隧道服务器的预连接池。
+
+客户端为每个CONNECT请求新建到隧道服务器的连接，要先等待一次完整的TCP握手。
+连接池在后台保持若干个已经建立、还没有使用的连接，收到CONNECT请求时直接取出一个，
+立刻发送Shadow头，省去一次到隧道服务器的往返。
+'''
+
+import collections
+import logging
+import os
+from selectors import EVENT_READ, EVENT_WRITE
+from socket import SO_ERROR, SOL_SOCKET, SOL_TCP, TCP_NODELAY, socket
+
+# 连接失败后等待多少秒再补充，避免隧道服务器不可用时不停地重连
+RETRY_DELAY = 1
+
+# 检查空闲连接是否过期的间隔秒数
+SWEEP_INTERVAL = 1
+
+
+class WarmPool:
+    '''
+    到一个地址的预连接池。这个类不是线程安全的。
+
+    size是池中保持的连接数（包括正在建立的），max_idle是连接在池中最多停留的秒数，
+    应该小于隧道服务器的空闲超时，否则取出的连接可能已经被服务器关闭。
+    '''
+
+    def __init__(self, selector, timers, addr, size, max_idle=30):
+        self.selector = selector
+        self.timers = timers
+        self.addr = addr
+        self.size = size
+        self.max_idle = max_idle
+        self._idle = collections.OrderedDict()  # sock -> 建立的时间，最早的在最前面
+        self._connecting = set()
+        self._retry_timer = None
+
+        timers.call_periodic(SWEEP_INTERVAL, self._sweep)
+        self._fill()
+
+    def __len__(self):
+        return len(self._idle)
+
+    def acquire(self):
+        '''
+        取出一个已经建立的连接，池为空时返回None。
+
+        取出的连接已经从selector中解除注册，之后由调用者负责。
+        '''
+        sock = None
+        if self._idle:
+            # 先用最早建立的连接，它们离过期最近
+            sock, _ = self._idle.popitem(last=False)
+            self.selector.unregister(sock)
+        self._fill()
+        return sock
+
+    def close(self):
+        '''
+        关闭池中所有的连接，不再补充。
+        '''
+        self.size = 0
+        if self._retry_timer:
+            self._retry_timer.cancel()
+            self._retry_timer = None
+        for sock in list(self._idle) + list(self._connecting):
+            self.selector.unregister(sock)
+            sock.close()
+        self._idle.clear()
+        self._connecting.clear()
+
+    def _fill(self):
+        '''
+        发起非阻塞连接，把池补充到size个。连接失败后的等待期间不补充。
+        '''
+        if self._retry_timer:
+            return
+        while len(self._idle) + len(self._connecting) < self.size:
+            sock = socket()
+            sock.setblocking(False)
+            sock.setsockopt(SOL_TCP, TCP_NODELAY, 1)
+            try:
+                sock.connect(self.addr)
+            except BlockingIOError:
+                pass
+            except OSError as e:
+                sock.close()
+                self._on_failure(e)
+                return
+            self._connecting.add(sock)
+            self.selector.register(sock, EVENT_WRITE, self._on_connected)
+
+    def _on_connected(self, key, mask):
+        '''
+        连接的套接字变为可写，检查连接是否成功。
+        '''
+        sock = key.fileobj
+        self._connecting.discard(sock)
+        err = sock.getsockopt(SOL_SOCKET, SO_ERROR)
+        if err:
+            self.selector.unregister(sock)
+            sock.close()
+            self._on_failure(os.strerror(err))
+            return
+
+        # 隧道服务器不会先发送数据，空闲的连接变为可读说明已经被关闭或者重置
+        self.selector.modify(sock, EVENT_READ, self._on_idle_readable)
+        self._idle[sock] = self.timers.now
+        logging.debug("预连接{0}:{1}成功，池中有{2}个连接".format(
+            self.addr[0], self.addr[1], len(self._idle)))
+
+    def _on_idle_readable(self, key, mask):
+        logging.debug("预连接{0}:{1}已被服务器关闭".format(
+            self.addr[0], self.addr[1]))
+        self._discard(key.fileobj)
+        self._fill()
+
+    def _on_failure(self, error):
+        logging.warning("预连接隧道服务器{0}:{1}失败: {2}".format(
+            self.addr[0], self.addr[1], error))
+        if self._retry_timer is None:
+            self._retry_timer = self.timers.call_later(RETRY_DELAY,
+                                                       self._on_retry)
+
+    def _on_retry(self):
+        self._retry_timer = None
+        self._fill()
+
+    def _discard(self, sock):
+        del self._idle[sock]
+        self.selector.unregister(sock)
+        sock.close()
+
+    def _sweep(self):
+        '''
+        关闭在池中停留超过max_idle秒的连接，并补充新的连接。
+        '''
+        deadline = self.timers.now - self.max_idle
+        while self._idle:
+            sock, since = next(iter(self._idle.items()))
+            if since > deadline:
+                break
+            self._discard(sock)
+        self._fill()
+
+
+def test():
+    import time
+    from selectors import DefaultSelector
+
+    from eventloop import TimerWheel
+
+    def create_server():
+        listener = socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(128)
+        return listener
+
+    listener = create_server()
+    listener.setblocking(False)
+    accepted = []
+
+    selector = DefaultSelector()
+    timers = TimerWheel(tick=0.01)
+    selector.register(listener, EVENT_READ,
+                      lambda key, mask: accepted.append(listener.accept()[0]))
+
+    def run_until(cond, timeout=2):
+        end = time.monotonic() + timeout
+        while not cond():
+            assert time.monotonic() < end
+            for key, mask in selector.select(0.01):
+                key.data(key, mask)
+            timers.update_time()
+            timers.run_due()
+
+    pool = WarmPool(selector, timers, listener.getsockname(), 2, max_idle=0.3)
+    run_until(lambda: len(pool) == 2 and len(accepted) == 2)
+
+    # 取出的连接已经建立，池在后台补充
+    sock = pool.acquire()
+    sock.send(b'x')
+    run_until(lambda: len(accepted) == 3)
+    assert accepted[0].recv(1) == b'x'
+    run_until(lambda: len(pool) == 2)
+
+    # 服务器关闭空闲连接后，池丢弃它并补充
+    accepted[1].close()
+    run_until(lambda: len(accepted) == 4 and len(pool) == 2)
+
+    # 空闲太久的连接被替换
+    run_until(lambda: len(accepted) >= 6, timeout=3)
+
+    pool.close()
+    assert len(pool) == 0
+    sock.close()
+    selector.unregister(listener)
+    listener.close()
+    for s in accepted:
+        s.close()
+
+    # 连接失败时等待后重试，不会不停地重连
+    listener = create_server()
+    addr = listener.getsockname()
+    listener.close()
+    pool = WarmPool(selector, timers, addr, 2)
+    run_until(lambda: pool._retry_timer is not None)
+    assert pool.acquire() is None and not pool._connecting
+    pool.close()
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,94 @@
+'''
+多进程工作模式。
+
+主进程作为监督者，派生出若干个工作进程。每个工作进程使用SO_REUSEPORT绑定同一个监听端口，
+运行各自独立的事件循环，由内核在工作进程之间分配新连接。
+工作进程意外退出时，监督者会重新启动它。
+'''
+
+import logging
+import os
+import signal
+import socket
+import time
+
+# 工作进程启动后在这段时间内退出，视为启动失败，重启前先等待一段时间，避免不停地fork
+MIN_WORKER_LIFETIME = 1.0
+RESTART_DELAY = 1.0
+
+# 当前工作进程的编号，主进程和单进程模式下为None
+worker_index = None
+
+
+def is_supported():
+    '''
+    当前平台是否支持多进程模式。需要fork和SO_REUSEPORT。
+    '''
+    return hasattr(os, 'fork') and hasattr(socket, 'SO_REUSEPORT')
+
+
+def supervise(workers, target, args):
+    '''
+    启动workers个工作进程，每个进程中调用target(args)，并监督它们的运行。
+
+    收到SIGINT或SIGTERM时，结束所有工作进程后返回。
+    '''
+    children = {}  # pid -> (编号, 启动时间)
+    stopping = False
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            global worker_index
+            worker_index = index
+            # 工作进程：恢复默认的信号处理，运行事件循环
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            code = 0
+            try:
+                target(args)
+            except Exception:
+                logging.exception("[worker {0}]工作进程异常退出".format(index))
+                code = 1
+            finally:
+                # os._exit不会执行atexit，先写出日志队列中剩下的日志
+                logging.shutdown()
+                os._exit(code)
+
+        children[pid] = (index, time.time())
+        logging.info("[worker {0}]启动工作进程 pid={1}".format(index, pid))
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    for index in range(workers):
+        spawn(index)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+
+        if pid not in children:
+            continue
+        index, started = children.pop(pid)
+
+        if stopping:
+            continue
+
+        logging.warning("[worker {0}]工作进程 pid={1} 退出，状态{2}，重新启动".format(
+            index, pid, status))
+        if time.time() - started < MIN_WORKER_LIFETIME:
+            time.sleep(RESTART_DELAY)
+        if not stopping:
+            spawn(index)